@@ -6,7 +6,10 @@
 .. moduleauthor:: Kevin Glisson <kglisson@netflix.com>
 """
 import sys
+import time
 import multiprocessing
+
+import arrow
 from tabulate import tabulate
 from sqlalchemy import or_
 
@@ -17,6 +20,8 @@ from flask_principal import Identity, identity_changed
 
 
 from lemur import database
+from lemur.common import defaults
+from lemur.common.utils import parse_certificate
 from lemur.extensions import sentry
 from lemur.extensions import metrics
 from lemur.plugins.base import plugins
@@ -27,13 +32,14 @@ from lemur.notifications.messaging import send_rotation_notification
 from lemur.domains.models import Domain
 from lemur.authorities.models import Authority
 from lemur.certificates.schemas import CertificateOutputSchema
-from lemur.certificates.models import Certificate
+from lemur.certificates.models import Certificate, get_x509_metadata
 from lemur.certificates.service import (
     reissue_certificate,
     get_certificate_primitives,
     get_all_pending_reissue,
     get_by_name,
-    get_all_certs,
+    get_ids_due_revocation_check,
+    get_ids_pending_revocation_check,
     get,
 )
 
@@ -117,6 +123,8 @@ def request_rotation(endpoint, certificate, message, commit):
 
             if message:
                 send_rotation_notification(certificate)
+                # commits the message if it was queued in the outbox
+                database.commit()
 
             status = SUCCESS_METRIC_STATUS
 
@@ -458,27 +466,214 @@ def revoke(path, reason, commit):
         pool.starmap(worker, args)
 
 
-@manager.command
-def check_revoked():
+def iter_revocation_check_ids(window, incremental=False):
     """
-    Function attempts to update Lemur's internal cache with revoked
-    certificates. This is called periodically by Lemur. It checks both
-    CRLs and OCSP to see if a certificate is revoked. If Lemur is unable
-    encounters an issue with verification it marks the certificate status
-    as `unknown`.
+    Streams the ids of certificates due a revocation check, `window` ids at a time.
+
+    In incremental mode only certificates not checked within the last
+    `LEMUR_REVOCATION_CHECK_INTERVAL_SECONDS` are returned, most important first.
+
+    :param window:
+    :param incremental:
+    :return:
+    """
+    if incremental:
+        interval = current_app.config.get("LEMUR_REVOCATION_CHECK_INTERVAL_SECONDS", 86400)
+        yield from get_ids_due_revocation_check(arrow.utcnow().shift(seconds=-interval), window)
+        return
+
+    last_id = 0
+    while True:
+        ids = get_ids_pending_revocation_check(last_id, window)
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+
+def claim_revocation_check(certificate_ids, until):
+    """
+    Leases certificates handed to a revocation check that runs elsewhere. Incremental runs do
+    not pick them again before `until`, and do pick them up afterwards if the check never
+    wrote its result. The lease is recorded as a `last_revocation_check` that falls due at
+    `until`, the check itself overwrites it.
+
+    :param certificate_ids:
+    :param until:
+    :return:
+    """
+    interval = current_app.config.get("LEMUR_REVOCATION_CHECK_INTERVAL_SECONDS", 86400)
+    Certificate.query.filter(Certificate.id.in_(certificate_ids)).update(
+        {Certificate.last_revocation_check: arrow.get(until).shift(seconds=-interval)},
+        synchronize_session=False,
+    )
+    database.commit()
+
+
+def check_revoked_chunk(certificate_ids, deadline=None):
     """
-    for cert in get_all_certs():
+    Checks the given certificates against OCSP and CRLs and writes their statuses back with
+    a single bulk update. Certificates that cannot be verified are marked `unknown`.
+
+    No further certificates are checked once the `deadline` timestamp has passed, those
+    left over keep their previous status and are not counted.
+
+    :param certificate_ids:
+    :param deadline:
+    :return: number of certificates per resulting status
+    """
+    now = arrow.utcnow()
+    mappings = []
+    for cert in Certificate.query.filter(Certificate.id.in_(certificate_ids)):
+        if deadline and time.time() >= deadline:
+            break
+
         try:
-            if cert.chain:
-                status = verify_string(cert.body, cert.chain)
+            status = verify_string(cert.body, cert.chain or "")
+            if status is None:
+                status = "unknown"
             else:
-                status = verify_string(cert.body, "")
-
-            cert.status = "valid" if status else "revoked"
+                status = "valid" if status else "revoked"
 
         except Exception as e:
             sentry.captureException()
             current_app.logger.exception(e)
-            cert.status = "unknown"
+            status = "unknown"
+
+        mappings.append(dict(id=cert.id, status=status, last_revocation_check=now))
 
-        database.update(cert)
+    database.db.session.bulk_update_mappings(Certificate, mappings)
+    database.commit()
+
+    counts = {}
+    for m in mappings:
+        counts[m["status"]] = counts.get(m["status"], 0) + 1
+    return counts
+
+
+@manager.option(
+    "-b",
+    "--batch-size",
+    dest="batch_size",
+    type=int,
+    default=100,
+    help="Number of certificates checked and written per batch.",
+)
+@manager.option(
+    "-i",
+    "--incremental",
+    dest="incremental",
+    action="store_true",
+    default=False,
+    help="Only check certificates not checked within LEMUR_REVOCATION_CHECK_INTERVAL_SECONDS.",
+)
+@manager.option(
+    "-t",
+    "--time-budget",
+    dest="time_budget",
+    type=int,
+    default=None,
+    help="Stop starting new batches after this many seconds (incremental mode only).",
+)
+def check_revoked(batch_size=100, incremental=False, time_budget=None):
+    """
+    Function attempts to update Lemur's internal cache with revoked
+    certificates. This is called periodically by Lemur. It checks both
+    CRLs and OCSP to see if a certificate is revoked. If Lemur is unable
+    encounters an issue with verification it marks the certificate status
+    as `unknown`. Expired and already revoked certificates are skipped.
+
+    In incremental mode certificates checked recently are skipped as well, and the run stops
+    once `time_budget` (default: `LEMUR_REVOCATION_TIME_BUDGET_SECONDS`) seconds have passed,
+    the remaining certificates are picked up by the next run.
+    """
+    if incremental and time_budget is None:
+        time_budget = current_app.config.get("LEMUR_REVOCATION_TIME_BUDGET_SECONDS", 3000)
+
+    start = time.time()
+    deadline = start + time_budget if incremental else None
+    for ids in iter_revocation_check_ids(batch_size, incremental):
+        if incremental and time.time() > deadline:
+            print("[!] Time budget of {0}s exhausted, stopping.".format(time_budget))
+            break
+        check_revoked_chunk(ids, deadline)
+
+
+def backfill_column(column, extract, batch_size):
+    """
+    Fills `column` for certificates stored before Lemur tracked it. Rows are streamed
+    in id order and written back with one bulk update per batch.
+
+    :param column: certificate column to fill
+    :param extract: function computing the value from a parsed certificate
+    :param batch_size:
+    :return: number of certificates filled and failed
+    """
+    filled = 0
+    failed = 0
+    last_id = 0
+    while True:
+        rows = (
+            database.db.session.query(Certificate.id, Certificate.body)
+            .filter(column == None)  # noqa
+            .filter(Certificate.id > last_id)
+            .order_by(Certificate.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+
+        mappings = []
+        for id, body in rows:
+            try:
+                mappings.append({"id": id, column.key: extract(parse_certificate(body))})
+            except ValueError:
+                current_app.logger.warning(f"Unable to parse certificate {id}")
+                failed += 1
+
+        database.db.session.bulk_update_mappings(Certificate, mappings)
+        database.commit()
+
+        filled += len(mappings)
+        last_id = rows[-1].id
+        print(f"[+] Filled {column.key} for {filled} certificates.")
+
+    return filled, failed
+
+
+@manager.option(
+    "-b",
+    "--batch-size",
+    dest="batch_size",
+    type=int,
+    default=1000,
+    help="Number of certificates to fingerprint per transaction.",
+)
+def backfill_fingerprints(batch_size):
+    """
+    Computes the fingerprint of certificates stored before Lemur tracked them.
+    """
+    print("[+] Starting certificate fingerprint backfill.")
+    filled, failed = backfill_column(Certificate.fingerprint, defaults.fingerprint, batch_size)
+    metrics.send("certificate_fingerprint_backfill", "gauge", filled)
+    print(f"[+] Done! Fingerprinted: {filled} Failed: {failed}")
+
+
+@manager.option(
+    "-b",
+    "--batch-size",
+    dest="batch_size",
+    type=int,
+    default=1000,
+    help="Number of certificates to process per transaction.",
+)
+def backfill_x509_metadata(batch_size):
+    """
+    Extracts the subject and extension metadata of certificates stored before Lemur
+    precomputed it, so they are no longer parsed when rendered.
+    """
+    print("[+] Starting certificate metadata backfill.")
+    filled, failed = backfill_column(Certificate.x509_metadata, get_x509_metadata, batch_size)
+    metrics.send("certificate_x509_metadata_backfill", "gauge", filled)
+    print(f"[+] Done! Filled: {filled} Failed: {failed}")
@@ -5,6 +5,7 @@
     :license: Apache, see LICENSE for more details.
 .. moduleauthor:: Kevin Glisson <kglisson@netflix.com>
 """
+import json
 from datetime import timedelta
 
 import arrow
@@ -24,6 +25,7 @@ from sqlalchemy import (
     Boolean,
     Index,
 )
+from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.expression import case, extract
@@ -96,6 +98,109 @@ def get_or_increase_name(name, serial):
     return "{0}-{1}".format(root, max(ends) + 1)
 
 
+def get_extensions(cert, warn_custom=True):
+    # setup default values
+    return_extensions = {"sub_alt_names": {"names": []}}
+
+    try:
+        for extension in cert.extensions:
+            value = extension.value
+            if isinstance(value, x509.BasicConstraints):
+                return_extensions["basic_constraints"] = value
+
+            elif isinstance(value, x509.SubjectAlternativeName):
+                return_extensions["sub_alt_names"]["names"] = value
+
+            elif isinstance(value, x509.ExtendedKeyUsage):
+                return_extensions["extended_key_usage"] = value
+
+            elif isinstance(value, x509.KeyUsage):
+                return_extensions["key_usage"] = value
+
+            elif isinstance(value, x509.SubjectKeyIdentifier):
+                return_extensions["subject_key_identifier"] = {"include_ski": True}
+
+            elif isinstance(value, x509.AuthorityInformationAccess):
+                return_extensions["certificate_info_access"] = {"include_aia": True}
+
+            elif isinstance(value, x509.AuthorityKeyIdentifier):
+                aki = {"use_key_identifier": False, "use_authority_cert": False}
+
+                if value.key_identifier:
+                    aki["use_key_identifier"] = True
+
+                if value.authority_cert_issuer:
+                    aki["use_authority_cert"] = True
+
+                return_extensions["authority_key_identifier"] = aki
+
+            elif isinstance(value, x509.CRLDistributionPoints):
+                return_extensions["crl_distribution_points"] = {
+                    "include_crl_dp": value
+                }
+
+            # TODO: Not supporting custom OIDs yet. https://github.com/Netflix/lemur/issues/665
+            elif warn_custom:
+                current_app.logger.warning(
+                    "Custom OIDs not yet supported for clone operation."
+                )
+    except InvalidCodepoint as e:
+        sentry.captureException()
+        current_app.logger.warning(
+            "Unable to parse extensions due to underscore in dns name"
+        )
+    except ValueError as e:
+        sentry.captureException()
+        current_app.logger.warning("Unable to parse")
+        current_app.logger.exception(e)
+
+    return return_extensions
+
+
+def get_key_type(cert):
+    if isinstance(cert.public_key(), rsa.RSAPublicKey):
+        return "RSA{key_size}".format(key_size=cert.public_key().key_size)
+
+
+def get_name_attribute(cert, oid):
+    attributes = cert.subject.get_attributes_for_oid(oid)
+    if attributes:
+        return attributes[0].value.strip()
+
+
+def get_x509_metadata(cert):
+    """
+    Extracts the values Lemur derives from a parsed certificate so they can be stored
+    alongside it, instead of being re-parsed from the PEM body whenever they are rendered.
+
+    :param cert: parsed certificate
+    :return: JSON serializable dict
+    """
+    from lemur.schemas import ExtensionSchema  # circular import
+
+    metadata = {
+        "organization": get_name_attribute(cert, x509.OID_ORGANIZATION_NAME),
+        "organizational_unit": get_name_attribute(cert, x509.OID_ORGANIZATIONAL_UNIT_NAME),
+        "country": get_name_attribute(cert, x509.OID_COUNTRY_NAME),
+        "state": get_name_attribute(cert, x509.OID_STATE_OR_PROVINCE_NAME),
+        "location": get_name_attribute(cert, x509.OID_LOCALITY_NAME),
+        "distinguished_name": cert.subject.rfc4514_string(),
+        "key_type": get_key_type(cert),
+    }
+
+    # the custom OID warning is for rendering a clone, not for storing a certificate
+    extensions = ExtensionSchema().dump(get_extensions(cert, warn_custom=False)).data
+    try:
+        json.dumps(extensions)
+        metadata["extensions"] = extensions
+    except TypeError:
+        # some general names (e.g. directory names) are not JSON serializable as dumped,
+        # those certificates keep rendering their extensions from the body
+        pass
+
+    return metadata
+
+
 class Certificate(db.Model):
     __tablename__ = "certificates"
     __table_args__ = (
@@ -129,6 +234,7 @@ class Certificate(db.Model):
 
     issuer = Column(String(128))
     serial = Column(String(128))
+    fingerprint = Column(String(64), index=True)
     cn = Column(String(128))
     deleted = Column(Boolean, index=True, default=False)
     dns_provider_id = Column(
@@ -143,8 +249,10 @@ class Certificate(db.Model):
 
     signing_algorithm = Column(String(128))
     status = Column(String(128))
+    last_revocation_check = Column(ArrowType)
     bits = Column(Integer())
     san = Column(String(1024))  # TODO this should be migrated to boolean
+    x509_metadata = Column(JSON)
 
     rotation = Column(Boolean, default=False)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -202,6 +310,7 @@ class Certificate(db.Model):
         self.not_before = defaults.not_before(cert)
         self.not_after = defaults.not_after(cert)
         self.serial = defaults.serial(cert)
+        self.fingerprint = defaults.fingerprint(cert)
 
         # when destinations are appended they require a valid name.
         if kwargs.get("name"):
@@ -244,6 +353,8 @@ class Certificate(db.Model):
         for domain in defaults.domains(cert):
             self.domains.append(Domain(name=domain))
 
+        self.x509_metadata = get_x509_metadata(cert)
+
         # Check integrity before saving anything into the database.
         # For user-facing API calls, validation should also be done in schema validators.
         self.check_integrity()
@@ -272,36 +383,44 @@ class Certificate(db.Model):
     def active(self):
         return self.notify
 
+    def get_metadata_value(self, key, extract):
+        """
+        Returns a value extracted when the certificate was stored, only parsing the body
+        for rows that have not been backfilled yet.
+        """
+        if self.x509_metadata and key in self.x509_metadata:
+            return self.x509_metadata[key]
+        return extract(self.parsed_cert)
+
     @property
     def organization(self):
-        return defaults.organization(self.parsed_cert)
+        return self.get_metadata_value("organization", defaults.organization)
 
     @property
     def organizational_unit(self):
-        return defaults.organizational_unit(self.parsed_cert)
+        return self.get_metadata_value("organizational_unit", defaults.organizational_unit)
 
     @property
     def country(self):
-        return defaults.country(self.parsed_cert)
+        return self.get_metadata_value("country", defaults.country)
 
     @property
     def state(self):
-        return defaults.state(self.parsed_cert)
+        return self.get_metadata_value("state", defaults.state)
 
     @property
     def location(self):
-        return defaults.location(self.parsed_cert)
+        return self.get_metadata_value("location", defaults.location)
 
     @property
     def distinguished_name(self):
-        return self.parsed_cert.subject.rfc4514_string()
+        return self.get_metadata_value(
+            "distinguished_name", lambda cert: cert.subject.rfc4514_string()
+        )
 
     @property
     def key_type(self):
-        if isinstance(self.parsed_cert.public_key(), rsa.RSAPublicKey):
-            return "RSA{key_size}".format(
-                key_size=self.parsed_cert.public_key().key_size
-            )
+        return self.get_metadata_value("key_type", get_key_type)
 
     @property
     def validity_remaining(self):
@@ -373,62 +492,7 @@ class Certificate(db.Model):
 
     @property
     def extensions(self):
-        # setup default values
-        return_extensions = {"sub_alt_names": {"names": []}}
-
-        try:
-            for extension in self.parsed_cert.extensions:
-                value = extension.value
-                if isinstance(value, x509.BasicConstraints):
-                    return_extensions["basic_constraints"] = value
-
-                elif isinstance(value, x509.SubjectAlternativeName):
-                    return_extensions["sub_alt_names"]["names"] = value
-
-                elif isinstance(value, x509.ExtendedKeyUsage):
-                    return_extensions["extended_key_usage"] = value
-
-                elif isinstance(value, x509.KeyUsage):
-                    return_extensions["key_usage"] = value
-
-                elif isinstance(value, x509.SubjectKeyIdentifier):
-                    return_extensions["subject_key_identifier"] = {"include_ski": True}
-
-                elif isinstance(value, x509.AuthorityInformationAccess):
-                    return_extensions["certificate_info_access"] = {"include_aia": True}
-
-                elif isinstance(value, x509.AuthorityKeyIdentifier):
-                    aki = {"use_key_identifier": False, "use_authority_cert": False}
-
-                    if value.key_identifier:
-                        aki["use_key_identifier"] = True
-
-                    if value.authority_cert_issuer:
-                        aki["use_authority_cert"] = True
-
-                    return_extensions["authority_key_identifier"] = aki
-
-                elif isinstance(value, x509.CRLDistributionPoints):
-                    return_extensions["crl_distribution_points"] = {
-                        "include_crl_dp": value
-                    }
-
-                # TODO: Not supporting custom OIDs yet. https://github.com/Netflix/lemur/issues/665
-                else:
-                    current_app.logger.warning(
-                        "Custom OIDs not yet supported for clone operation."
-                    )
-        except InvalidCodepoint as e:
-            sentry.captureException()
-            current_app.logger.warning(
-                "Unable to parse extensions due to underscore in dns name"
-            )
-        except ValueError as e:
-            sentry.captureException()
-            current_app.logger.warning("Unable to parse")
-            current_app.logger.exception(e)
-
-        return return_extensions
+        return get_extensions(self.parsed_cert)
 
     def __repr__(self):
         return "Certificate(name={name})".format(name=self.name)
@@ -273,7 +273,7 @@ class CertificateOutputSchema(LemurOutputSchema):
     status = fields.String()
     user = fields.Nested(UserNestedOutputSchema)
 
-    extensions = fields.Nested(ExtensionSchema)
+    extensions = fields.Method("get_extensions")
 
     # associated objects
     domains = fields.Nested(DomainNestedOutputSchema, many=True)
@@ -289,6 +289,16 @@ class CertificateOutputSchema(LemurOutputSchema):
     )
     rotation_policy = fields.Nested(RotationPolicyNestedOutputSchema)
 
+    def get_extensions(self, obj):
+        # extensions are serialized once when the certificate is stored
+        metadata = getattr(obj, "x509_metadata", None)
+        if metadata and "extensions" in metadata:
+            return metadata["extensions"]
+
+        extensions = obj.get("extensions") if isinstance(obj, dict) else obj.extensions
+        if extensions is not None:
+            return ExtensionSchema().dump(extensions).data
+
 
 class CertificateShortOutputSchema(LemurOutputSchema):
     id = fields.Integer()
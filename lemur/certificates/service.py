@@ -5,18 +5,22 @@
     :license: Apache, see LICENSE for more details.
 .. moduleauthor:: Kevin Glisson <kglisson@netflix.com>
 """
+from collections import defaultdict
+from datetime import datetime
+
 import arrow
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
 from flask import current_app
-from sqlalchemy import func, or_, not_, cast, Integer
+from sqlalchemy import and_, func, or_, not_, cast, case, literal, tuple_, Integer
 
 from lemur import database
 from lemur.authorities.models import Authority
 from lemur.certificates.models import Certificate
 from lemur.certificates.schemas import CertificateOutputSchema, CertificateInputSchema
-from lemur.common.utils import generate_private_key, truthiness
+from lemur.common import defaults
+from lemur.common.utils import generate_private_key, parse_certificate, truthiness
 from lemur.destinations.models import Destination
 from lemur.domains.models import Domain
 from lemur.extensions import metrics, sentry, signals
@@ -68,6 +72,91 @@ def get_by_serial(serial):
     return Certificate.query.filter(Certificate.serial == serial).all()
 
 
+def get_by_names(names):
+    """
+    Retrieves all certificates whose name is in the given list, with a single query.
+
+    :param names:
+    :return:
+    """
+    names = list(names)
+    if not names:
+        return []
+    return Certificate.query.filter(Certificate.name.in_(names)).all()
+
+
+def get_by_serials(serials):
+    """
+    Retrieves all certificates whose serial number is in the given list, with a single query.
+
+    :param serials:
+    :return:
+    """
+    # although serial is a number, the DB column is String(128)
+    serials = [str(s) for s in serials]
+    if not serials:
+        return []
+    return Certificate.query.filter(Certificate.serial.in_(serials)).all()
+
+
+def get_by_fingerprint(fingerprint):
+    """
+    Retrieves certificate(s) by the SHA-256 fingerprint of their body.
+
+    :param fingerprint: hex encoded SHA-256 fingerprint
+    :return:
+    """
+    return Certificate.query.filter(Certificate.fingerprint == fingerprint).all()
+
+
+def get_by_fingerprints(fingerprints):
+    """
+    Retrieves all certificates whose fingerprint is in the given list, with a single query.
+
+    :param fingerprints: hex encoded SHA-256 fingerprints
+    :return:
+    """
+    fingerprints = list(fingerprints)
+    if not fingerprints:
+        return []
+    return Certificate.query.filter(Certificate.fingerprint.in_(fingerprints)).all()
+
+
+def get_by_bodies(certs):
+    """
+    Maps the fingerprint of each of the given parsed certificates to the Lemur certificates
+    with the same body, with a single query. Rows whose fingerprint has not been backfilled
+    yet are found by serial number and compared by parsing their body.
+
+    :param certs: cryptography certificates
+    :return:
+    """
+    fingerprints = {defaults.fingerprint(c) for c in certs}
+    if not fingerprints:
+        return {}
+
+    # although serial is a number, the DB column is String(128)
+    serials = {str(c.serial_number) for c in certs}
+    query = Certificate.query.filter(
+        or_(
+            Certificate.fingerprint.in_(fingerprints),
+            and_(Certificate.fingerprint == None, Certificate.serial.in_(serials)),  # noqa
+        )
+    )
+
+    matches = defaultdict(list)
+    for c in query:
+        fingerprint = c.fingerprint
+        if not fingerprint:
+            try:
+                fingerprint = defaults.fingerprint(parse_certificate(c.body))
+            except ValueError:
+                continue
+        if fingerprint in fingerprints:
+            matches[fingerprint].append(c)
+    return matches
+
+
 def get_by_attributes(conditions):
     """
     Retrieves certificate(s) by conditions given in a hash of given key=>value pairs.
@@ -102,6 +191,77 @@ def get_all_certs():
     return Certificate.query.all()
 
 
+def get_ids_pending_revocation_check(last_id=0, limit=1000):
+    """
+    Retrieves, in id order, the ids after `last_id` of certificates that have not expired
+    and are not already known to be revoked.
+
+    :param last_id:
+    :param limit:
+    :return:
+    """
+    query = (
+        database.db.session.query(Certificate.id)
+        .filter(Certificate.not_after > arrow.utcnow())
+        .filter(or_(Certificate.status != "revoked", Certificate.status == None))  # noqa
+        .filter(Certificate.id > last_id)
+        .order_by(Certificate.id)
+        .limit(limit)
+    )
+    return [id for id, in query]
+
+
+def get_ids_due_revocation_check(checked_before, limit=1000):
+    """
+    Yields, `limit` at a time, the ids of certificates that have not expired, are not already
+    known to be revoked and were not checked since `checked_before`. Certificates attached to
+    endpoints come first, then those issued outside of Lemur's own cryptography authorities,
+    then the longest unchecked.
+
+    Pages are read with keyset pagination on that order, like
+    `get_ids_pending_revocation_check`, so only one page is held at a time.
+
+    :param checked_before:
+    :param limit:
+    :return:
+    """
+    internal_authorities = database.db.session.query(Authority.id).filter(
+        Authority.plugin_name == "cryptography-issuer"
+    )
+    keys = [
+        case([(Certificate.endpoints.any(), 0)], else_=1),
+        case([(Certificate.authority_id.in_(internal_authorities), 1)], else_=0),
+        # never checked sorts first, and the row comparison below needs a value
+        func.coalesce(Certificate.last_revocation_check, datetime(1970, 1, 1)),
+        Certificate.id,
+    ]
+    query = (
+        database.db.session.query(*keys)
+        .filter(Certificate.not_after > arrow.utcnow())
+        .filter(or_(Certificate.status != "revoked", Certificate.status == None))  # noqa
+        .filter(
+            or_(
+                Certificate.last_revocation_check == None,  # noqa
+                Certificate.last_revocation_check < checked_before,
+            )
+        )
+        .order_by(*keys)
+    )
+
+    last = None
+    while True:
+        page = query
+        if last:
+            page = page.filter(
+                tuple_(*keys) > tuple_(*[literal(v, k.type) for k, v in zip(keys, last)])
+            )
+        rows = page.limit(limit).all()
+        if not rows:
+            return
+        yield [row[-1] for row in rows]
+        last = rows[-1]
+
+
 def get_all_pending_cleaning_expired(source):
     """
     Retrieves all certificates that are available for cleaning. These are certificates which are expired and are not
@@ -174,18 +334,28 @@ def get_all_pending_reissue():
 def find_duplicates(cert):
     """
     Finds certificates that already exist within Lemur. We do this by looking for
-    certificate bodies that are the same. This is the most reliable way to determine
-    if a certificate is already being tracked by Lemur.
+    certificate bodies that are the same, using their indexed fingerprint. This is the
+    most reliable way to determine if a certificate is already being tracked by Lemur.
+    Rows without a fingerprint, and bodies that cannot be parsed, are compared as text.
 
     :param cert:
     :return:
     """
+    body = cert["body"].strip()
+    condition = and_(Certificate.fingerprint == None, Certificate.body == body)  # noqa
+    try:
+        condition = or_(
+            Certificate.fingerprint == defaults.fingerprint(parse_certificate(body)),
+            condition,
+        )
+    except ValueError:
+        pass
+
+    query = Certificate.query.filter(condition)
     if cert["chain"]:
-        return Certificate.query.filter_by(
-            body=cert["body"].strip(), chain=cert["chain"].strip()
-        ).all()
+        return query.filter(Certificate.chain == cert["chain"].strip()).all()
     else:
-        return Certificate.query.filter_by(body=cert["body"].strip(), chain=None).all()
+        return query.filter(Certificate.chain == None).all()  # noqa
 
 
 def export(cert, export_plugin):
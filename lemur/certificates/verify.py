@@ -5,33 +5,250 @@
     :license: Apache, see LICENSE for more details.
 .. moduleauthor:: Kevin Glisson <kglisson@netflix.com>
 """
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import arrow
+import redis
 import requests
-import subprocess
 from flask import current_app
-from requests.exceptions import ConnectionError, InvalidSchema
+from requests.adapters import HTTPAdapter
+from requests.exceptions import InvalidSchema, RequestException
 from cryptography import x509
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+from cryptography.x509 import ocsp
+from cryptography.x509.oid import ExtendedKeyUsageOID
+
+from lemur.common.utils import (
+    check_cert_signature,
+    chunks,
+    parse_certificate,
+    parse_cert_chain,
+)
+from lemur.extensions import metrics, sentry
+
+# OCSP and CRL requests go through one pooled session so keep-alive connections to the
+# handful of responders and distribution points used by our issuers are reused across
+# checks and worker threads.
+http_session = requests.Session()
+http_session.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+http_session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+
+
+def get_ocsp_url(cert):
+    """
+    Returns the first OCSP responder URL from the certificate's Authority Information Access
+    extension, or None if it does not have one.
+
+    :param cert:
+    :return:
+    """
+    try:
+        access_descriptions = cert.extensions.get_extension_for_oid(
+            x509.OID_AUTHORITY_INFORMATION_ACCESS
+        ).value
+    except x509.ExtensionNotFound:
+        return None
+
+    for description in access_descriptions:
+        if description.access_method == x509.OID_OCSP and isinstance(
+            description.access_location, x509.UniformResourceIdentifier
+        ):
+            return description.access_location.value
+
+
+def get_issuer(cert, issuer_chain):
+    """
+    Picks the certificate that issued `cert` out of the parsed issuer chain.
+
+    :param cert:
+    :param issuer_chain: list of parsed certificates
+    :return:
+    """
+    for issuer in issuer_chain:
+        if issuer.subject == cert.issuer:
+            return issuer
+
+
+class OCSPCache(object):
+    """
+    Verified OCSP answers keyed by the issuer key hash and serial number of their CertID.
+
+    Answers are served until the `next_update` given by the responder, or for
+    ``LEMUR_OCSP_CACHE_SECONDS`` if it gave none. With ``LEMUR_OCSP_CACHE_REDIS`` enabled they
+    are kept in Redis with a matching TTL and shared by every worker, otherwise the process
+    keeps up to `max_size` of them in memory.
+    """
+
+    max_size = 50000
+
+    def __init__(self):
+        self.responses = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def redis():
+        if not current_app.config.get("LEMUR_OCSP_CACHE_REDIS", False):
+            return None
+
+        from lemur.common.redis import RedisHandler
+
+        return RedisHandler().redis()
+
+    @staticmethod
+    def key(issuer_key_hash, serial_number):
+        return "lemur.ocsp.{0}.{1}".format(issuer_key_hash.hex(), serial_number)
+
+    def get(self, issuer_key_hash, serial_number):
+        """Returns True or False for a cached good or revoked answer, None on a miss."""
+        key = self.key(issuer_key_hash, serial_number)
+        red = self.redis()
+
+        if red is not None:
+            try:
+                status = red.get(key)
+            except redis.exceptions.RedisError:
+                sentry.captureException()
+                status = None
+        else:
+            status, next_update = self.responses.get(key, (None, None))
+            if status is not None and next_update <= datetime.utcnow():
+                status = None
+
+        metrics.send(
+            "ocsp_cache", "counter", 1, metric_tags={"status": "miss" if status is None else "hit"}
+        )
+        if status is None:
+            return None
+        return status == "good"
+
+    def set(self, issuer_key_hash, serial_number, valid, next_update=None):
+        key = self.key(issuer_key_hash, serial_number)
+        status = "good" if valid else "revoked"
+
+        now = datetime.utcnow()
+        if not next_update or next_update <= now:
+            next_update = now + timedelta(
+                seconds=current_app.config.get("LEMUR_OCSP_CACHE_SECONDS", 3600)
+            )
+
+        red = self.redis()
+        if red is not None:
+            try:
+                red.set(key, status, ex=max(int((next_update - now).total_seconds()), 1))
+            except redis.exceptions.RedisError:
+                sentry.captureException()
+            return
+
+        with self.lock:
+            # oldest answers are evicted first, re-inserting moves an answer to the end
+            self.responses.pop(key, None)
+            while len(self.responses) >= self.max_size:
+                self.responses.popitem(last=False)
+            self.responses[key] = (status, next_update)
+
+
+ocsp_cache = OCSPCache()
+
+
+def check_ocsp_signature(ocsp_response, issuer):
+    """
+    Checks that the response was signed by the issuer, or by a responder certificate it
+    delegated OCSP signing to and that is included in the response.
+
+    :raise Exception: If no acceptable signer is found
+    """
+    signers = [issuer]
+    for responder in ocsp_response.certificates:
+        if responder.issuer != issuer.subject:
+            continue
+        try:
+            usages = responder.extensions.get_extension_for_class(
+                x509.ExtendedKeyUsage
+            ).value
+            check_cert_signature(responder, issuer.public_key())
+        except (x509.ExtensionNotFound, InvalidSignature, UnsupportedAlgorithm):
+            continue
+        if ExtendedKeyUsageOID.OCSP_SIGNING in usages:
+            signers.append(responder)
+
+    for signer in signers:
+        public_key = signer.public_key()
+        try:
+            if isinstance(public_key, rsa.RSAPublicKey):
+                public_key.verify(
+                    ocsp_response.signature,
+                    ocsp_response.tbs_response_bytes,
+                    padding.PKCS1v15(),
+                    ocsp_response.signature_hash_algorithm,
+                )
+            elif isinstance(public_key, ec.EllipticCurvePublicKey):
+                public_key.verify(
+                    ocsp_response.signature,
+                    ocsp_response.tbs_response_bytes,
+                    ec.ECDSA(ocsp_response.signature_hash_algorithm),
+                )
+            else:
+                continue
+            return
+        except InvalidSignature:
+            continue
 
-from lemur.utils import mktempfile
-from lemur.common.utils import parse_certificate
+    raise Exception("OCSP response signature is not valid")
 
-crl_cache = {}
 
+def check_ocsp_response(ocsp_response, cert, issuer):
+    """
+    Checks that a successful response answers for `cert` as issued by `issuer`, is current,
+    and is signed by the issuer or a responder it delegated to.
 
-def ocsp_verify(cert, cert_path, issuer_chain_path):
+    :raise Exception: If the response cannot be trusted
+    """
+    if ocsp_response.serial_number != cert.serial_number:
+        raise Exception("Did not receive a valid response")
+
+    # responders may hash the CertID with another algorithm than the one we asked with
+    expected = (
+        ocsp.OCSPRequestBuilder()
+        .add_certificate(cert, issuer, ocsp_response.hash_algorithm)
+        .build()
+    )
+    if (
+        ocsp_response.issuer_key_hash != expected.issuer_key_hash
+        or ocsp_response.issuer_name_hash != expected.issuer_name_hash
+    ):
+        raise Exception("OCSP response is for a different issuer")
+
+    now = datetime.utcnow()
+    skew = timedelta(seconds=current_app.config.get("LEMUR_OCSP_CLOCK_SKEW_SECONDS", 300))
+    if ocsp_response.this_update > now + skew:
+        raise Exception("OCSP response is not yet valid")
+    if ocsp_response.next_update and ocsp_response.next_update < now - skew:
+        raise Exception("OCSP response is stale")
+
+    check_ocsp_signature(ocsp_response, issuer)
+
+
+def ocsp_verify(cert, issuer):
     """
     Attempts to verify a certificate via OCSP. OCSP is a more modern version
     of CRL in that it will query the OCSP URI in order to determine if the
     certificate has been revoked
 
+    The request is built and the response parsed in-process, the responder is queried over
+    the shared `http_session` with a timeout of ``LEMUR_OCSP_TIMEOUT`` seconds. Signed good or
+    revoked answers are kept in `ocsp_cache` until their `next_update`.
+
     :param cert:
-    :param cert_path:
-    :param issuer_chain_path:
+    :param issuer:
     :return bool: True if certificate is valid, False otherwise
     """
-    command = ["openssl", "x509", "-noout", "-ocsp_uri", "-in", cert_path]
-    p1 = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    url, err = p1.communicate()
+    url = get_ocsp_url(cert)
 
     if not url:
         current_app.logger.debug(
@@ -39,41 +256,345 @@ def ocsp_verify(cert, cert_path, issuer_chain_path):
         )
         return None
 
-    p2 = subprocess.Popen(
-        [
-            "openssl",
-            "ocsp",
-            "-issuer",
-            issuer_chain_path,
-            "-cert",
-            cert_path,
-            "-url",
-            url.strip(),
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+    if not issuer:
+        current_app.logger.debug(
+            "No issuer available to query OCSP for certificate {}".format(
+                cert.serial_number
+            )
+        )
+        return None
+
+    ocsp_request = (
+        ocsp.OCSPRequestBuilder().add_certificate(cert, issuer, hashes.SHA1()).build()
     )
 
-    message, err = p2.communicate()
+    cached = ocsp_cache.get(ocsp_request.issuer_key_hash, cert.serial_number)
+    if cached is not None:
+        return cached
 
-    p_message = message.decode("utf-8")
+    try:
+        response = http_session.post(
+            url,
+            data=ocsp_request.public_bytes(serialization.Encoding.DER),
+            headers={"Content-Type": "application/ocsp-request"},
+            timeout=current_app.config.get("LEMUR_OCSP_TIMEOUT", 10),
+        )
+    except RequestException:
+        raise Exception("Unable to reach OCSP responder: {0}".format(url))
 
-    if "error" in p_message or "Error" in p_message:
-        raise Exception("Got error when parsing OCSP url")
+    if response.status_code != 200:
+        raise Exception("Got error when querying OCSP url: {0}".format(url))
+
+    try:
+        ocsp_response = ocsp.load_der_ocsp_response(response.content)
+    except ValueError:
+        raise Exception("Did not receive a valid response")
+
+    if ocsp_response.response_status != ocsp.OCSPResponseStatus.SUCCESSFUL:
+        raise Exception(
+            "Got error when querying OCSP url: {0}".format(
+                ocsp_response.response_status.name
+            )
+        )
 
-    elif "revoked" in p_message:
+    check_ocsp_response(ocsp_response, cert, issuer)
+
+    if ocsp_response.certificate_status == ocsp.OCSPCertStatus.REVOKED:
         current_app.logger.debug(
             "OCSP reports certificate revoked: {}".format(cert.serial_number)
         )
-        return False
+        valid = False
+
+    elif ocsp_response.certificate_status == ocsp.OCSPCertStatus.GOOD:
+        valid = True
 
-    elif "good" not in p_message:
+    else:
         raise Exception("Did not receive a valid response")
 
-    return True
+    ocsp_cache.set(
+        ocsp_request.issuer_key_hash,
+        cert.serial_number,
+        valid,
+        ocsp_response.next_update,
+    )
+    return valid
 
 
-def crl_verify(cert, cert_path):
+class CRLStore(object):
+    """
+    Revoked serials of every CRL we have downloaded, indexed by serial number.
+
+    A CRL is downloaded and parsed once per update: it is served from the index until its
+    `next_update` (or ``LEMUR_CRL_REFRESH_SECONDS`` if it has none) passes, then revalidated
+    with ``If-None-Match``/``If-Modified-Since``. With ``LEMUR_CRL_CACHE_REDIS`` enabled the
+    index is kept in Redis hashes shared by every worker and surviving restarts, otherwise in
+    the memory of the process.
+    """
+
+    # stored CRLs are dropped if nobody has refreshed them for this long
+    retention = timedelta(days=7)
+    write_batch_size = 10000
+    # returned by `lookup` when Redis does not hold the index
+    missing = object()
+
+    def __init__(self):
+        # guards the dicts below only, it is never held across a download
+        self.lock = threading.Lock()
+        self.url_locks = {}
+        self.crls = {}
+
+    def url_lock(self, url):
+        """
+        Returns the lock serializing refreshes of the CRL at `url`, so a slow distribution
+        point never holds up lookups in the CRLs of others.
+        """
+        with self.lock:
+            return self.url_locks.setdefault(url, threading.Lock())
+
+    def put(self, url, crl):
+        with self.lock:
+            self.crls[url] = crl
+
+    @staticmethod
+    def redis():
+        if not current_app.config.get("LEMUR_CRL_CACHE_REDIS", False):
+            return None
+
+        from lemur.common.redis import RedisHandler
+
+        return RedisHandler().redis()
+
+    @staticmethod
+    def keys(url):
+        digest = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return "lemur.crl.{0}.meta".format(digest), "lemur.crl.{0}.revoked".format(digest)
+
+    @staticmethod
+    def is_fresh(crl):
+        return crl is not None and crl["next_update"] > datetime.utcnow()
+
+    def get_revocation_reason(self, url, serial_number):
+        """
+        Returns the revocation reason of `serial_number` on the CRL at `url`, or None if it is
+        not listed. Entries without a reason code are reported as `unspecified`.
+
+        :raise InvalidSchema: If the URL scheme is not supported
+        """
+        red = self.redis()
+        crl = self.get(url, red)
+
+        if crl["revoked"] is None:
+            reason = self.lookup(red, url, crl, serial_number)
+            if reason is not self.missing:
+                return reason
+
+            # the index is gone from Redis, an unlisted serial would read as not revoked
+            metrics.send("crl_refresh", "counter", 1, metric_tags={"status": "missing"})
+            with self.url_lock(url):
+                crl = self.refresh(url, None, red)
+                self.put(url, crl)
+
+        return crl["revoked"].get(serial_number)
+
+    def lookup(self, red, url, crl, serial_number):
+        """
+        Returns the revocation reason of `serial_number` from the index stored in Redis, or
+        `missing` if the index is not there. Only a CRL stored with its entry count is trusted,
+        a meta hash without one was not written by `save`.
+        """
+        if crl.get("count") is None:
+            return self.missing
+        if not crl["count"]:
+            return None
+
+        revoked_key = self.keys(url)[1]
+        try:
+            pipe = red.pipeline()
+            pipe.hget(revoked_key, str(serial_number))
+            pipe.exists(revoked_key)
+            reason, exists = pipe.execute()
+        except redis.exceptions.RedisError:
+            sentry.captureException()
+            raise Exception("Unable to retrieve CRL: {0}".format(url))
+
+        return reason if exists else self.missing
+
+    def get(self, url, red=None):
+        crl = self.crls.get(url)
+        if self.is_fresh(crl):
+            return crl
+
+        with self.url_lock(url):
+            # another thread may have refreshed it while we waited
+            crl = self.crls.get(url)
+            if self.is_fresh(crl):
+                return crl
+
+            if red is not None:
+                stored = self.load(red, url)
+                if self.is_fresh(stored):
+                    self.put(url, stored)
+                    return stored
+                crl = crl or stored
+
+            crl = self.refresh(url, crl, red)
+            self.put(url, crl)
+            return crl
+
+    def refresh(self, url, crl, red=None):
+        current_app.logger.debug("Retrieving CRL: {}".format(url))
+
+        headers = {}
+        if crl and crl["etag"]:
+            headers["If-None-Match"] = crl["etag"]
+        if crl and crl["last_modified"]:
+            headers["If-Modified-Since"] = crl["last_modified"]
+
+        refresh_at = datetime.utcnow() + timedelta(
+            seconds=current_app.config.get("LEMUR_CRL_REFRESH_SECONDS", 3600)
+        )
+
+        try:
+            response = http_session.get(
+                url, headers=headers, timeout=current_app.config.get("LEMUR_CRL_TIMEOUT", 60)
+            )
+        except InvalidSchema:
+            raise
+        except RequestException:
+            response = None
+
+        if response is None or response.status_code not in (200, 304):
+            if crl is None:
+                raise Exception("Unable to retrieve CRL: {0}".format(url))
+
+            # keep answering from the copy we have rather than retrying for every certificate
+            current_app.logger.warning("Unable to refresh CRL {0}, serving stale copy".format(url))
+            metrics.send("crl_refresh", "counter", 1, metric_tags={"status": "failed"})
+            return dict(crl, next_update=refresh_at)
+
+        if response.status_code == 304 and crl is not None:
+            metrics.send("crl_refresh", "counter", 1, metric_tags={"status": "not_modified"})
+            crl = dict(crl, next_update=refresh_at)
+            if red is None or self.touch(red, url, crl):
+                return crl
+
+            # neither Redis nor this process holds the index any more
+            return self.refresh(url, None, red)
+
+        parsed = x509.load_der_x509_crl(response.content, backend=default_backend())
+
+        revoked = {}
+        for r in parsed:
+            try:
+                reason = r.extensions.get_extension_for_class(x509.CRLReason).value.reason
+            except x509.ExtensionNotFound:
+                reason = x509.ReasonFlags.unspecified
+            revoked[r.serial_number] = reason.value
+
+        next_update = parsed.next_update
+        if not next_update or next_update <= datetime.utcnow():
+            next_update = refresh_at
+
+        crl = dict(
+            revoked=revoked,
+            count=len(revoked),
+            next_update=next_update,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+        metrics.send("crl_refresh", "counter", 1, metric_tags={"status": "modified"})
+
+        if red is not None:
+            self.save(red, url, crl)
+        return crl
+
+    def load(self, red, url):
+        meta_key, _ = self.keys(url)
+        try:
+            meta = red.hgetall(meta_key)
+        except redis.exceptions.RedisError:
+            sentry.captureException()
+            return None
+
+        if not meta:
+            return None
+
+        return dict(
+            revoked=None,
+            count=int(meta["count"]) if meta.get("count") else None,
+            next_update=arrow.get(meta["next_update"]).naive,
+            etag=meta.get("etag") or None,
+            last_modified=meta.get("last_modified") or None,
+        )
+
+    def touch(self, red, url, crl):
+        """
+        Extends the stored CRL if its index is intact, or stores it again from the copy in memory.
+        Returns False if neither Redis nor this process holds the index.
+        """
+        meta_key, revoked_key = self.keys(url)
+        try:
+            pipe = red.pipeline()
+            pipe.hget(meta_key, "count")
+            pipe.exists(revoked_key)
+            count, exists = pipe.execute()
+
+            if count and (exists or int(count) == 0):
+                pipe = red.pipeline()
+                pipe.hset(meta_key, "next_update", crl["next_update"].isoformat())
+                pipe.expire(meta_key, self.retention)
+                pipe.expire(revoked_key, self.retention)
+                pipe.execute()
+                return True
+        except redis.exceptions.RedisError:
+            sentry.captureException()
+            return crl["revoked"] is not None
+
+        if crl["revoked"] is None:
+            return False
+
+        self.save(red, url, crl)
+        return True
+
+    def save(self, red, url, crl):
+        """
+        Writes the index to a staging hash and swaps it in, so readers in other workers never
+        see a partially written CRL.
+        """
+        meta_key, revoked_key = self.keys(url)
+        staging_key = revoked_key + ".staging"
+        try:
+            red.delete(staging_key)
+            for chunk in chunks(crl["revoked"].items(), self.write_batch_size):
+                red.hmset(staging_key, {str(serial): reason for serial, reason in chunk})
+
+            pipe = red.pipeline()
+            if crl["revoked"]:
+                pipe.rename(staging_key, revoked_key)
+                pipe.expire(revoked_key, self.retention)
+            else:
+                pipe.delete(revoked_key)
+            pipe.delete(meta_key)
+            pipe.hmset(
+                meta_key,
+                dict(
+                    url=url,
+                    count=len(crl["revoked"]),
+                    next_update=crl["next_update"].isoformat(),
+                    etag=crl["etag"] or "",
+                    last_modified=crl["last_modified"] or "",
+                ),
+            )
+            pipe.expire(meta_key, self.retention)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            sentry.captureException()
+
+
+crl_store = CRLStore()
+
+
+def crl_verify(cert, cert_path=None):
     """
     Attempts to verify a certificate using CRL.
 
@@ -95,67 +616,41 @@ def crl_verify(cert, cert_path):
     for p in distribution_points:
         point = p.full_name[0].value
 
-        if point not in crl_cache:
-            current_app.logger.debug("Retrieving CRL: {}".format(point))
-            try:
-                response = requests.get(point)
-
-                if response.status_code != 200:
-                    raise Exception("Unable to retrieve CRL: {0}".format(point))
-            except InvalidSchema:
-                # Unhandled URI scheme (like ldap://); skip this distribution point.
-                continue
-            except ConnectionError:
-                raise Exception("Unable to retrieve CRL: {0}".format(point))
+        try:
+            reason = crl_store.get_revocation_reason(point, cert.serial_number)
+        except InvalidSchema:
+            # Unhandled URI scheme (like ldap://); skip this distribution point.
+            continue
+
+        # Handle "removeFromCRL" revoke reason as unrevoked;
+        # continue with the next distribution point.
+        # Per RFC 5280 section 6.3.3 (k):
+        #  https://tools.ietf.org/html/rfc5280#section-6.3.3
+        if reason is None or reason == x509.ReasonFlags.remove_from_crl.value:
+            continue
 
-            crl_cache[point] = x509.load_der_x509_crl(
-                response.content, backend=default_backend()
-            )
-        else:
-            current_app.logger.debug("CRL point is cached {}".format(point))
-
-        for r in crl_cache[point]:
-            if cert.serial_number == r.serial_number:
-                try:
-                    reason = r.extensions.get_extension_for_class(x509.CRLReason).value
-                    # Handle "removeFromCRL" revoke reason as unrevoked;
-                    # continue with the next distribution point.
-                    # Per RFC 5280 section 6.3.3 (k):
-                    #  https://tools.ietf.org/html/rfc5280#section-6.3.3
-                    if reason == x509.ReasonFlags.remove_from_crl:
-                        break
-                except x509.ExtensionNotFound:
-                    pass
-
-                current_app.logger.debug(
-                    "CRL reports certificate " "revoked: {}".format(cert.serial_number)
-                )
-                return False
+        current_app.logger.debug(
+            "CRL reports certificate " "revoked: {}".format(cert.serial_number)
+        )
+        return False
 
     return True
 
 
-def verify(cert_path, issuer_chain_path):
+def verify_certificate(cert, issuer_chain):
     """
-    Verify a certificate using OCSP and CRL
+    Verify a parsed certificate using OCSP and CRL
 
-    :param cert_path:
-    :param issuer_chain_path:
+    :param cert:
+    :param issuer_chain: list of parsed certificates
     :return: True if valid, False otherwise
     """
-    with open(cert_path, "rt") as c:
-        try:
-            cert = parse_certificate(c.read())
-        except ValueError as e:
-            current_app.logger.error(e)
-            return None
-
     # OCSP is our main source of truth, in a lot of cases CRLs
     # have been deprecated and are no longer updated
-    verify_result = ocsp_verify(cert, cert_path, issuer_chain_path)
+    verify_result = ocsp_verify(cert, get_issuer(cert, issuer_chain))
 
     if verify_result is None:
-        verify_result = crl_verify(cert, cert_path)
+        verify_result = crl_verify(cert)
 
     if verify_result is None:
         current_app.logger.debug("Failed to verify {}".format(cert.serial_number))
@@ -163,6 +658,23 @@ def verify(cert_path, issuer_chain_path):
     return verify_result
 
 
+def verify(cert_path, issuer_chain_path):
+    """
+    Verify a certificate using OCSP and CRL
+
+    :param cert_path:
+    :param issuer_chain_path:
+    :return: True if valid, False otherwise
+    """
+    with open(cert_path, "rt") as c:
+        cert_string = c.read()
+
+    with open(issuer_chain_path, "rt") as c:
+        issuer_string = c.read()
+
+    return verify_string(cert_string, issuer_string)
+
+
 def verify_string(cert_string, issuer_string):
     """
     Verify a certificate given only it's string value
@@ -171,11 +683,10 @@ def verify_string(cert_string, issuer_string):
     :param issuer_string:
     :return: True if valid, False otherwise
     """
-    with mktempfile() as cert_tmp:
-        with open(cert_tmp, "w") as f:
-            f.write(cert_string)
-        with mktempfile() as issuer_tmp:
-            with open(issuer_tmp, "w") as f:
-                f.write(issuer_string)
-            status = verify(cert_tmp, issuer_tmp)
-    return status
+    try:
+        cert = parse_certificate(cert_string)
+    except ValueError as e:
+        current_app.logger.error(e)
+        return None
+
+    return verify_certificate(cert, parse_cert_chain(issuer_string))
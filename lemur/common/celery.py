@@ -10,14 +10,16 @@ command: celery -A lemur.common.celery worker --loglevel=info -l DEBUG -B
 import copy
 import sys
 import time
+import uuid
 from datetime import datetime, timezone, timedelta
 
 from celery import Celery
 from celery.exceptions import SoftTimeLimitExceeded
+from celery.signals import task_postrun
 from flask import current_app
 
 from lemur.authorities.service import get as get_authority
-from lemur.common.redis import RedisHandler
+from lemur.common.redis import LeaseLock, LeaseSemaphore, ProcessRedis
 from lemur.destinations import service as destinations_service
 from lemur.extensions import metrics, sentry
 from lemur.factory import create_app
@@ -37,7 +39,7 @@ if current_app:
 else:
     flask_app = create_app()
 
-red = RedisHandler().redis()
+red = ProcessRedis()
 
 
 def make_celery(app):
@@ -63,21 +65,49 @@ def make_celery(app):
 celery = make_celery(flask_app)
 
 
-def is_task_active(fun, task_id, args):
-    from celery.task.control import inspect
+# locks held by the tasks running in this worker process, by task id
+task_locks = {}
 
+
+def acquire_task_lock(fun, task_id, args):
+    """
+    Takes the Redis lease lock for this task name and arguments, it is released when the
+    task finishes. The lease lasts for the task's soft time limit and is renewed while held.
+
+    Returns False when the same task with the same arguments is already running elsewhere.
+    """
     if not args:
         args = '()'  # empty args
 
-    i = inspect()
-    active_tasks = i.active()
-    for _, tasks in active_tasks.items():
-        for task in tasks:
-            if task.get("id") == task_id:
-                continue
-            if task.get("name") == fun and task.get("args") == str(args):
-                return True
-    return False
+    task = celery.tasks.get(fun)
+    ttl = getattr(task, "soft_time_limit", None) or current_app.config.get(
+        "CELERY_TASK_LOCK_TTL", 3600
+    )
+
+    start = time.time()
+    lock = LeaseLock(red, f"{fun}{args}.lock", task_id, ttl)
+    acquired = lock.acquire()
+    metrics.send("celery.task_lock.wait", "timer", (time.time() - start) * 1000, metric_tags={"function": fun})
+
+    if not acquired:
+        metrics.send("celery.task_lock.contention", "counter", 1, metric_tags={"function": fun})
+        return False
+
+    task_locks[task_id] = lock
+    return True
+
+
+@task_postrun.connect
+def release_task_lock(task_id=None, **kwargs):
+    lock = task_locks.pop(task_id, None)
+    if lock:
+        lock.release()
+
+
+@task_postrun.connect
+def flush_metrics(**kwargs):
+    # handed to the flusher thread, the worker does not wait on the providers
+    metrics.request_flush()
 
 
 @celery.task()
@@ -102,7 +132,7 @@ def report_celery_last_success_metrics():
         "task_id": task_id,
     }
 
-    if task_id and is_task_active(function, task_id, None):
+    if task_id and not acquire_task_lock(function, task_id, None):
         log_data["message"] = "Skipping task: Task is already active"
         current_app.logger.debug(log_data)
         return
@@ -141,7 +171,7 @@ def fetch_acme_cert(id):
 
     current_app.logger.debug(log_data)
 
-    if task_id and is_task_active(log_data["function"], task_id, (id,)):
+    if task_id and not acquire_task_lock(log_data["function"], task_id, (id,)):
         log_data["message"] = "Skipping task: Task is already active"
         current_app.logger.debug(log_data)
         return
@@ -243,7 +273,7 @@ def fetch_all_pending_acme_certs():
         "task_id": task_id,
     }
 
-    if task_id and is_task_active(function, task_id, None):
+    if task_id and not acquire_task_lock(function, task_id, None):
         log_data["message"] = "Skipping task: Task is already active"
         current_app.logger.debug(log_data)
         return
@@ -280,7 +310,7 @@ def remove_old_acme_certs():
         "task_id": task_id,
     }
 
-    if task_id and is_task_active(function, task_id, None):
+    if task_id and not acquire_task_lock(function, task_id, None):
         log_data["message"] = "Skipping task: Task is already active"
         current_app.logger.debug(log_data)
         return
@@ -317,7 +347,7 @@ def clean_all_sources():
         "task_id": task_id,
     }
 
-    if task_id and is_task_active(function, task_id, None):
+    if task_id and not acquire_task_lock(function, task_id, None):
         log_data["message"] = "Skipping task: Task is already active"
         current_app.logger.debug(log_data)
         return
@@ -353,7 +383,7 @@ def clean_source(source):
         "task_id": task_id,
     }
 
-    if task_id and is_task_active(function, task_id, (source,)):
+    if task_id and not acquire_task_lock(function, task_id, (source,)):
         log_data["message"] = "Skipping task: Task is already active"
         current_app.logger.debug(log_data)
         return
@@ -384,7 +414,7 @@ def sync_all_sources():
         "task_id": task_id,
     }
 
-    if task_id and is_task_active(function, task_id, None):
+    if task_id and not acquire_task_lock(function, task_id, None):
         log_data["message"] = "Skipping task: Task is already active"
         current_app.logger.debug(log_data)
         return
@@ -420,7 +450,7 @@ def sync_source(source):
         "task_id": task_id,
     }
 
-    if task_id and is_task_active(function, task_id, (source,)):
+    if task_id and not acquire_task_lock(function, task_id, (source,)):
         log_data["message"] = "Skipping task: Task is already active"
         current_app.logger.debug(log_data)
         return
@@ -463,7 +493,7 @@ def sync_source_destination():
         "task_id": task_id,
     }
 
-    if task_id and is_task_active(function, task_id, None):
+    if task_id and not acquire_task_lock(function, task_id, None):
         log_data["message"] = "Skipping task: Task is already active"
         current_app.logger.debug(log_data)
         return
@@ -498,7 +528,7 @@ def certificate_reissue():
         "task_id": task_id,
     }
 
-    if task_id and is_task_active(function, task_id, None):
+    if task_id and not acquire_task_lock(function, task_id, None):
         log_data["message"] = "Skipping task: Task is already active"
         current_app.logger.debug(log_data)
         return
@@ -537,7 +567,7 @@ def certificate_rotate():
 
     }
 
-    if task_id and is_task_active(function, task_id, None):
+    if task_id and not acquire_task_lock(function, task_id, None):
         log_data["message"] = "Skipping task: Task is already active"
         current_app.logger.debug(log_data)
         return
@@ -575,7 +605,7 @@ def endpoints_expire():
         "task_id": task_id,
     }
 
-    if task_id and is_task_active(function, task_id, None):
+    if task_id and not acquire_task_lock(function, task_id, None):
         log_data["message"] = "Skipping task: Task is already active"
         current_app.logger.debug(log_data)
         return
@@ -611,7 +641,7 @@ def get_all_zones():
         "task_id": task_id,
     }
 
-    if task_id and is_task_active(function, task_id, None):
+    if task_id and not acquire_task_lock(function, task_id, None):
         log_data["message"] = "Skipping task: Task is already active"
         current_app.logger.debug(log_data)
         return
@@ -630,10 +660,130 @@ def get_all_zones():
     metrics.send(f"{function}.success", 'counter', 1)
 
 
+@celery.task(bind=True, soft_time_limit=600)
+def check_revoked_chunk(self, certificate_ids, run=None, deadline=None):
+    """
+    This celery task checks the revocation status of a chunk of certificates. At most
+    `LEMUR_REVOCATION_CONCURRENCY` chunks run at once across all workers, a chunk that finds no
+    free slot is retried later instead of holding on to its worker. Nothing is checked once the
+    `deadline` of its `check_revoked` run has passed.
+    :return: number of certificates per resulting status
+    """
+    function = f"{__name__}.{sys._getframe().f_code.co_name}"
+    if deadline and time.time() >= deadline:
+        metrics.send(f"{function}.expired", "counter", 1)
+        record_check_revoked_chunk(run, {})
+        return {}
+
+    slots = LeaseSemaphore(
+        red,
+        f"{function}.slots",
+        current_app.config.get("LEMUR_REVOCATION_CONCURRENCY", 10),
+        self.soft_time_limit,
+    )
+    if not slots.acquire(self.request.id):
+        metrics.send(f"{function}.throttled", "counter", 1)
+        raise self.retry(countdown=10, max_retries=None)
+
+    statuses = {}
+    try:
+        statuses = cli_certificate.check_revoked_chunk(certificate_ids, deadline)
+    except SoftTimeLimitExceeded:
+        current_app.logger.error({
+            "function": function,
+            "message": "Checking revoked chunk: Time limit exceeded.",
+            "certificates": len(certificate_ids),
+        })
+        sentry.captureException()
+        metrics.send("celery.timeout", "counter", 1, metric_tags={"function": function})
+    finally:
+        slots.release(self.request.id)
+        record_check_revoked_chunk(run, statuses)
+
+    metrics.send(f"{__name__}.check_revoked.checked", "counter", sum(statuses.values()))
+    return statuses
+
+
+def record_check_revoked_chunk(run, statuses):
+    """
+    Adds the statuses of a finished chunk to the Redis hash of its `check_revoked` run, and
+    reports the run if this was its last chunk.
+    """
+    if not run:
+        return
+
+    pipe = red.pipeline()
+    for status, count in statuses.items():
+        pipe.hincrby(run, f"status.{status}", count)
+    pipe.hincrby(run, "done", 1)
+    pipe.hget(run, "chunks")
+    done, chunks = pipe.execute()[-2:]
+    if chunks is not None and done >= int(chunks):
+        report_check_revoked(run)
+
+
+def report_check_revoked(run):
+    """
+    Reports the statuses, throughput and unchecked certificates of a `check_revoked` run from
+    its Redis hash and records the run's success. Only the first call for a run reports, be it
+    from its last chunk or from `check_revoked_done`.
+    """
+    if not red.hsetnx(run, "reported", 1):
+        return
+
+    function = f"{__name__}.check_revoked"
+    fields = red.hgetall(run)
+    start = float(fields["start"])
+    statuses = {
+        k[len("status."):]: int(v) for k, v in fields.items() if k.startswith("status.")
+    }
+    checked = sum(statuses.values())
+    chunks, done = int(fields.get("chunks", 0)), int(fields.get("done", 0))
+
+    for status, count in statuses.items():
+        metrics.send(f"{function}.status", "gauge", count, metric_tags={"status": status})
+    metrics.send(f"{function}.throughput", "gauge", checked / max(time.time() - start, 1))
+    metrics.send(f"{function}.unchecked", "gauge", int(fields.get("certificates", 0)) - checked)
+    metrics.send(f"{function}.unfinished_chunks", "gauge", chunks - done)
+
+    current_app.logger.debug({
+        "function": function,
+        "message": "Done checking revoked",
+        "statuses": statuses,
+        "unfinished_chunks": chunks - done,
+        "duration": time.time() - start,
+    })
+    red.set(f'{function}.last_success', int(time.time()))
+    metrics.send(f"{function}.success", 'counter', 1)
+
+
+@celery.task()
+def check_revoked_done(run):
+    """
+    This celery task reports a `check_revoked` run once none of its chunks can still be running,
+    in case chunks expired or failed before the last of them could report it
+    :return:
+    """
+    report_check_revoked(run)
+
+
 @celery.task(soft_time_limit=3600)
 def check_revoked():
     """
     This celery task attempts to check if any certs are expired
+
+    Ids of certificates due a check are streamed in chunks of `LEMUR_REVOCATION_CHUNK_SIZE` and
+    handed to `check_revoked_chunk` tasks as they are read, nothing waits on them here. Every
+    chunk adds its statuses to a Redis hash for the run, the last one to finish reports the
+    totals and records the run's success. `check_revoked_done` is scheduled for when no chunk
+    can still be running and reports the run if expired or failed chunks left it unreported.
+    With `LEMUR_REVOCATION_INCREMENTAL` only certificates due a check are picked.
+
+    The run ends after `LEMUR_REVOCATION_TIME_BUDGET_SECONDS` in incremental mode and the task's
+    time limit otherwise. Chunks no worker has picked up by then expire, and chunks still
+    running stop checking. In incremental mode their certificates are also leased until any
+    chunk still running must have finished, so the next run does not hand them out again, see
+    `claim_revocation_check`.
     :return:
     """
     function = f"{__name__}.{sys._getframe().f_code.co_name}"
@@ -647,23 +797,58 @@ def check_revoked():
         "task_id": task_id,
     }
 
-    if task_id and is_task_active(function, task_id, None):
+    if task_id and not acquire_task_lock(function, task_id, None):
         log_data["message"] = "Skipping task: Task is already active"
         current_app.logger.debug(log_data)
         return
 
     current_app.logger.debug(log_data)
+
+    chunk_size = current_app.config.get("LEMUR_REVOCATION_CHUNK_SIZE", 100)
+    incremental = current_app.config.get("LEMUR_REVOCATION_INCREMENTAL", False)
+    time_budget = current_app.config.get("LEMUR_REVOCATION_TIME_BUDGET_SECONDS", 3000)
+    start = time.time()
+    deadline = start + (time_budget if incremental else check_revoked.soft_time_limit)
+    expires = datetime.fromtimestamp(deadline, timezone.utc)
+    # every chunk has finished or stopped by then
+    report_at = expires + timedelta(seconds=check_revoked_chunk.soft_time_limit)
+
+    run = f"{function}.run.{uuid.uuid4().hex}"
+    red.hset(run, "start", start)
+    red.expireat(run, report_at + timedelta(days=1))
+    check_revoked_done.apply_async((run,), eta=report_at)
+
+    chunks, certificates = 0, 0
     try:
-        cli_certificate.check_revoked()
+        for ids in cli_certificate.iter_revocation_check_ids(chunk_size, incremental):
+            if incremental and time.time() > deadline:
+                metrics.send(f"{function}.budget_exhausted", "counter", 1)
+                break
+            if incremental:
+                # a chunk left running past this run must not be handed out again by the next
+                cli_certificate.claim_revocation_check(ids, report_at)
+            check_revoked_chunk.apply_async((ids, run, deadline), expires=expires)
+            chunks += 1
+            certificates += len(ids)
     except SoftTimeLimitExceeded:
         log_data["message"] = "Checking revoked: Time limit exceeded."
         current_app.logger.error(log_data)
         sentry.captureException()
         metrics.send("celery.timeout", "counter", 1, metric_tags={"function": function})
-        return
-
-    red.set(f'{function}.last_success', int(time.time()))
-    metrics.send(f"{function}.success", 'counter', 1)
+    finally:
+        # chunks that finished before the total was known left reporting to this
+        pipe = red.pipeline()
+        pipe.hset(run, "chunks", chunks)
+        pipe.hset(run, "certificates", certificates)
+        pipe.hget(run, "done")
+        done = int(pipe.execute()[-1] or 0)
+        if done >= chunks:
+            report_check_revoked(run)
+
+    metrics.send(f"{function}.chunks", "gauge", chunks)
+    log_data["message"] = "Dispatched revocation checks"
+    log_data["chunks"] = chunks
+    current_app.logger.debug(log_data)
 
 
 @celery.task(soft_time_limit=3600)
@@ -683,7 +868,7 @@ def notify_expirations():
         "task_id": task_id,
     }
 
-    if task_id and is_task_active(function, task_id, None):
+    if task_id and not acquire_task_lock(function, task_id, None):
         log_data["message"] = "Skipping task: Task is already active"
         current_app.logger.debug(log_data)
         return
@@ -700,3 +885,39 @@ def notify_expirations():
 
     red.set(f'{function}.last_success', int(time.time()))
     metrics.send(f"{function}.success", 'counter', 1)
+
+
+@celery.task(soft_time_limit=600)
+def dispatch_notifications():
+    """
+    This celery task delivers the notifications waiting in the outbox
+    :return:
+    """
+    function = f"{__name__}.{sys._getframe().f_code.co_name}"
+    task_id = None
+    if celery.current_task:
+        task_id = celery.current_task.request.id
+
+    log_data = {
+        "function": function,
+        "message": "deliver queued notifications",
+        "task_id": task_id,
+    }
+
+    if task_id and not acquire_task_lock(function, task_id, None):
+        log_data["message"] = "Skipping task: Task is already active"
+        current_app.logger.debug(log_data)
+        return
+
+    current_app.logger.debug(log_data)
+    try:
+        cli_notification.dispatch()
+    except SoftTimeLimitExceeded:
+        log_data["message"] = "Dispatching notifications: Time limit exceeded."
+        current_app.logger.error(log_data)
+        sentry.captureException()
+        metrics.send("celery.timeout", "counter", 1, metric_tags={"function": function})
+        return
+
+    red.set(f'{function}.last_success', int(time.time()))
+    metrics.send(f"{function}.success", 'counter', 1)
@@ -2,6 +2,7 @@ import re
 import unicodedata
 
 from cryptography import x509
+from cryptography.hazmat.primitives import hashes
 from flask import current_app
 
 from lemur.common.utils import is_selfsigned
@@ -188,6 +189,16 @@ def serial(cert):
     return cert.serial_number
 
 
+def fingerprint(cert):
+    """
+    Fetch the hex encoded SHA-256 fingerprint of the certificate's DER encoding.
+
+    :param cert:
+    :return: fingerprint
+    """
+    return cert.fingerprint(hashes.SHA256()).hex()
+
+
 def san(cert):
     """
     Determines if a given certificate is a SAN certificate.
@@ -2,8 +2,10 @@
 Helper Class for Redis
 
 """
+import os
 import redis
-import sys
+import threading
+import time
 from flask import current_app
 from lemur.extensions import sentry
 from lemur.factory import create_app
@@ -15,30 +17,62 @@ else:
 
 
 class RedisHandler:
+    """
+    Hands out clients backed by a connection pool shared by the whole process.
+
+    Pools are kept per connection parameters and rebuilt in a forked child (e.g. a Celery
+    prefork worker) so sockets are never shared across processes. Connections are opened on
+    first use and checked with a PING once idle for `health_check_interval` seconds.
+    """
+
+    pools = {}
+    pools_lock = threading.Lock()
+    health_check_interval = 30
+
     def __init__(self, host=flask_app.config.get('REDIS_HOST', 'localhost'),
                  port=flask_app.config.get('REDIS_PORT', 6379),
-                 db=flask_app.config.get('REDIS_DB', 0)):
+                 db=flask_app.config.get('REDIS_DB', 0),
+                 socket_timeout=None):
         self.host = host
         self.port = port
         self.db = db
+        self.socket_timeout = socket_timeout
+
+    def pool(self):
+        key = (self.host, self.port, self.db, self.socket_timeout)
+        with self.pools_lock:
+            pid, pool = self.pools.get(key, (None, None))
+            if pid != os.getpid():
+                # The decode_responses flag here directs the client to convert the responses from Redis into Python
+                # strings using the default encoding utf-8.  This is client specific.
+                pool = redis.ConnectionPool(
+                    host=self.host,
+                    port=self.port,
+                    db=self.db,
+                    socket_timeout=self.socket_timeout,
+                    encoding="utf-8",
+                    decode_responses=True,
+                    health_check_interval=self.health_check_interval,
+                )
+                self.pools[key] = (os.getpid(), pool)
+            return pool
 
     def redis(self, db=0):
-        # The decode_responses flag here directs the client to convert the responses from Redis into Python strings
-        # using the default encoding utf-8.  This is client specific.
-        function = f"{__name__}.{sys._getframe().f_code.co_name}"
-        try:
-            red = redis.StrictRedis(host=self.host, port=self.port, db=self.db, encoding="utf-8", decode_responses=True)
-            red.set("test", 0)
-        except redis.ConnectionError:
-            log_data = {
-                "function": function,
-                "message": "Redis Connection error",
-                "host": self.host,
-                "port": self.port
-            }
-            current_app.logger.error(log_data)
-            sentry.captureException()
-        return red
+        return redis.StrictRedis(connection_pool=self.pool())
+
+
+class ProcessRedis:
+    """
+    Client for module level use. Every attribute is looked up on `RedisHandler().redis()` in
+    the calling process, so a module imported before a fork (e.g. by the Celery prefork
+    parent) still talks to Redis over a pool owned by the current process.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.handler = RedisHandler(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.handler.redis(), name)
 
 
 def redis_get(key, default=None):
@@ -50,3 +84,94 @@ def redis_get(key, default=None):
     if not v:
         return default
     return v
+
+
+class LeaseLock:
+    """
+    Mutex held in Redis for at most `ttl` seconds at a time.
+
+    The key holds the owner's token, so only the owner can renew or release it. While held, a
+    daemon thread renews the lease every third of its ttl, if the owner dies the lease lapses
+    and another worker can take the lock.
+    """
+
+    # only touch the key while it still holds our token
+    renew_script = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    release_script = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, red, key, token, ttl):
+        self.red = red
+        self.key = key
+        self.token = token
+        self.ttl = ttl
+        self.released = threading.Event()
+
+    def acquire(self):
+        if not self.red.set(self.key, self.token, nx=True, px=int(self.ttl * 1000)):
+            return False
+
+        renewer = threading.Thread(target=self.keep_alive, daemon=True)
+        renewer.start()
+        return True
+
+    def keep_alive(self):
+        while not self.released.wait(self.ttl / 3):
+            try:
+                if not self.renew():
+                    return
+            except redis.exceptions.RedisError:
+                sentry.captureException()
+
+    def renew(self):
+        return self.red.register_script(self.renew_script)(
+            keys=[self.key], args=[self.token, int(self.ttl * 1000)]
+        )
+
+    def release(self):
+        self.released.set()
+        return self.red.register_script(self.release_script)(
+            keys=[self.key], args=[self.token]
+        )
+
+
+class LeaseSemaphore:
+    """
+    Counting semaphore held in Redis, at most `limit` holders at a time.
+
+    Holders are kept in a sorted set scored by the end of their lease, so the slot of a holder
+    that died without releasing it lapses after `ttl` seconds.
+    """
+
+    def __init__(self, red, key, limit, ttl):
+        self.red = red
+        self.key = key
+        self.limit = limit
+        self.ttl = ttl
+
+    def acquire(self, token):
+        now = time.time()
+        pipe = self.red.pipeline()
+        pipe.zremrangebyscore(self.key, "-inf", now)
+        pipe.zadd(self.key, {token: now + self.ttl})
+        pipe.zrank(self.key, token)
+        pipe.expire(self.key, int(self.ttl))
+        rank = pipe.execute()[2]
+        if rank < self.limit:
+            return True
+
+        # later leases rank last, so only the newcomer gives its slot back
+        self.red.zrem(self.key, token)
+        return False
+
+    def release(self, token):
+        return self.red.zrem(self.key, token)
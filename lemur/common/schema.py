@@ -122,6 +122,11 @@ def unwrap_pagination(data, output_schema):
         return data
 
     if isinstance(data, dict):
+        if "next_cursor" in data.keys():
+            marshaled_data = {"nextCursor": data["next_cursor"]}
+            marshaled_data["items"] = output_schema.dump(data["items"], many=True).data
+            return marshaled_data
+
         if "total" in data.keys():
             if data.get("total") == 0:
                 return data
@@ -6,22 +6,26 @@
 
 .. moduleauthor:: Kevin Glisson <kglisson@netflix.com>
 """
+import hashlib
 import random
 import re
 import string
+import threading
+from collections import OrderedDict
 
 import sqlalchemy
 from cryptography import x509
 from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import rsa, ec, padding
 from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from flask import current_app, has_app_context
 from flask_restful.reqparse import RequestParser
 from sqlalchemy import and_, func
 
 from lemur.constants import CERTIFICATE_KEY_TYPES
 from lemur.exceptions import InvalidConfiguration
+from lemur.extensions import metrics
 
 paginated_parser = RequestParser()
 
@@ -31,6 +35,7 @@ paginated_parser.add_argument("sortDir", type=str, dest="sort_dir", location="ar
 paginated_parser.add_argument("sortBy", type=str, dest="sort_by", location="args")
 paginated_parser.add_argument("filter", type=str, location="args")
 paginated_parser.add_argument("owner", type=str, location="args")
+paginated_parser.add_argument("cursor", type=str, location="args")
 
 
 def get_psuedo_random_string():
@@ -44,6 +49,90 @@ def get_psuedo_random_string():
     return challenge
 
 
+class ParseCache(object):
+    """
+    Bounded LRU cache of parsed PEM objects, keyed by the SHA-256 of their encoding.
+
+    Parsed certificates and CSRs are immutable, so one instance is shared by every caller in
+    the process and intermediates or roots referenced by thousands of chains are only parsed
+    once per worker. The size is read from ``LEMUR_PARSE_CACHE_SIZE``, 0 disables caching.
+    Hits and misses are sent as counters every ``report_interval`` lookups.
+    """
+
+    default_size = 1024
+    report_interval = 1000
+
+    def __init__(self, name, parse):
+        self.name = name
+        self.parse = parse
+        self.hits = 0
+        self.misses = 0
+        self._reported = (0, 0)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def maxsize(self):
+        if has_app_context():
+            return current_app.config.get("LEMUR_PARSE_CACHE_SIZE", self.default_size)
+        return self.default_size
+
+    def get(self, pem):
+        maxsize = self.maxsize
+        if not maxsize:
+            return self.parse(pem)
+
+        key = hashlib.sha256(pem.encode("utf-8")).digest()
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+
+        if value is None:
+            value = self.parse(pem)
+            with self._lock:
+                self.misses += 1
+                self._items[key] = value
+                while len(self._items) > maxsize:
+                    self._items.popitem(last=False)
+
+        if (self.hits + self.misses) % self.report_interval == 0:
+            self.report()
+
+        return value
+
+    def report(self):
+        """Sends the hits and misses since the last report."""
+        with self._lock:
+            hits = self.hits - self._reported[0]
+            misses = self.misses - self._reported[1]
+            self._reported = (self.hits, self.misses)
+
+        if has_app_context():
+            metrics.send("parse_cache.hit", "counter", hits, metric_tags={"cache": self.name})
+            metrics.send("parse_cache.miss", "counter", misses, metric_tags={"cache": self.name})
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+def _load_certificate(body):
+    return x509.load_pem_x509_certificate(body.encode("utf-8"), default_backend())
+
+
+def _load_csr(csr):
+    return x509.load_pem_x509_csr(csr.encode("utf-8"), default_backend())
+
+
+certificate_cache = ParseCache("certificate", _load_certificate)
+csr_cache = ParseCache("csr", _load_csr)
+
+
 def parse_certificate(body):
     """
     Helper function that parses a PEM certificate.
@@ -53,7 +142,7 @@ def parse_certificate(body):
     """
     assert isinstance(body, str)
 
-    return x509.load_pem_x509_certificate(body.encode("utf-8"), default_backend())
+    return certificate_cache.get(body)
 
 
 def parse_private_key(private_key):
@@ -102,7 +191,7 @@ def parse_csr(csr):
     """
     assert isinstance(csr, str)
 
-    return x509.load_pem_x509_csr(csr.encode("utf-8"), default_backend())
+    return csr_cache.get(csr)
 
 
 def get_authority_key(body):
@@ -291,19 +380,21 @@ def windowed_query(q, column, windowsize):
             yield row
 
 
+def chunks(items, size):
+    """Break an iterable into lists of at most `size` items."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
 def truthiness(s):
     """If input string resembles something truthy then return True, else False."""
 
     return s.lower() in ("true", "yes", "on", "t", "1")
 
-
-def find_matching_certificates_by_hash(cert, matching_certs):
-    """Given a Cryptography-formatted certificate cert, and Lemur-formatted certificates (matching_certs),
-    determine if any of the certificate hashes match and return the matches."""
-    matching = []
-    for c in matching_certs:
-        if parse_certificate(c.body).fingerprint(hashes.SHA256()) == cert.fingerprint(
-            hashes.SHA256()
-        ):
-            matching.append(c)
-    return matching
@@ -9,12 +9,15 @@
 
 .. moduleauthor:: Kevin Glisson <kglisson@netflix.com>
 """
+import base64
+import json
+
 from inflection import underscore
 from sqlalchemy import exc, func, distinct
 from sqlalchemy.orm import make_transient, lazyload
 from sqlalchemy.sql import and_, or_
 
-from lemur.exceptions import AttrNotFound, DuplicateError
+from lemur.exceptions import AttrNotFound, DuplicateError, InvalidCursor
 from lemur.extensions import db
 
 
@@ -306,10 +309,93 @@ def get_count(q):
     return count
 
 
+def encode_cursor(item, column):
+    """
+    Builds the opaque cursor pointing just past `item` for the given sort column.
+
+    :param item:
+    :param column:
+    :return:
+    """
+    value = [getattr(item, column.name), item.id]
+    return base64.urlsafe_b64encode(json.dumps(value, default=str).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (sort value, id) pair stored in a cursor built by `encode_cursor`.
+
+    :param cursor:
+    :return: :raise InvalidCursor:
+    """
+    try:
+        value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return value, int(last_id)
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+
+
+def seek(query, model, column, direction, cursor):
+    """
+    Returns the page of `query` following `cursor`, ordered by `column` with
+    the primary key as tie breaker. Rows are located through the index on the
+    sort column instead of an OFFSET scan.
+
+    NULL sort values are treated as larger than any other value, matching
+    PostgreSQL's default NULLS LAST for ascending and NULLS FIRST for
+    descending order.
+
+    :param query:
+    :param model:
+    :param column:
+    :param direction:
+    :param cursor:
+    :return:
+    """
+    if direction == "desc":
+        query = query.order_by(column.desc(), model.id.desc())
+    else:
+        query = query.order_by(column.asc(), model.id.asc())
+
+    if not cursor:
+        return query
+
+    value, last_id = decode_cursor(cursor)
+
+    if column is model.__table__.columns.id:
+        if direction == "desc":
+            return query.filter(model.id < last_id)
+        return query.filter(model.id > last_id)
+
+    if direction == "desc":
+        if value is None:
+            return query.filter(
+                or_(column.isnot(None), and_(column.is_(None), model.id < last_id))
+            )
+        return query.filter(
+            or_(column < value, and_(column == value, model.id < last_id))
+        )
+
+    if value is None:
+        return query.filter(and_(column.is_(None), model.id > last_id))
+    return query.filter(
+        or_(
+            column > value,
+            and_(column == value, model.id > last_id),
+            column.is_(None),
+        )
+    )
+
+
 def sort_and_page(query, model, args):
     """
     Helper that allows us to combine sorting and paging
 
+    When a `cursor` is given (an empty one starts at the first page) keyset
+    pagination is used instead of page numbers: results are ordered by the
+    sort column (`id` descending by default), no total is computed and the
+    cursor for the following page is returned as `next_cursor`.
+
     :param query:
     :param model:
     :param args:
@@ -319,12 +405,24 @@ def sort_and_page(query, model, args):
     sort_dir = args.pop("sort_dir")
     page = args.pop("page")
     count = args.pop("count")
+    cursor = args.pop("cursor", None)
 
     if args.get("user"):
         user = args.pop("user")
 
     query = find_all(query, model, args)
 
+    if cursor is not None:
+        column = get_model_column(model, underscore(sort_by or "id"))
+        query = seek(query, model, column, sort_dir or "desc", cursor)
+
+        items = query.limit(count + 1).all()
+        next_cursor = None
+        if len(items) > count:
+            items = items[:count]
+            next_cursor = encode_cursor(items[-1], column)
+        return dict(items=items, next_cursor=next_cursor)
+
     if sort_by and sort_dir:
         query = sort(query, model, sort_by, sort_dir)
 
@@ -75,6 +75,8 @@ class DomainsList(AuthenticatedResource):
            :query sortBy: field to sort on
            :query sortDir: asc or desc
            :query page: int default is 1
+           :query cursor: opaque cursor from a previous ``nextCursor``, pass it empty to start. Switches to cursor
+                          pagination: no total is returned and ``page`` is ignored
            :query filter: key value pair format is k;v
            :query count: count number. default is 10
            :reqheader Authorization: OAuth token to authenticate
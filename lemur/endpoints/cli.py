@@ -11,11 +11,14 @@ import arrow
 from datetime import timedelta
 
 from sqlalchemy import cast
+from sqlalchemy.sql import text
 from sqlalchemy_utils import ArrowType
 
 from lemur import database
 from lemur.extensions import metrics, sentry
-from lemur.endpoints.models import Endpoint
+from lemur.endpoints import service as endpoint_service
+from lemur.endpoints.models import Cipher, Endpoint, Policy
+from lemur.models import policies_ciphers
 
 
 manager = Manager(usage="Handles all endpoint related tasks.")
@@ -54,3 +57,71 @@ def expire(ttl):
         print("[+] Finished expiration.")
     except Exception as e:
         sentry.captureException()
+
+
+@manager.option(
+    "-c",
+    "--commit",
+    dest="commit",
+    action="store_true",
+    default=False,
+    help="Persist changes.",
+)
+def compact_policies(commit):
+    """
+    Merges duplicate ciphers and policies with the same cipher set, repointing endpoints to
+    the remaining policy, and refreshes the content hash of every policy.
+    """
+    print("[+] Staring compaction of endpoint policies.")
+
+    # ciphers are identified by name, keep the oldest of each
+    ciphers = {}
+    merged_ciphers = 0
+    for cipher in database.session_query(Cipher).order_by(Cipher.id):
+        if cipher.name not in ciphers:
+            ciphers[cipher.name] = cipher
+            continue
+
+        database.db.session.execute(
+            policies_ciphers.update()
+            .where(policies_ciphers.c.cipher_id == cipher.id)
+            .values(cipher_id=ciphers[cipher.name].id)
+        )
+        database.db.session.delete(cipher)
+        merged_ciphers += 1
+
+    database.db.session.flush()
+    # merging ciphers can leave a policy with the same cipher twice
+    database.db.session.execute(
+        text(
+            "delete from policies_ciphers a using policies_ciphers b "
+            "where a.ctid < b.ctid and a.policy_id = b.policy_id and a.cipher_id = b.cipher_id"
+        )
+    )
+    database.db.session.expire_all()
+
+    policies = {}
+    merged_policies = 0
+    for policy in database.session_query(Policy).order_by(Policy.id):
+        policy_hash = endpoint_service.get_policy_hash(policy.ciphers)
+        if policy_hash not in policies:
+            policies[policy_hash] = policy
+            policy.content_hash = policy_hash
+            continue
+
+        database.db.session.query(Endpoint).filter(
+            Endpoint.policy_id == policy.id
+        ).update({Endpoint.policy_id: policies[policy_hash].id}, synchronize_session=False)
+        database.db.session.delete(policy)
+        merged_policies += 1
+
+    print(
+        "[+] Merged {0} ciphers and {1} policies.".format(merged_ciphers, merged_policies)
+    )
+
+    if commit:
+        database.commit()
+        print("[+] Finished compaction.")
+    else:
+        database.db.session.rollback()
+        print("[!] Run with --commit to persist changes.")
@@ -9,7 +9,7 @@
 import arrow
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.associationproxy import association_proxy
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Index
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.sql.expression import case
 
@@ -39,13 +39,22 @@ class Cipher(db.Model):
 
 class Policy(db.Model):
     ___tablename__ = "policies"
+    __table_args__ = (
+        Index("ix_policy_content_hash", "content_hash", unique=True),
+    )
     id = Column(Integer, primary_key=True)
     name = Column(String(128), nullable=True)
     ciphers = relationship("Cipher", secondary=policies_ciphers, backref="policy")
+    content_hash = Column(String(64))
 
 
 class Endpoint(db.Model):
     __tablename__ = "endpoints"
+    __table_args__ = (
+        Index(
+            "ix_endpoints_source_dnsname_port", "source_id", "dnsname", "port", unique=True
+        ),
+    )
     id = Column(Integer, primary_key=True)
     owner = Column(String(128))
     name = Column(String(128))
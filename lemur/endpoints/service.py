@@ -8,15 +8,23 @@
 .. moduleauthor:: Kevin Glisson <kglisson@netflix.com>
 
 """
+import hashlib
+import json
+
 import arrow
 
 from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
 
 from lemur import database
 from lemur.common.utils import truthiness
 from lemur.endpoints.models import Endpoint, Policy, Cipher
+from lemur.models import policies_ciphers
 from lemur.extensions import metrics
 
+# policy hash to id, policies are immutable once created
+policy_ids = {}
+
 
 def get_all():
     """
@@ -105,24 +113,165 @@ def create(**kwargs):
     return endpoint
 
 
-def get_or_create_policy(**kwargs):
-    policy = database.get(Policy, kwargs["name"], field="name")
+def get_policy_hash(ciphers):
+    """
+    Canonical hash of a policy: the sorted set of its cipher names. Policies with the same
+    ciphers share one row whatever they are named, the row keeps the first name seen.
+
+    :param ciphers: cipher names or Cipher objects
+    :return:
+    """
+    names = sorted(set(getattr(c, "name", c) for c in ciphers))
+    return hashlib.sha256(json.dumps(names).encode("utf-8")).hexdigest()
 
-    if not policy:
-        policy = Policy(**kwargs)
-        database.create(policy)
 
+def get_cached_policy(policy_hash):
+    """
+    Returns the policy with this hash if this process has seen it, without touching ciphers.
+
+    :param policy_hash:
+    :return:
+    """
+    policy_id = policy_ids.get(policy_hash)
+    if policy_id is None:
+        return
+
+    policy = Policy.query.get(policy_id)
+    if not policy:
+        # created in a transaction that was rolled back
+        policy_ids.pop(policy_hash, None)
     return policy
 
 
-def get_or_create_cipher(**kwargs):
-    cipher = database.get(Cipher, kwargs["name"], field="name")
+def get_or_create_policy(**kwargs):
+    """
+    Returns the policy with the given cipher set, creating it with the given name if needed.
+    Policies are looked up by their content hash, see `get_policy_hash`.
+
+    :param kwargs: name and ciphers (names or Cipher objects)
+    :return:
+    """
+    policies = get_or_create_policies(
+        [dict(name=kwargs["name"], ciphers=[getattr(c, "name", c) for c in kwargs["ciphers"]])]
+    )
+    return list(policies.values())[0]
+
+
+def get_ids_by_dnsname_and_port(source):
+    """
+    Maps the (dnsname, port) of the endpoints of `source` to their id.
 
-    if not cipher:
-        cipher = Cipher(**kwargs)
-        database.create(cipher)
+    :param source:
+    :return:
+    """
+    query = database.db.session.query(Endpoint.dnsname, Endpoint.port, Endpoint.id).filter(
+        Endpoint.source_id == source.id
+    )
+    return {(dnsname, port): id for dnsname, port, id in query}
+
+
+def get_or_create_ciphers(names):
+    """
+    Returns a name to Cipher map for `names`, looking all of them up in one query and
+    adding the missing ones to the session.
 
-    return cipher
+    :param names:
+    :return:
+    """
+    names = set(names)
+    ciphers = {}
+    if names:
+        for cipher in Cipher.query.filter(Cipher.name.in_(names)).order_by(Cipher.id):
+            ciphers.setdefault(cipher.name, cipher)
+
+    for name in names - set(ciphers):
+        ciphers[name] = Cipher(name=name)
+        database.add(ciphers[name])
+
+    database.db.session.flush()
+    return ciphers
+
+
+def insert_policies(policies):
+    """
+    Inserts the given policies, keyed by content hash, with ``ON CONFLICT DO NOTHING``. A
+    policy created concurrently by another sync is left alone, only the policies inserted
+    here get their cipher associations.
+
+    :param policies: hash to policy dict (name and cipher names)
+    :return:
+    """
+    ciphers = get_or_create_ciphers(c for p in policies.values() for c in p["ciphers"])
+    stmt = (
+        insert(Policy.__table__)
+        .values([dict(name=p["name"], content_hash=h) for h, p in policies.items()])
+        .on_conflict_do_nothing(index_elements=["content_hash"])
+        .returning(Policy.__table__.c.id, Policy.__table__.c.content_hash)
+    )
+    associations = [
+        dict(policy_id=policy_id, cipher_id=ciphers[name].id)
+        for policy_id, policy_hash in database.db.session.execute(stmt)
+        for name in sorted(set(policies[policy_hash]["ciphers"]))
+    ]
+    if associations:
+        database.db.session.execute(policies_ciphers.insert(), associations)
+
+
+def get_or_create_policies(policies):
+    """
+    Returns a hash to Policy map for the given policy dicts (name and cipher names), see
+    `get_policy_hash`. Policies this process has not seen are looked up in one query, and
+    missing policies and ciphers are created in bulk.
+
+    :param policies:
+    :return:
+    """
+    policies = {get_policy_hash(p["ciphers"]): p for p in policies}
+    existing = {}
+    for policy_hash in policies:
+        policy = get_cached_policy(policy_hash)
+        if policy:
+            existing[policy_hash] = policy
+
+    def select(hashes):
+        for policy in Policy.query.filter(Policy.content_hash.in_(hashes)):
+            existing[policy.content_hash] = policy
+
+    unknown = [h for h in policies if h not in existing]
+    if unknown:
+        select(unknown)
+
+    missing = {h: policies[h] for h in policies if h not in existing}
+    if missing:
+        insert_policies(missing)
+        select(list(missing))
+
+    for policy_hash, policy in existing.items():
+        policy_ids[policy_hash] = policy.id
+    return existing
+
+
+def upsert(rows):
+    """
+    Inserts endpoints, or updates the policy, certificate and last update of the endpoint the
+    same source already has at the same (dnsname, port), in a single statement. Does not commit.
+
+    :param rows: list of dicts of endpoint column values
+    :return:
+    """
+    if not rows:
+        return
+
+    stmt = insert(Endpoint.__table__).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Endpoint.source_id, Endpoint.dnsname, Endpoint.port],
+        set_=dict(
+            policy_id=stmt.excluded.policy_id,
+            certificate_id=stmt.excluded.certificate_id,
+            last_updated=stmt.excluded.last_updated,
+        ),
+    )
+    database.db.session.execute(stmt)
 
 
 def update(endpoint_id, **kwargs):
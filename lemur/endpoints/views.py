@@ -54,6 +54,8 @@ class EndpointsList(AuthenticatedResource):
            :query sortBy: field to sort on
            :query sortDir: asc or desc
            :query page: int default is 1
+           :query cursor: opaque cursor from a previous ``nextCursor``, pass it empty to start. Switches to cursor
+                          pagination: no total is returned and ``page`` is ignored
            :query filter: key value pair. format is k;v
            :query limit: limit number default is 10
            :reqheader Authorization: OAuth token to authenticate
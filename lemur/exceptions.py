@@ -34,6 +34,14 @@ class AttrNotFound(LemurException):
         return repr("The field '{0}' is not sortable or filterable".format(self.field))
 
 
+class InvalidCursor(LemurException):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __str__(self):
+        return repr("The cursor '{0}' is not valid for this query".format(self.cursor))
+
+
 class InvalidConfiguration(Exception):
     pass
 
@@ -3,18 +3,110 @@
     :copyright: (c) 2018 by Netflix Inc., see AUTHORS for more
     :license: Apache, see LICENSE for more details.
 """
+import atexit
+import os
+import threading
+
 from flask import current_app
 from lemur.plugins.base import plugins
 
 
+class Histogram(object):
+    """
+    Summary of the values of a timer: how many there were, their sum, minimum and maximum.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+
+class MetricBuffer(object):
+    """
+    Aggregates metrics per (name, tags) until they are drained: counters are summed, the
+    last value of a gauge is kept and timers (any other type) are summarized in a
+    `Histogram`, so the buffer holds one entry per key however many values are sent.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+
+    def add(self, metric_name, metric_type, metric_value, metric_tags=None):
+        key = (metric_name, tuple(sorted(metric_tags.items())) if metric_tags else ())
+        metric_type = metric_type.lower()
+
+        with self.lock:
+            if metric_type == "counter":
+                self.counters[key] = self.counters.get(key, 0) + metric_value
+            elif metric_type == "gauge":
+                self.gauges[key] = metric_value
+            else:
+                if key not in self.timers:
+                    self.timers[key] = Histogram()
+                self.timers[key].add(metric_value)
+
+    def drain(self):
+        """
+        Returns the buffered metrics as (name, type, value, tags) tuples and empties the buffer.
+        A timer is reported as the `.count` and `.sum` counters and the `.min` and `.max`
+        gauges of its histogram.
+        """
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            gauges, self.gauges = self.gauges, {}
+            timers, self.timers = self.timers, {}
+
+        drained = []
+        for (name, tags), value in counters.items():
+            drained.append((name, "counter", value, dict(tags)))
+        for (name, tags), value in gauges.items():
+            drained.append((name, "gauge", value, dict(tags)))
+        for (name, tags), histogram in timers.items():
+            drained.extend([
+                (name + ".count", "counter", histogram.count, dict(tags)),
+                (name + ".sum", "counter", histogram.sum, dict(tags)),
+                (name + ".min", "gauge", histogram.min, dict(tags)),
+                (name + ".max", "gauge", histogram.max, dict(tags)),
+            ])
+        return drained
+
+    def __len__(self):
+        return len(self.counters) + len(self.gauges) + len(self.timers)
+
+
 class Metrics(object):
     """
     :param app: The Flask application object. Defaults to None.
+
+    With ``METRIC_FLUSH_INTERVAL`` set, metrics are aggregated in memory and handed to the
+    providers' `submit_many` by a background thread every that many seconds or as soon as
+    `request_flush` is called, e.g. when a Celery task ends, and once more when the process
+    exits. Otherwise every metric is submitted as it is sent.
     """
 
     _providers = []
 
     def __init__(self, app=None):
+        self.app = None
+        self.flush_interval = None
+        self.buffer = MetricBuffer()
+        self._plugins = {}
+        self._flusher = None
+        self._flusher_pid = None
+        self._flusher_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._exit_flush = False
         if app is not None:
             self.init_app(app)
 
@@ -23,14 +115,82 @@ class Metrics(object):
 
         :param app: The Flask application object.
         """
+        self.app = app
         self._providers = app.config.get("METRIC_PROVIDERS", [])
+        self.flush_interval = app.config.get("METRIC_FLUSH_INTERVAL")
+        self._plugins = {}
+        if self.flush_interval and not self._exit_flush:
+            # apps may be created many times in one process, flush on exit only once
+            atexit.register(self.flush)
+            self._exit_flush = True
+
+    def get_plugin(self, provider):
+        # plugins.get scans every registered plugin, resolve each provider only once
+        plugin = self._plugins.get(provider)
+        if plugin is None:
+            plugin = self._plugins[provider] = plugins.get(provider)
+        return plugin
 
     def send(self, metric_name, metric_type, metric_value, *args, **kwargs):
+        if not self._providers:
+            return
+
+        if self.flush_interval and "options" not in kwargs and len(args) < 2:
+            metric_tags = args[0] if args else kwargs.get("metric_tags")
+            self.buffer.add(metric_name, metric_type, metric_value, metric_tags)
+            self.start_flusher()
+            return
+
         for provider in self._providers:
             current_app.logger.debug(
-                "Sending metric '{metric}' to the {provider} provider.".format(
-                    metric=metric_name, provider=provider
-                )
+                "Sending metric '%s' to the %s provider.", metric_name, provider
             )
-            p = plugins.get(provider)
+            p = self.get_plugin(provider)
             p.submit(metric_name, metric_type, metric_value, *args, **kwargs)
+
+    def start_flusher(self):
+        # (re)start the thread in a forked worker, threads do not survive the fork
+        if self._flusher_pid == os.getpid():
+            return
+
+        with self._flusher_lock:
+            if self._flusher_pid == os.getpid():
+                return
+            if self._flusher_pid is not None:
+                # whatever the parent buffered is flushed by the parent
+                self.buffer = MetricBuffer()
+                self._flush_requested = threading.Event()
+            self._flusher = threading.Thread(target=self.run_flusher, daemon=True)
+            self._flusher.start()
+            self._flusher_pid = os.getpid()
+
+    def run_flusher(self):
+        while True:
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            self.flush()
+
+    def request_flush(self):
+        """Has the background thread flush now instead of at the end of its interval."""
+        if not self.flush_interval:
+            return
+
+        self.start_flusher()
+        self._flush_requested.set()
+
+    def flush(self):
+        """Submits everything buffered so far to every provider."""
+        metrics = self.buffer.drain()
+        if not metrics or self.app is None:
+            return
+
+        with self.app.app_context():
+            for provider in self._providers:
+                try:
+                    self.get_plugin(provider).submit_many(metrics)
+                except Exception as e:
+                    current_app.logger.warning(
+                        "Unable to flush {count} metrics to the {provider} provider: {error}".format(
+                            count=len(metrics), provider=provider, error=e
+                        )
+                    )
@@ -0,0 +1,80 @@
+"""Add an indexed SHA-256 fingerprint column to certificates and backfill it
+
+Revision ID: 4f3c2e6a8b1d
+Revises: b33c838cb669
+Create Date: 2026-10-16 10:12:31.241503
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "4f3c2e6a8b1d"
+down_revision = "b33c838cb669"
+
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from sqlalchemy.sql import text
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    op.add_column(
+        "certificates", sa.Column("fingerprint", sa.String(length=64), nullable=True)
+    )
+    op.create_index(
+        "ix_certificates_fingerprint", "certificates", ["fingerprint"], unique=False
+    )
+
+    conn = op.get_bind()
+    last_id = 0
+    filled = 0
+    while True:
+        stmt = text(
+            "select id, body from certificates where id > :last_id order by id limit :limit"
+        )
+        rows = conn.execute(stmt.bindparams(last_id=last_id, limit=BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+
+        params = {}
+        values = []
+        for id, body in rows:
+            try:
+                cert = x509.load_pem_x509_certificate(
+                    body.strip().encode("utf-8"), default_backend()
+                )
+            except ValueError:
+                log.warning("Unable to parse certificate %d, skipping" % id)
+                continue
+
+            n = len(values)
+            params["id%d" % n] = id
+            params["fingerprint%d" % n] = cert.fingerprint(hashes.SHA256()).hex()
+            values.append("(:id%d, :fingerprint%d)" % (n, n))
+
+        # one statement per batch rather than one per certificate
+        if values:
+            stmt = text(
+                "update certificates c set fingerprint = v.fingerprint "
+                "from (values {0}) as v(id, fingerprint) where c.id = v.id".format(
+                    ", ".join(values)
+                )
+            )
+            conn.execute(stmt.bindparams(**params))
+            filled += len(values)
+
+        last_id = rows[-1][0]
+
+    log.info("Filled fingerprint for %d certificates" % filled)
+
+
+def downgrade():
+    op.drop_index("ix_certificates_fingerprint", table_name="certificates")
+    op.drop_column("certificates", "fingerprint")
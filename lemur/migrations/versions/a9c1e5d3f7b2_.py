@@ -0,0 +1,28 @@
+"""Add precomputed x509 metadata to certificates
+
+Rows are filled by `lemur certificate backfill_x509_metadata`, until then their
+metadata is derived from the certificate body as before.
+
+Revision ID: a9c1e5d3f7b2
+Revises: 4f3c2e6a8b1d
+Create Date: 2026-10-16 11:03:52.618240
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "a9c1e5d3f7b2"
+down_revision = "4f3c2e6a8b1d"
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.add_column(
+        "certificates", sa.Column("x509_metadata", postgresql.JSON(), nullable=True)
+    )
+
+
+def downgrade():
+    op.drop_column("certificates", "x509_metadata")
@@ -0,0 +1,48 @@
+"""Make endpoints unique per source on (dnsname, port) so source syncs can upsert them
+
+Endpoints from different sources or accounts may legitimately share a dnsname and port,
+so the key includes the source. Within one source a (dnsname, port) is a single endpoint,
+syncs used to update it in place; any duplicates left behind are dropped, keeping the most
+recently updated one. The next sync of the source rediscovers anything dropped here.
+
+Revision ID: c7e2b4d9a1f3
+Revises: a9c1e5d3f7b2
+Create Date: 2026-10-16 14:22:07.513092
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "c7e2b4d9a1f3"
+down_revision = "a9c1e5d3f7b2"
+
+from alembic import op
+from sqlalchemy.sql import text
+
+
+def upgrade():
+    conn = op.get_bind()
+    result = conn.execute(
+        text(
+            "delete from endpoints e using endpoints newer "
+            "where e.source_id = newer.source_id and e.dnsname = newer.dnsname "
+            "and e.port = newer.port "
+            "and (e.last_updated, e.id) < (newer.last_updated, newer.id)"
+        )
+    )
+    if result.rowcount:
+        print(
+            "[+] Removed {0} duplicate endpoints sharing a source, dnsname and port".format(
+                result.rowcount
+            )
+        )
+
+    op.create_index(
+        "ix_endpoints_source_dnsname_port",
+        "endpoints",
+        ["source_id", "dnsname", "port"],
+        unique=True,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_endpoints_source_dnsname_port", table_name="endpoints")
@@ -0,0 +1,71 @@
+"""Add a content hash to endpoint policies
+
+The hash is a SHA-256 of the policy's sorted, de-duplicated cipher names, see
+`lemur.endpoints.service.get_policy_hash`. Existing policies are hashed here; policies
+with the same cipher set are merged into the oldest one and their endpoints repointed,
+so the unique index holds and syncs reuse them straight away.
+
+Revision ID: d5a8f3c61e2b
+Revises: c7e2b4d9a1f3
+Create Date: 2026-10-16 15:41:26.880317
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "d5a8f3c61e2b"
+down_revision = "c7e2b4d9a1f3"
+
+import hashlib
+import json
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import text
+
+
+def upgrade():
+    op.add_column("policy", sa.Column("content_hash", sa.String(length=64), nullable=True))
+
+    conn = op.get_bind()
+    ciphers = {}
+    for policy_id, name in conn.execute(
+        text(
+            "select p.id, c.name from policy p "
+            "left join policies_ciphers pc on pc.policy_id = p.id "
+            "left join ciphers c on c.id = pc.cipher_id"
+        )
+    ):
+        names = ciphers.setdefault(policy_id, set())
+        if name is not None:
+            names.add(name)
+
+    kept, merged = {}, []
+    for policy_id in sorted(ciphers):
+        policy_hash = hashlib.sha256(
+            json.dumps(sorted(ciphers[policy_id])).encode("utf-8")
+        ).hexdigest()
+        if policy_hash in kept:
+            merged.append(dict(id=policy_id, kept_id=kept[policy_hash]))
+        else:
+            kept[policy_hash] = policy_id
+
+    if merged:
+        conn.execute(
+            text("update endpoints set policy_id = :kept_id where policy_id = :id"), merged
+        )
+        conn.execute(text("delete from policies_ciphers where policy_id = :id"), merged)
+        conn.execute(text("delete from policy where id = :id"), merged)
+        print("[+] Merged {0} policies with the same ciphers".format(len(merged)))
+
+    if kept:
+        conn.execute(
+            text("update policy set content_hash = :hash where id = :id"),
+            [dict(id=policy_id, hash=policy_hash) for policy_hash, policy_id in kept.items()],
+        )
+
+    op.create_index("ix_policy_content_hash", "policy", ["content_hash"], unique=True)
+
+
+def downgrade():
+    op.drop_index("ix_policy_content_hash", table_name="policy")
+    op.drop_column("policy", "content_hash")
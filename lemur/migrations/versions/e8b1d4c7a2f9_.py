@@ -0,0 +1,25 @@
+"""Track when each certificate's revocation status was last checked
+
+Revision ID: e8b1d4c7a2f9
+Revises: d5a8f3c61e2b
+Create Date: 2026-10-16 17:02:13.504182
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "e8b1d4c7a2f9"
+down_revision = "d5a8f3c61e2b"
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy_utils import ArrowType
+
+
+def upgrade():
+    op.add_column(
+        "certificates", sa.Column("last_revocation_check", ArrowType(), nullable=True)
+    )
+
+
+def downgrade():
+    op.drop_column("certificates", "last_revocation_check")
@@ -0,0 +1,67 @@
+"""Add the notification outbox
+
+Revision ID: f4c9a2e6b8d1
+Revises: e8b1d4c7a2f9
+Create Date: 2026-10-16 18:27:40.118953
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "f4c9a2e6b8d1"
+down_revision = "e8b1d4c7a2f9"
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy_utils import ArrowType, JSONType
+
+
+def upgrade():
+    op.create_table(
+        "notification_outbox",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("event_type", sa.String(length=32), nullable=False),
+        sa.Column("plugin_name", sa.String(length=64), nullable=False),
+        sa.Column("notification_id", sa.Integer(), nullable=True),
+        sa.Column("targets", JSONType(), nullable=True),
+        sa.Column("payload", JSONType(), nullable=True),
+        sa.Column("status", sa.String(length=16), server_default="pending", nullable=False),
+        sa.Column("attempts", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("last_error", sa.Text(), nullable=True),
+        sa.Column("date_created", ArrowType(), server_default=sa.text("now()"), nullable=False),
+        sa.Column("next_attempt", ArrowType(), server_default=sa.text("now()"), nullable=False),
+        sa.Column("date_sent", ArrowType(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["notification_id"], ["notifications.id"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_notification_outbox_status_next_attempt",
+        "notification_outbox",
+        ["status", "next_attempt"],
+    )
+    op.create_table(
+        "notification_outbox_keys",
+        sa.Column("dedupe_key", sa.String(length=64), nullable=False),
+        sa.Column("message_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["message_id"], ["notification_outbox.id"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("dedupe_key"),
+    )
+    op.create_index(
+        "ix_notification_outbox_keys_message_id",
+        "notification_outbox_keys",
+        ["message_id"],
+    )
+
+
+def downgrade():
+    op.drop_index(
+        "ix_notification_outbox_keys_message_id", table_name="notification_outbox_keys"
+    )
+    op.drop_table("notification_outbox_keys")
+    op.drop_index(
+        "ix_notification_outbox_status_next_attempt", table_name="notification_outbox"
+    )
+    op.drop_table("notification_outbox")
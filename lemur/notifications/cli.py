@@ -7,9 +7,13 @@
 """
 from flask_script import Manager
 
+from lemur import database
 from lemur.constants import SUCCESS_METRIC_STATUS, FAILURE_METRIC_STATUS
 from lemur.extensions import sentry, metrics
-from lemur.notifications.messaging import send_expiration_notifications
+from lemur.notifications.messaging import (
+    dispatch_notifications,
+    send_expiration_notifications,
+)
 
 manager = Manager(usage="Handles notification related tasks.")
 
@@ -38,6 +42,8 @@ def expirations(exclude):
     try:
         print("Starting to notify subscribers about expiring certificates!")
         success, failed = send_expiration_notifications(exclude)
+        # commits the messages queued in the outbox
+        database.commit()
         print(
             "Finished notifying subscribers about expiring certificates! Sent: {success} Failed: {failed}".format(
                 success=success, failed=failed
@@ -50,3 +56,35 @@ def expirations(exclude):
     metrics.send(
         "expiration_notification_job", "counter", 1, metric_tags={"status": status}
     )
+
+
+@manager.option(
+    "-b",
+    "--batch-size",
+    dest="batch_size",
+    type=int,
+    default=None,
+    help="Number of outbox messages loaded and sent per batch.",
+)
+def dispatch(batch_size=None):
+    """
+    Delivers the notifications waiting in the outbox (see `LEMUR_NOTIFICATION_OUTBOX`).
+
+    :return:
+    """
+    status = FAILURE_METRIC_STATUS
+    try:
+        print("Starting to deliver queued notifications!")
+        sent, failed = dispatch_notifications(batch_size)
+        print(
+            "Finished delivering queued notifications! Sent: {sent} Given up: {failed}".format(
+                sent=sent, failed=failed
+            )
+        )
+        status = SUCCESS_METRIC_STATUS
+    except Exception as e:
+        sentry.captureException()
+
+    metrics.send(
+        "notification_dispatch_job", "counter", 1, metric_tags={"status": status}
+    )
@@ -8,39 +8,111 @@
 .. moduleauthor:: Kevin Glisson <kglisson@netflix.com>
 
 """
-from collections import defaultdict
+import hashlib
+import json
+import threading
+import time
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import timedelta
 from itertools import groupby
+from queue import Queue
 
 import arrow
 from flask import current_app
-from sqlalchemy import and_
+from sqlalchemy import and_, or_, select
+from sqlalchemy.dialects.postgresql import insert
 
 from lemur import database
 from lemur.certificates.models import Certificate
 from lemur.certificates.schemas import certificate_notification_output_schema
-from lemur.common.utils import windowed_query
 from lemur.constants import FAILURE_METRIC_STATUS, SUCCESS_METRIC_STATUS
 from lemur.extensions import metrics, sentry
+from lemur.notifications.models import (
+    Notification,
+    NotificationMessage,
+    NotificationMessageKey,
+)
 from lemur.pending_certificates.schemas import pending_certificate_output_schema
 from lemur.plugins import plugins
 from lemur.plugins.utils import get_plugin_option
 
 
-def get_certificates(exclude=None):
+def get_notification_interval(notification):
     """
-    Finds all certificates that are eligible for notifications.
+    Returns the number of days before expiration at which the notification fires.
+
+    :param notification:
+    :return:
+    """
+    interval = get_plugin_option("interval", notification.options)
+    unit = get_plugin_option("unit", notification.options)
+
+    if unit == "weeks":
+        interval *= 7
+
+    elif unit == "months":
+        interval *= 30
+
+    elif unit == "days":  # it's nice to be explicit about the base unit
+        pass
+
+    else:
+        raise Exception(
+            "Invalid base unit for expiration interval: {0}".format(unit)
+        )
+
+    return interval
+
+
+def get_due_notifications(exclude=None):
+    """
+    Finds every (certificate, notification) pair due to be sent today with a single query,
+    ordered by owner and notification label.
+
+    The few notifications are read once to turn their interval and unit into a window of
+    expiration dates; certificates are then matched against those windows in SQL instead of
+    loading the notifications of every certificate expiring soon.
+
     :param exclude:
     :return:
     """
     now = arrow.utcnow()
-    max = now + timedelta(days=90)
+
+    intervals = defaultdict(list)
+    for notification in Notification.query.filter(Notification.active == True):  # noqa
+        if not notification.options:
+            continue
+        try:
+            intervals[get_notification_interval(notification)].append(notification.id)
+        except Exception as e:
+            current_app.logger.error(
+                "Skipping notification {0}: {1}".format(notification.label, e)
+            )
+            sentry.captureException()
+
+    if not intervals:
+        return []
+
+    # a certificate is due `days` before expiration for the whole day after that point
+    windows = [
+        and_(
+            Notification.id.in_(ids),
+            Certificate.not_after >= now + timedelta(days=days),
+            Certificate.not_after < now + timedelta(days=days + 1),
+        )
+        for days, ids in intervals.items()
+    ]
 
     q = (
-        database.db.session.query(Certificate)
-        .filter(Certificate.not_after <= max)
+        database.db.session.query(Certificate, Notification)
+        .join(Certificate.notifications)
         .filter(Certificate.notify == True)
         .filter(Certificate.expired == False)
+        # as before, certificates expiring more than 90 days out are never notified about
+        .filter(Certificate.not_after <= now + timedelta(days=90))
+        .filter(or_(*windows))
     )  # noqa
 
     exclude_conditions = []
@@ -50,13 +122,21 @@ def get_certificates(exclude=None):
 
         q = q.filter(and_(*exclude_conditions))
 
-    certs = []
+    return q.order_by(Certificate.owner, Notification.label, Certificate.id).all()
 
-    for c in windowed_query(q, Certificate.id, 10000):
-        if needs_notification(c):
-            certs.append(c)
 
-    return certs
+def get_certificates(exclude=None):
+    """
+    Finds all certificates that are eligible for notifications.
+    :param exclude:
+    :return:
+    """
+    # a certificate is due once per notification, those are not necessarily adjacent
+    certs = OrderedDict()
+    for certificate, notification in get_due_notifications(exclude=exclude):
+        certs.setdefault(certificate.id, certificate)
+
+    return list(certs.values())
 
 
 def get_eligible_certificates(exclude=None):
@@ -66,29 +146,96 @@ def get_eligible_certificates(exclude=None):
     :return:
     """
     certificates = defaultdict(dict)
-    certs = get_certificates(exclude=exclude)
 
-    # group by owner
-    for owner, items in groupby(certs, lambda x: x.owner):
-        notification_groups = []
+    # group by owner, then by notification
+    for owner, items in groupby(get_due_notifications(exclude=exclude), lambda x: x[0].owner):
+        for label, pairs in groupby(items, lambda x: x[1].label):
+            certificates[owner][label] = [
+                (notification, certificate) for certificate, notification in pairs
+            ]
 
-        for certificate in items:
-            notifications = needs_notification(certificate)
+    return certificates
 
-            if notifications:
-                for notification in notifications:
-                    notification_groups.append((notification, certificate))
 
-        # group by notification
-        for notification, items in groupby(notification_groups, lambda x: x[0].label):
-            certificates[owner][notification] = list(items)
+def queue_notification(event_type, data, targets, notification=None, plugin_name=None):
+    """
+    Records a notification in the outbox, `dispatch_notifications` delivers it. The row is
+    only added to the session, it is committed with the caller's transaction.
 
-    return certificates
+    Certificates already queued today for the same event, notification and targets are left
+    out of the message, and a message left with no certificates is dropped, see
+    `NotificationMessageKey`.
+
+    :param event_type:
+    :param data: notification payload of one or several certificates
+    :param targets:
+    :param notification: the notification to send through, or None to use `plugin_name`
+    :param plugin_name:
+    :return:
+    """
+    if notification:
+        plugin_name = notification.plugin_name
+
+    day = arrow.utcnow().format("YYYY-MM-DD")
+    certificates = OrderedDict()
+    for certificate in data if isinstance(data, list) else [data]:
+        dedupe_key = hashlib.sha256(
+            json.dumps(
+                [
+                    event_type,
+                    notification.id if notification else plugin_name,
+                    certificate["name"],
+                    sorted(targets),
+                    day,
+                ]
+            ).encode("utf-8")
+        ).hexdigest()
+        certificates[dedupe_key] = certificate
+
+    message = NotificationMessage(
+        event_type=event_type,
+        plugin_name=plugin_name,
+        notification_id=notification.id if notification else None,
+        targets=list(targets),
+        payload=data,
+    )
+    database.add(message)
+    database.db.session.flush()
+
+    # keys another message holds, even one not committed yet, are skipped
+    outbox_keys = NotificationMessageKey.__table__
+    inserted = database.db.session.execute(
+        insert(outbox_keys)
+        .values([dict(dedupe_key=k, message_id=message.id) for k in certificates])
+        .on_conflict_do_nothing(index_elements=["dedupe_key"])
+        .returning(outbox_keys.c.dedupe_key)
+    )
+    inserted = set(dedupe_key for dedupe_key, in inserted)
+    queued = [c for k, c in certificates.items() if k in inserted]
+
+    if not queued:
+        database.db.session.delete(message)
+    elif len(queued) < len(certificates):
+        message.payload = queued
+
+    for status, count in [
+        ("queued", len(queued)),
+        ("duplicate", len(certificates) - len(queued)),
+    ]:
+        if count:
+            metrics.send(
+                "notification_outbox.queued",
+                "counter",
+                count,
+                metric_tags={"event_type": event_type, "status": status},
+            )
+    return True
 
 
 def send_notification(event_type, data, targets, notification):
     """
-    Executes the plugin and handles failure.
+    Executes the plugin and handles failure. With ``LEMUR_NOTIFICATION_OUTBOX`` enabled the
+    notification is queued in the outbox instead.
 
     :param event_type:
     :param data:
@@ -96,6 +243,9 @@ def send_notification(event_type, data, targets, notification):
     :param notification:
     :return:
     """
+    if current_app.config.get("LEMUR_NOTIFICATION_OUTBOX", False):
+        return queue_notification(event_type, data, targets, notification=notification)
+
     status = FAILURE_METRIC_STATUS
     try:
         notification.plugin.send(event_type, data, targets, notification.options)
@@ -114,6 +264,73 @@ def send_notification(event_type, data, targets, notification):
         return True
 
 
+def get_routing_key(notification):
+    """
+    Returns what decides where the messages of a notification go: its plugin and the values of
+    the plugin's `routing_options`. Digests only merge notifications with the same key.
+
+    :param notification:
+    :return:
+    """
+    names = getattr(notification.plugin, "routing_options", [])
+    return (notification.plugin_name,) + tuple(
+        json.dumps(get_plugin_option(name, notification.options), sort_keys=True)
+        for name in names
+    )
+
+
+def plan_expiration_notifications(exclude=None):
+    """
+    Builds the expiration digests of a run: one message per set of targets (the owner, a
+    notification's recipients and the security team), listing each of its certificates once,
+    soonest to expire first. Notifications routed the same way, see `get_routing_key`, share
+    their digests, and each certificate keeps the notification it is due under.
+
+    :param exclude:
+    :return: list of (notification, targets, [(certificate, notification)]) and the number of
+        certificates covered
+    """
+    security_email = current_app.config.get("LEMUR_SECURITY_TEAM_EMAIL") or []
+
+    digests = OrderedDict()
+    covered = set()
+
+    def add(notification, targets, certificate):
+        key = (get_routing_key(notification), frozenset(targets))
+        if key not in digests:
+            digests[key] = (notification, list(targets), OrderedDict())
+        digests[key][2].setdefault(certificate.id, (certificate, notification))
+
+    for certificate, notification in get_due_notifications(exclude=exclude):
+        covered.add(certificate.id)
+        add(notification, [certificate.owner], certificate)
+
+        notification_recipient = get_plugin_option("recipients", notification.options)
+        if notification_recipient:
+            # removing owner and security_email from notification_recipient
+            notification_recipient = [
+                i
+                for i in notification_recipient.split(",")
+                if i not in security_email and i != certificate.owner
+            ]
+            if notification_recipient:
+                add(notification, notification_recipient, certificate)
+
+        # security team gets all
+        if security_email:
+            add(notification, security_email, certificate)
+
+    plan = [
+        (
+            notification,
+            targets,
+            sorted(certificates.values(), key=lambda p: (p[0].not_after, p[0].name)),
+        )
+        for notification, targets, certificates in digests.values()
+    ]
+    return plan, len(covered)
+
+
 def send_expiration_notifications(exclude):
     """
     This function will check for upcoming certificate expiration,
@@ -121,59 +338,51 @@ def send_expiration_notifications(exclude):
     """
     success = failure = 0
 
-    # security team gets all
-    security_email = current_app.config.get("LEMUR_SECURITY_TEAM_EMAIL")
+    plan, covered = plan_expiration_notifications(exclude=exclude)
 
-    security_data = []
-    for owner, notification_group in get_eligible_certificates(exclude=exclude).items():
+    # each certificate is dumped once per run and the same payload is handed to every
+    # message it appears in, plugins must treat payloads as read-only
+    dumped = {}
+    payloads = {}
+    with ExitStack() as batches:
+        batched = set()
+        for notification, targets, certificates in plan:
+            # deliver everything a plugin sends this run over one connection
+            if notification.plugin_name not in batched:
+                batches.enter_context(notification.plugin.batch())
+                batched.add(notification.plugin_name)
 
-        for notification_label, certificates in notification_group.items():
             notification_data = []
-
-            notification = certificates[0][0]
-
-            for data in certificates:
-                n, certificate = data
-                cert_data = certificate_notification_output_schema.dump(
-                    certificate
-                ).data
-                notification_data.append(cert_data)
-                security_data.append(cert_data)
-
-            if send_notification(
-                "expiration", notification_data, [owner], notification
-            ):
+            for certificate, due in certificates:
+                if certificate.id not in dumped:
+                    dumped[certificate.id] = certificate_notification_output_schema.dump(
+                        certificate
+                    ).data
+                key = (certificate.id, due.id)
+                if key not in payloads:
+                    # tells apart the notifications merged into one digest
+                    payloads[key] = dict(
+                        dumped[certificate.id],
+                        notification=dict(
+                            label=due.label,
+                            interval=get_plugin_option("interval", due.options),
+                            unit=get_plugin_option("unit", due.options),
+                        ),
+                    )
+                notification_data.append(payloads[key])
+
+            if send_notification("expiration", notification_data, targets, notification):
                 success += 1
             else:
                 failure += 1
 
-            notification_recipient = get_plugin_option(
-                "recipients", notification.options
-            )
-            if notification_recipient:
-                notification_recipient = notification_recipient.split(",")
-                # removing owner and security_email from notification_recipient
-                notification_recipient = [i for i in notification_recipient if i not in security_email and i != owner]
-
-            if (
-                notification_recipient
-            ):
-                if send_notification(
-                    "expiration",
-                    notification_data,
-                    notification_recipient,
-                    notification,
-                ):
-                    success += 1
-                else:
-                    failure += 1
-
-            if send_notification(
-                "expiration", security_data, security_email, notification
-            ):
-                success += 1
-            else:
-                failure += 1
+    current_app.logger.info(
+        "Sent {0} expiration messages ({1} failed) covering {2} certificates".format(
+            success, failure, covered
+        )
+    )
+    metrics.send("expiration_notification.messages", "gauge", success + failure)
+    metrics.send("expiration_notification.certificates", "gauge", covered)
 
     return success, failure
 
@@ -195,6 +404,11 @@ def send_rotation_notification(certificate, notification_plugin=None):
 
     data = certificate_notification_output_schema.dump(certificate).data
 
+    if current_app.config.get("LEMUR_NOTIFICATION_OUTBOX", False):
+        return queue_notification(
+            "rotation", data, [data["owner"]], plugin_name=notification_plugin.slug
+        )
+
     try:
         notification_plugin.send("rotation", data, [data["owner"]])
         status = SUCCESS_METRIC_STATUS
@@ -215,6 +429,231 @@ def send_rotation_notification(certificate, notification_plugin=None):
         return True
 
 
+class RateLimiter(object):
+    """
+    Spaces calls out to at most `rate` per second, shared by the dispatcher's threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next)
+            self.next = at + self.interval
+
+        if at > now:
+            time.sleep(at - now)
+
+
+def deliver_notifications(app, limiters, pending, delivered):
+    """
+    Sends the messages taken from `pending` until it yields None, and puts each message's id
+    and error (None once sent) on `delivered`. A plugin's sends go through its `batch()`, so
+    every worker reuses one connection per plugin for the whole dispatch.
+    """
+    with app.app_context(), ExitStack() as batches:
+        batched = set()
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+
+            message_id, plugin_name, event_type, payload, targets, options = item
+            try:
+                plugin = plugins.get(plugin_name)
+                if plugin_name not in batched:
+                    batches.enter_context(plugin.batch())
+                    batched.add(plugin_name)
+
+                if plugin_name in limiters:
+                    limiters[plugin_name].wait()
+                plugin.send(event_type, payload, targets, options)
+                delivered.put((message_id, None))
+            except Exception as e:
+                sentry.captureException()
+                delivered.put((message_id, e))
+
+
+def claim_notifications(batch_size):
+    """
+    Marks up to `batch_size` due messages as `sending` and returns them. Rows are picked with
+    ``FOR UPDATE SKIP LOCKED`` and the claim is committed before anything is sent, so
+    concurrent dispatchers never get the same message. A claim expires after
+    ``LEMUR_NOTIFICATION_CLAIM_SECONDS``, after which a message left behind by a dispatcher
+    that died is picked up again.
+
+    :param batch_size:
+    :return:
+    """
+    now = arrow.utcnow()
+    outbox = NotificationMessage.__table__
+    due = (
+        select([outbox.c.id])
+        .where(outbox.c.status.in_(["pending", "sending"]))
+        .where(outbox.c.next_attempt <= now)
+        .order_by(outbox.c.next_attempt, outbox.c.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    claimed = database.db.session.execute(
+        outbox.update()
+        .where(outbox.c.id.in_(due))
+        .values(
+            status="sending",
+            next_attempt=now.shift(
+                seconds=current_app.config.get("LEMUR_NOTIFICATION_CLAIM_SECONDS", 600)
+            ),
+        )
+        .returning(outbox.c.id)
+    )
+    ids = [message_id for message_id, in claimed]
+    database.commit()
+
+    if not ids:
+        return []
+    return (
+        NotificationMessage.query.filter(NotificationMessage.id.in_(ids))
+        .order_by(NotificationMessage.id)
+        .all()
+    )
+
+
+def purge_notifications():
+    """
+    Deletes sent and failed messages older than ``LEMUR_NOTIFICATION_OUTBOX_RETENTION_DAYS``,
+    with their keys, and the keys of messages queued before today. Keys include the day they
+    were queued on, so older ones no longer keep any certificate out of the outbox.
+
+    :return: number of messages and keys deleted
+    """
+    now = arrow.utcnow()
+    retention = current_app.config.get("LEMUR_NOTIFICATION_OUTBOX_RETENTION_DAYS", 30)
+    outbox = NotificationMessage.__table__
+    outbox_keys = NotificationMessageKey.__table__
+
+    messages = database.db.session.execute(
+        outbox.delete()
+        .where(outbox.c.status.in_(["sent", "failed"]))
+        .where(outbox.c.date_created < now.shift(days=-retention))
+    ).rowcount
+    keys = database.db.session.execute(
+        outbox_keys.delete().where(
+            outbox_keys.c.message_id.in_(
+                select([outbox.c.id]).where(outbox.c.date_created < now.floor("day"))
+            )
+        )
+    ).rowcount
+    database.commit()
+
+    metrics.send("notification_outbox.purged", "counter", messages, metric_tags={"table": "messages"})
+    metrics.send("notification_outbox.purged", "counter", keys, metric_tags={"table": "keys"})
+    return messages, keys
+
+
+def dispatch_notifications(batch_size=None):
+    """
+    Delivers the messages due in the outbox, `batch_size` at a time.
+
+    At most ``LEMUR_NOTIFICATION_CONCURRENCY`` messages are sent at once, and plugins listed in
+    ``LEMUR_NOTIFICATION_RATE_LIMITS`` (slug to messages per second) are throttled. A failed
+    message is retried with exponential backoff, starting at ``LEMUR_NOTIFICATION_RETRY_SECONDS``,
+    until it has been attempted ``LEMUR_NOTIFICATION_MAX_ATTEMPTS`` times. Messages are claimed
+    before they are sent, see `claim_notifications`, so dispatchers can run concurrently. Old
+    messages are purged afterwards, see `purge_notifications`.
+
+    :param batch_size:
+    :return: number of messages sent and given up on
+    """
+    batch_size = batch_size or current_app.config.get("LEMUR_NOTIFICATION_BATCH_SIZE", 100)
+    concurrency = current_app.config.get("LEMUR_NOTIFICATION_CONCURRENCY", 4)
+    max_attempts = current_app.config.get("LEMUR_NOTIFICATION_MAX_ATTEMPTS", 5)
+    retry_seconds = current_app.config.get("LEMUR_NOTIFICATION_RETRY_SECONDS", 60)
+    limiters = {
+        slug: RateLimiter(rate)
+        for slug, rate in current_app.config.get("LEMUR_NOTIFICATION_RATE_LIMITS", {}).items()
+    }
+
+    app = current_app._get_current_object()
+    sent = failed = 0
+    pending, delivered = Queue(), Queue()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(deliver_notifications, app, limiters, pending, delivered)
+
+        try:
+            while True:
+                messages = {message.id: message for message in claim_notifications(batch_size)}
+                if not messages:
+                    break
+
+                for message in messages.values():
+                    pending.put(
+                        (
+                            message.id,
+                            message.plugin_name,
+                            message.event_type,
+                            message.payload,
+                            message.targets,
+                            message.notification.options if message.notification else None,
+                        )
+                    )
+
+                for _ in range(len(messages)):
+                    message_id, error = delivered.get()
+                    message = messages[message_id]
+                    status = FAILURE_METRIC_STATUS
+                    if error is None:
+                        status = SUCCESS_METRIC_STATUS
+                        message.status = "sent"
+                        message.date_sent = arrow.utcnow()
+                        sent += 1
+                        metrics.send(
+                            "notification_outbox.latency",
+                            "timer",
+                            (message.date_sent - message.date_created).total_seconds() * 1000,
+                            metric_tags={
+                                "event_type": message.event_type,
+                                "plugin": message.plugin_name,
+                            },
+                        )
+                    else:
+                        message.attempts += 1
+                        message.last_error = str(error)
+                        if message.attempts >= max_attempts:
+                            message.status = "failed"
+                            failed += 1
+                        else:
+                            message.status = "pending"
+                            message.next_attempt = arrow.utcnow().shift(
+                                seconds=retry_seconds * 2 ** (message.attempts - 1)
+                            )
+
+                    metrics.send(
+                        "notification",
+                        "counter",
+                        1,
+                        metric_tags={"status": status, "event_type": message.event_type},
+                    )
+
+                database.commit()
+        finally:
+            # let the workers close their plugins' connections and exit
+            for _ in range(concurrency):
+                pending.put(None)
+
+    purge_notifications()
+
+    backlog = NotificationMessage.query.filter(
+        NotificationMessage.status.in_(["pending", "sending"])
+    ).count()
+    metrics.send("notification_outbox.backlog", "gauge", backlog)
+    return sent, failed
+
+
 def send_pending_failure_notification(
     pending_cert, notify_owner=True, notify_security=True, notification_plugin=None
 ):
@@ -289,26 +728,10 @@ def needs_notification(certificate):
     notifications = []
 
     for notification in certificate.notifications:
+        # as in get_due_notifications, inactive notifications do not hold back the others
         if not notification.active or not notification.options:
-            return
-
-        interval = get_plugin_option("interval", notification.options)
-        unit = get_plugin_option("unit", notification.options)
-
-        if unit == "weeks":
-            interval *= 7
-
-        elif unit == "months":
-            interval *= 30
-
-        elif unit == "days":  # it's nice to be explicit about the base unit
-            pass
-
-        else:
-            raise Exception(
-                "Invalid base unit for expiration interval: {0}".format(unit)
-            )
+            continue
 
-        if days == interval:
+        if days == get_notification_interval(notification):
             notifications.append(notification)
     return notifications
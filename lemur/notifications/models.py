@@ -6,8 +6,19 @@
 .. moduleauthor:: Kevin Glisson <kglisson@netflix.com>
 """
 from sqlalchemy.orm import relationship
-from sqlalchemy import Integer, String, Column, Boolean, Text
+from sqlalchemy import (
+    Integer,
+    String,
+    Column,
+    Boolean,
+    Text,
+    ForeignKey,
+    Index,
+    PassiveDefault,
+    func,
+)
 from sqlalchemy_utils import JSONType
+from sqlalchemy_utils.types.arrow import ArrowType
 
 from lemur.database import db
 from lemur.plugins.base import plugins
@@ -46,3 +57,55 @@ class Notification(db.Model):
 
     def __repr__(self):
         return "Notification(label={label})".format(label=self.label)
+
+
+class NotificationMessage(db.Model):
+    """
+    A notification recorded in the outbox, delivered later by the dispatcher.
+
+    Each certificate in the message is keyed by event, notification, targets and day, see
+    `NotificationMessageKey`. A message is `pending` until a dispatcher claims it as `sending`,
+    then ends up `sent` or `failed`.
+    """
+
+    __tablename__ = "notification_outbox"
+    __table_args__ = (
+        Index("ix_notification_outbox_status_next_attempt", "status", "next_attempt"),
+    )
+    id = Column(Integer, primary_key=True)
+    event_type = Column(String(32), nullable=False)
+    plugin_name = Column(String(64), nullable=False)
+    notification_id = Column(
+        Integer, ForeignKey("notifications.id", ondelete="CASCADE"), nullable=True
+    )
+    targets = Column(JSONType)
+    payload = Column(JSONType)
+    status = Column(String(16), PassiveDefault("pending"), nullable=False)
+    attempts = Column(Integer, PassiveDefault("0"), nullable=False)
+    last_error = Column(Text())
+    date_created = Column(ArrowType, PassiveDefault(func.now()), nullable=False)
+    next_attempt = Column(ArrowType, PassiveDefault(func.now()), nullable=False)
+    date_sent = Column(ArrowType)
+
+    notification = relationship("Notification")
+
+    def __repr__(self):
+        return "NotificationMessage(event_type={event_type}, status={status})".format(
+            event_type=self.event_type, status=self.status
+        )
+
+
+class NotificationMessageKey(db.Model):
+    """
+    Records that a certificate was queued for a notification event and targets on a given
+    day. A certificate whose key already exists is left out of later messages that day.
+    """
+
+    __tablename__ = "notification_outbox_keys"
+    dedupe_key = Column(String(64), primary_key=True)
+    message_id = Column(
+        Integer,
+        ForeignKey("notification_outbox.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
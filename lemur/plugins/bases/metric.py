@@ -16,3 +16,11 @@ class MetricPlugin(Plugin):
         self, metric_name, metric_type, metric_value, metric_tags=None, options=None
     ):
         raise NotImplementedError
+
+    def submit_many(self, metrics):
+        """
+        Submits aggregated metrics, a list of (name, type, value, tags) tuples. Plugins that
+        can write several metrics at once should override this.
+        """
+        for metric_name, metric_type, metric_value, metric_tags in metrics:
+            self.submit(metric_name, metric_type, metric_value, metric_tags=metric_tags)
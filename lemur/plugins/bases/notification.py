@@ -6,6 +6,8 @@
 
 .. moduleauthor:: Kevin Glisson <kglisson@netflix.com>
 """
+from contextlib import contextmanager
+
 from lemur.plugins.base import Plugin
 
 
@@ -16,10 +18,20 @@ class NotificationPlugin(Plugin):
     """
 
     type = "notification"
+    # options deciding where a message goes, expiration digests of notifications that differ
+    # in any of them are never merged
+    routing_options = []
 
     def send(self, notification_type, message, targets, options, **kwargs):
         raise NotImplementedError
 
+    @contextmanager
+    def batch(self):
+        """
+        Wraps a run of sends, plugins can override it to reuse a connection across them.
+        """
+        yield
+
 
 class ExpirationNotificationPlugin(NotificationPlugin):
     """
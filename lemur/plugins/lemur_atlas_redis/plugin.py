@@ -7,7 +7,6 @@
 .. moduleauthor:: Jay Zarfoss
 """
 
-from redis import Redis
 import json
 from datetime import datetime
 
@@ -43,18 +42,28 @@ class AtlasMetricRedisPlugin(MetricPlugin):
             "default": "localhost",
         },
         {"name": "redis_port", "type": "int", "required": False, "default": 28527},
+        {
+            "name": "max_queue_length",
+            "type": "int",
+            "required": False,
+            "help_message": "The oldest metrics are dropped once the agent queue grows past this length",
+            "default": 100000,
+        },
     ]
 
-    metric_data = {}
-    redis_host = None
-    redis_port = None
+    queue = "atlas-agent"
 
-    def submit(
-        self, metric_name, metric_type, metric_value, metric_tags=None, options=None
-    ):
-        if not options:
-            options = self.options
+    @staticmethod
+    def client(host, port):
+        # imported here, lemur.common.redis needs an app and plugins are loaded while creating it
+        from lemur.common.redis import RedisHandler
+
+        # the handler keeps one connection pool per (host, port) and process, clients are
+        # not cached here so a forked worker never reuses its parent's pool
+        return RedisHandler(host=host, port=port, db=0, socket_timeout=0.1).redis()
 
+    @staticmethod
+    def payload(metric_name, metric_type, metric_value, metric_tags=None):
         valid_types = ["COUNTER", "GAUGE", "TIMER"]
         if metric_type.upper() not in valid_types:
             raise Exception(
@@ -69,29 +78,75 @@ class AtlasMetricRedisPlugin(MetricPlugin):
                     "Invalid Metric Tags for Atlas: Tags must be in dict format"
                 )
 
-        self.metric_data["timestamp"] = millis_since_epoch()
-        self.metric_data["type"] = metric_type.upper()
-        self.metric_data["name"] = str(metric_name)
-        self.metric_data["tags"] = metric_tags
-
-        if (
+        if not (
             metric_value == "NaN"
             or isinstance(metric_value, int)
             or isinstance(metric_value, float)
         ):
-            self.metric_data["value"] = metric_value
-        else:
             raise Exception("Invalid Metric Value for Atlas: Metric must be a number")
 
-        self.redis_host = self.get_option("redis_host", options)
-        self.redis_port = self.get_option("redis_port", options)
+        return json.dumps(
+            {
+                "timestamp": millis_since_epoch(),
+                "type": metric_type.upper(),
+                "name": str(metric_name),
+                "tags": metric_tags,
+                "value": metric_value,
+            }
+        )
+
+    def submit(
+        self, metric_name, metric_type, metric_value, metric_tags=None, options=None
+    ):
+        self.push(
+            [self.payload(metric_name, metric_type, metric_value, metric_tags)], options
+        )
+
+    def submit_many(self, metrics, options=None):
+        # one invalid metric must not cost the rest of the batch
+        payloads = []
+        for metric in metrics:
+            try:
+                payloads.append(self.payload(*metric))
+            except Exception as e:
+                current_app.logger.warning(
+                    "AtlasMetricsRedis: skipping metric [{metric}]: {exception}".format(
+                        metric=metric[0], exception=e
+                    )
+                )
+
+        if payloads:
+            self.push(payloads, options)
+
+    def push(self, payloads, options=None):
+        """
+        Appends the payloads to the agent queue in one round trip. The queue is then trimmed to
+        `max_queue_length`, dropping the oldest metrics, so a stalled agent can never make
+        Redis, or whoever is sending metrics, wait.
+        """
+        if not options:
+            options = self.options
+
+        host = self.get_option("redis_host", options)
+        port = self.get_option("redis_port", options)
+        max_queue_length = self.get_option("max_queue_length", options)
 
         try:
-            r = Redis(host=self.redis_host, port=self.redis_port, socket_timeout=0.1)
-            r.rpush('atlas-agent', json.dumps(self.metric_data))
+            pipe = self.client(host, port).pipeline(transaction=False)
+            pipe.rpush(self.queue, *payloads)
+            pipe.ltrim(self.queue, -max_queue_length, -1)
+            length, _ = pipe.execute()
         except Exception as e:
             current_app.logger.warning(
-                "AtlasMetricsRedis: exception [{exception}] could not post atlas metrics to AtlasRedis [{host}:{port}], metric [{metricdata}]".format(
-                    exception=e, host=self.redis_host, port=self.redis_port, metricdata=json.dumps(self.metric_data)
+                "AtlasMetricsRedis: exception [{exception}] could not post {count} atlas metrics to AtlasRedis [{host}:{port}]".format(
+                    exception=e, count=len(payloads), host=host, port=port
+                )
+            )
+            return
+
+        if length > max_queue_length:
+            current_app.logger.warning(
+                "AtlasMetricsRedis: queue [{host}:{port}] is full, dropped the {count} oldest metrics".format(
+                    host=host, port=port, count=length - max_queue_length
                 )
             )
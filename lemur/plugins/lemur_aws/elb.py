@@ -5,6 +5,8 @@
 
 .. moduleauthor:: Kevin Glisson <kglisson@netflix.com>
 """
+import threading
+
 import botocore
 from flask import current_app
 
@@ -36,9 +38,39 @@ def retry_throttled(exception):
 
         if exception.response["Error"]["Code"] == "CertificateNotFound":
             return False
+
+    budget = getattr(scan_state, "budget", None)
+    if budget and not budget.consume():
+        metrics.send("elb_retry_budget_exhausted", "counter", 1)
+        return False
     return True
 
 
+class RetryBudget(object):
+    """
+    Number of retries shared by every thread of a concurrent scan.
+
+    Without it each worker retries independently, so N threads hitting the account's
+    rate limit would keep it saturated with N times the retries. Once the budget is spent
+    further failures are raised instead of retried.
+    """
+
+    def __init__(self, retries):
+        self.lock = threading.Lock()
+        self.remaining = retries
+
+    def consume(self):
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+# per thread pointer to the budget of the scan the thread is working for
+scan_state = threading.local()
+
+
 def is_valid(listener_tuple):
     """
     There are a few rules that aws has when creating listeners,
@@ -151,9 +151,16 @@ def get_certificates(**kwargs):
 def get_all_certificates(**kwargs):
     """
     Use STS to fetch all of the SSL certificates from a given account
+
+    When `known_names` and `last_run` are given, certificates whose name is in `known_names`
+    and which were uploaded before `last_run` are left out without fetching their body, IAM
+    certificates cannot change without being uploaded again.
     """
     certificates = []
     account_number = kwargs.get("account_number")
+    known_names = kwargs.pop("known_names", None) or set()
+    last_run = kwargs.pop("last_run", None)
+    skipped = 0
     metrics.send(
         "get_all_certificates",
         "counter",
@@ -166,6 +173,14 @@ def get_all_certificates(**kwargs):
         metadata = response["ServerCertificateMetadataList"]
 
         for m in metadata:
+            if (
+                last_run
+                and m["ServerCertificateName"] in known_names
+                and m["UploadDate"] < last_run
+            ):
+                skipped += 1
+                continue
+
             certificates.append(
                 get_certificate(
                     m["ServerCertificateName"], account_number=account_number
@@ -173,6 +188,12 @@ def get_all_certificates(**kwargs):
             )
 
         if not response.get("Marker"):
+            metrics.send(
+                "get_all_certificates_skipped",
+                "gauge",
+                skipped,
+                metric_tags={"account_number": account_number},
+            )
             return certificates
         else:
             kwargs.update(dict(Marker=response["Marker"]))
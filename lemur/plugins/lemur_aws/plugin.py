@@ -32,6 +32,8 @@
 .. moduleauthor:: Mikhail Khodorovskiy <mikhail.khodorovskiy@jivesoftware.com>
 .. moduleauthor:: Harm Weites <harm@weites.com>
 """
+from concurrent.futures import ThreadPoolExecutor
+
 from acme.errors import ClientError
 from flask import current_app
 from lemur.extensions import sentry, metrics
@@ -90,19 +92,36 @@ def format_elb_cipher_policy(policy):
 def get_elb_endpoints(account_number, region, elb_dict):
     """
     Retrieves endpoint information from elb response data.
+
+    The policies of all secure listeners are described with a single call per load balancer.
     :param account_number:
     :param region:
     :param elb_dict:
     :return:
     """
-    endpoints = []
-    for listener in elb_dict["ListenerDescriptions"]:
-        if not listener["Listener"].get("SSLCertificateId"):
-            continue
+    listeners = [
+        listener
+        for listener in elb_dict["ListenerDescriptions"]
+        if listener["Listener"].get("SSLCertificateId")
+        and listener["Listener"]["SSLCertificateId"] != "Invalid-Certificate"
+    ]
 
-        if listener["Listener"]["SSLCertificateId"] == "Invalid-Certificate":
-            continue
+    policies = {}
+    policy_names = sorted(
+        set(name for listener in listeners for name in listener["PolicyNames"])
+    )
+    if policy_names:
+        response = elb.describe_load_balancer_policies(
+            elb_dict["LoadBalancerName"],
+            policy_names,
+            account_number=account_number,
+            region=region,
+        )
+        for descr in response["PolicyDescriptions"]:
+            policies[descr["PolicyName"]] = descr
 
+    endpoints = []
+    for listener in listeners:
         endpoint = dict(
             name=elb_dict["LoadBalancerName"],
             dnsname=elb_dict["DNSName"],
@@ -114,11 +133,12 @@ def get_elb_endpoints(account_number, region, elb_dict):
         )
 
         if listener["PolicyNames"]:
-            policy = elb.describe_load_balancer_policies(
-                elb_dict["LoadBalancerName"],
-                listener["PolicyNames"],
-                account_number=account_number,
-                region=region,
+            policy = dict(
+                PolicyDescriptions=[
+                    policies[name]
+                    for name in listener["PolicyNames"]
+                    if name in policies
+                ]
             )
             endpoint["policy"] = format_elb_cipher_policy(policy)
 
@@ -129,20 +149,47 @@ def get_elb_endpoints(account_number, region, elb_dict):
     return endpoints
 
 
-def get_elb_endpoints_v2(account_number, region, elb_dict):
+def get_elb_endpoints_v2(account_number, region, elb_dict, policies=None):
     """
     Retrieves endpoint information from elbv2 response data.
+
+    ELBv2 listeners can only use predefined SSL policies, so formatted policies are kept in
+    `policies` by name. Passing the same dict for every load balancer of a region means each
+    policy is described once per region, and those still missing are described in one call.
     :param account_number:
     :param region:
     :param elb_dict:
+    :param policies:
     :return:
     """
+    if policies is None:
+        policies = {}
+
     endpoints = []
     listeners = elb.describe_listeners_v2(
         account_number=account_number,
         region=region,
         LoadBalancerArn=elb_dict["LoadBalancerArn"],
     )
+
+    missing = sorted(
+        set(
+            listener["SslPolicy"]
+            for listener in listeners["Listeners"]
+            if listener.get("Certificates")
+            and listener["SslPolicy"]
+            and listener["SslPolicy"] not in policies
+        )
+    )
+    if missing:
+        response = elb.describe_ssl_policies_v2(
+            missing, account_number=account_number, region=region
+        )
+        for descr in response["SslPolicies"]:
+            policies[descr["Name"]] = format_elb_cipher_policy_v2(
+                dict(SslPolicies=[descr])
+            )
+
     for listener in listeners["Listeners"]:
         if not listener.get("Certificates"):
             continue
@@ -157,16 +204,78 @@ def get_elb_endpoints_v2(account_number, region, elb_dict):
             )
 
         if listener["SslPolicy"]:
-            policy = elb.describe_ssl_policies_v2(
-                [listener["SslPolicy"]], account_number=account_number, region=region
-            )
-            endpoint["policy"] = format_elb_cipher_policy_v2(policy)
+            # every endpoint gets its own copy, callers rewrite the ciphers in place
+            policy = policies.get(listener["SslPolicy"], dict(name=None, ciphers=[]))
+            endpoint["policy"] = dict(policy, ciphers=list(policy["ciphers"]))
 
         endpoints.append(endpoint)
 
     return endpoints
 
 
+def get_region_endpoints(account_number, region, generation):
+    """
+    Retrieves the endpoints of one generation ("elb" or "elbv2") of load balancers in a region.
+    :param account_number:
+    :param region:
+    :param generation:
+    :return:
+    """
+    endpoints = []
+    if generation == "elb":
+        elbs = elb.get_all_elbs(account_number=account_number, region=region)
+        current_app.logger.info(
+            "Describing classic load balancers in {0}-{1}".format(
+                account_number, region
+            )
+        )
+
+        for e in elbs:
+            endpoints.extend(get_elb_endpoints(account_number, region, e))
+    else:
+        # fetch advanced ELBs
+        elbs_v2 = elb.get_all_elbs_v2(account_number=account_number, region=region)
+        current_app.logger.info(
+            "Describing advanced load balancers in {0}-{1}".format(
+                account_number, region
+            )
+        )
+
+        policies = {}
+        for e in elbs_v2:
+            endpoints.extend(
+                get_elb_endpoints_v2(account_number, region, e, policies=policies)
+            )
+
+    return endpoints
+
+
+def get_region_endpoints_concurrently(account_number, scans, concurrency):
+    """
+    Runs get_region_endpoints for each (region, generation) on a bounded thread pool.
+    Results are returned in the order of `scans` regardless of completion order, and
+    all workers draw their throttling retries from one shared budget.
+    :param account_number:
+    :param scans:
+    :param concurrency:
+    :return:
+    """
+    app = current_app._get_current_object()
+    budget = elb.RetryBudget(current_app.config.get("LEMUR_AWS_RETRY_BUDGET", 100))
+
+    def scan(region, generation):
+        with app.app_context():
+            elb.scan_state.budget = budget
+            try:
+                return get_region_endpoints(account_number, region, generation)
+            finally:
+                elb.scan_state.budget = None
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(scans))) as pool:
+        futures = [pool.submit(scan, region, generation) for region, generation in scans]
+        return [future.result() for future in futures]
+
+
 class AWSSourcePlugin(SourcePlugin):
     title = "AWS"
     slug = "aws-source"
@@ -189,11 +298,21 @@ class AWSSourcePlugin(SourcePlugin):
             "type": "str",
             "helpMessage": "Comma separated list of regions to search in, if no region is specified we look in all regions.",
         },
+        {
+            "name": "regionConcurrency",
+            "type": "int",
+            "required": False,
+            "validation": "^\\d+$",
+            "default": "1",
+            "helpMessage": "Number of regions and load balancer types to describe in parallel, 1 scans them one at a time.",
+        },
     ]
 
     def get_certificates(self, options, **kwargs):
         cert_data = iam.get_all_certificates(
-            account_number=self.get_option("accountNumber", options)
+            account_number=self.get_option("accountNumber", options),
+            known_names=kwargs.get("known_names"),
+            last_run=kwargs.get("last_run"),
         )
         return [
             dict(
@@ -214,27 +333,19 @@ class AWSSourcePlugin(SourcePlugin):
         else:
             regions = "".join(regions.split()).split(",")
 
-        for region in regions:
-            elbs = elb.get_all_elbs(account_number=account_number, region=region)
-            current_app.logger.info(
-                "Describing classic load balancers in {0}-{1}".format(
-                    account_number, region
-                )
-            )
-
-            for e in elbs:
-                endpoints.extend(get_elb_endpoints(account_number, region, e))
+        scans = [(region, generation) for region in regions for generation in ["elb", "elbv2"]]
+        concurrency = int(self.get_option("regionConcurrency", options) or 1)
 
-            # fetch advanced ELBs
-            elbs_v2 = elb.get_all_elbs_v2(account_number=account_number, region=region)
-            current_app.logger.info(
-                "Describing advanced load balancers in {0}-{1}".format(
-                    account_number, region
-                )
-            )
+        if concurrency > 1 and len(scans) > 1:
+            results = get_region_endpoints_concurrently(account_number, scans, concurrency)
+        else:
+            results = [
+                get_region_endpoints(account_number, region, generation)
+                for region, generation in scans
+            ]
 
-            for e in elbs_v2:
-                endpoints.extend(get_elb_endpoints_v2(account_number, region, e))
+        for result in results:
+            endpoints.extend(result)
 
         return endpoints
 
@@ -5,6 +5,8 @@
     :license: Apache, see LICENSE for more details.
 .. moduleauthor:: Kevin Glisson <kglisson@netflix.com>
 """
+import threading
+from datetime import datetime, timedelta, timezone
 from functools import wraps
 
 import boto3
@@ -12,43 +14,172 @@ import boto3
 from botocore.config import Config
 from flask import current_app
 
+from lemur.extensions import metrics
+
 
 config = Config(retries=dict(max_attempts=20))
 
 
+class CredentialCache(object):
+    """
+    Process wide cache of assumed role credentials and the boto3 clients built from them.
+
+    Credentials are kept per (account, role) and refreshed ``LEMUR_STS_REFRESH_SECONDS``
+    before their ``Expiration``. Clients are kept per (account, role, region, service) and
+    rebuilt whenever the credentials behind them are refreshed. A built client may be shared
+    between threads, but building one through boto3's default session is not thread safe, so
+    every client and resource is built from its own session. Resources may not be shared at
+    all and are built fresh from the cached credentials on each call.
+    """
+
+    default_refresh = 300
+
+    def __init__(self):
+        # guards the dicts below only, it is never held across a network call
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.credentials = {}
+        self.clients = {}
+
+    def clear(self):
+        with self.lock:
+            self.credentials.clear()
+            self.clients.clear()
+
+    def key_lock(self, key):
+        """
+        Returns the lock serializing refreshes of one cache entry, so threads working with
+        other accounts or roles never wait on it.
+        """
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def is_fresh(self, credentials):
+        refresh = timedelta(
+            seconds=current_app.config.get(
+                "LEMUR_STS_REFRESH_SECONDS", self.default_refresh
+            )
+        )
+        return credentials and credentials["Expiration"] - refresh > datetime.now(
+            timezone.utc
+        )
+
+    def get_credentials(self, account_number, role):
+        """
+        Returns valid credentials for the role, assuming it only if the cached ones are
+        missing or about to expire.
+
+        :param account_number:
+        :param role:
+        :return:
+        """
+        key = (account_number, role)
+        status = "hit"
+
+        credentials = self.credentials.get(key)
+        if not self.is_fresh(credentials):
+            with self.key_lock(key):
+                # another thread may have refreshed them while we waited
+                credentials = self.credentials.get(key)
+                if not self.is_fresh(credentials):
+                    sts = boto3.session.Session().client("sts", config=config)
+                    arn = "arn:aws:iam::{0}:role/{1}".format(account_number, role)
+
+                    # TODO add user specific information to RoleSessionName
+                    credentials = sts.assume_role(RoleArn=arn, RoleSessionName="lemur")[
+                        "Credentials"
+                    ]
+                    with self.lock:
+                        self.credentials[key] = credentials
+                    status = "refresh"
+
+        metrics.send(
+            "sts.credentials",
+            "counter",
+            1,
+            metric_tags={"status": status, "account_number": account_number},
+        )
+        return credentials
+
+    def session(self, credentials):
+        """
+        Returns a new boto3 session for the credentials, the shared default session must not
+        be used from several threads at once.
+
+        :param credentials:
+        :return:
+        """
+        return boto3.session.Session(
+            aws_access_key_id=credentials["AccessKeyId"],
+            aws_secret_access_key=credentials["SecretAccessKey"],
+            aws_session_token=credentials["SessionToken"],
+        )
+
+    def get_client(self, service, account_number, role, region):
+        """
+        Returns a client for the service, reusing the cached one while its credentials
+        are still current.
+
+        :param service:
+        :param account_number:
+        :param role:
+        :param region:
+        :return:
+        """
+        credentials = self.get_credentials(account_number, role)
+        key = (account_number, role, region, service)
+
+        cached = self.clients.get(key)
+        if cached and cached[0] == credentials["AccessKeyId"]:
+            return cached[1]
+
+        with self.key_lock(key):
+            cached = self.clients.get(key)
+            if cached and cached[0] == credentials["AccessKeyId"]:
+                return cached[1]
+
+            client = self.session(credentials).client(
+                service, region_name=region, config=config
+            )
+            with self.lock:
+                self.clients[key] = (credentials["AccessKeyId"], client)
+            return client
+
+    def get_resource(self, service, account_number, role, region):
+        """
+        Returns a new resource for the service built from the cached credentials.
+
+        :param service:
+        :param account_number:
+        :param role:
+        :param region:
+        :return:
+        """
+        credentials = self.get_credentials(account_number, role)
+        return self.session(credentials).resource(
+            service, region_name=region, config=config
+        )
+
+
+sts_cache = CredentialCache()
+
+
 def sts_client(service, service_type="client"):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            sts = boto3.client("sts", config=config)
-            arn = "arn:aws:iam::{0}:role/{1}".format(
-                kwargs.pop("account_number"),
-                current_app.config.get("LEMUR_INSTANCE_PROFILE", "Lemur"),
-            )
-
-            # TODO add user specific information to RoleSessionName
-            role = sts.assume_role(RoleArn=arn, RoleSessionName="lemur")
+            account_number = kwargs.pop("account_number")
+            role = current_app.config.get("LEMUR_INSTANCE_PROFILE", "Lemur")
+            region = kwargs.pop("region", "us-east-1")
 
             if service_type == "client":
-                client = boto3.client(
-                    service,
-                    region_name=kwargs.pop("region", "us-east-1"),
-                    aws_access_key_id=role["Credentials"]["AccessKeyId"],
-                    aws_secret_access_key=role["Credentials"]["SecretAccessKey"],
-                    aws_session_token=role["Credentials"]["SessionToken"],
-                    config=config,
+                kwargs["client"] = sts_cache.get_client(
+                    service, account_number, role, region
                 )
-                kwargs["client"] = client
             elif service_type == "resource":
-                resource = boto3.resource(
-                    service,
-                    region_name=kwargs.pop("region", "us-east-1"),
-                    aws_access_key_id=role["Credentials"]["AccessKeyId"],
-                    aws_secret_access_key=role["Credentials"]["SecretAccessKey"],
-                    aws_session_token=role["Credentials"]["SessionToken"],
-                    config=config,
+                kwargs["resource"] = sts_cache.get_resource(
+                    service, account_number, role, region
                 )
-                kwargs["resource"] = resource
             return f(*args, **kwargs)
 
         return decorated_function
@@ -1 +1,11 @@
 from lemur.tests.conftest import *  # noqa
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def clear_sts_cache():
+    from lemur.plugins.lemur_aws.sts import sts_cache
+
+    sts_cache.clear()
+    yield
+    sts_cache.clear()
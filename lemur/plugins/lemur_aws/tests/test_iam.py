@@ -24,3 +24,27 @@ def test_get_all_server_certs(app):
     upload_cert("123456789012", "testCert", EXTERNAL_VALID_STR, SAN_CERT_KEY)
     certs = get_all_certificates("123456789012")
     assert len(certs) == 1
+
+
+def test_get_all_certificates_incremental(app):
+    from datetime import datetime, timedelta, timezone
+    from mock import patch
+    from lemur.plugins.lemur_aws.iam import get_all_certificates
+
+    last_run = datetime.now(timezone.utc)
+    metadata = {
+        "ServerCertificateMetadataList": [
+            {"ServerCertificateName": "known", "UploadDate": last_run - timedelta(days=30)},
+            {"ServerCertificateName": "reuploaded", "UploadDate": last_run + timedelta(minutes=1)},
+            {"ServerCertificateName": "new", "UploadDate": last_run - timedelta(days=30)},
+        ]
+    }
+
+    with patch("lemur.plugins.lemur_aws.iam.get_certificates", return_value=metadata), \
+            patch("lemur.plugins.lemur_aws.iam.get_certificate", side_effect=lambda name, **kwargs: name):
+        assert get_all_certificates(account_number="123456789012") == ["known", "reuploaded", "new"]
+        assert get_all_certificates(
+            account_number="123456789012",
+            known_names={"known", "reuploaded"},
+            last_run=last_run,
+        ) == ["reuploaded", "new"]
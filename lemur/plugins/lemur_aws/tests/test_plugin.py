@@ -1,5 +1,95 @@
+import boto3
+from moto import mock_sts, mock_elb, mock_elbv2
+
+
 def test_get_certificates(app):
     from lemur.plugins.base import plugins
 
     p = plugins.get("aws-s3")
     assert p
+
+
+@mock_sts()
+@mock_elb()
+@mock_elbv2()
+def test_get_endpoints_concurrently(app, aws_credentials):
+    from lemur.plugins.base import plugins
+
+    for region in ["us-east-1", "us-west-2"]:
+        boto3.client("elb", region_name=region).create_load_balancer(
+            LoadBalancerName="example-lb-{}".format(region),
+            Listeners=[
+                {
+                    "Protocol": "https",
+                    "LoadBalancerPort": 443,
+                    "InstanceProtocol": "tcp",
+                    "InstancePort": 5443,
+                    "SSLCertificateId": "cert-{}".format(region),
+                }
+            ],
+        )
+
+    p = plugins.get("aws-source")
+    options = [
+        {"name": "accountNumber", "value": "123456789012"},
+        {"name": "regions", "value": "us-east-1,us-west-2"},
+    ]
+    serial = p.get_endpoints(options)
+    concurrent = p.get_endpoints(options + [{"name": "regionConcurrency", "value": 4}])
+
+    assert [e["certificate_name"] for e in serial] == ["cert-us-east-1", "cert-us-west-2"]
+    assert concurrent == serial
+
+
+def test_get_elb_endpoints_batches_policies(app):
+    from mock import patch
+    from lemur.plugins.lemur_aws.plugin import get_elb_endpoints, get_elb_endpoints_v2
+
+    elb_dict = {
+        "LoadBalancerName": "example-lb",
+        "DNSName": "example-lb.us-east-1.elb.amazonaws.com",
+        "ListenerDescriptions": [
+            {
+                "Listener": {"LoadBalancerPort": port, "SSLCertificateId": "arn/cert"},
+                "PolicyNames": ["policy-{}".format(port)],
+            }
+            for port in [443, 8443]
+        ],
+    }
+    policies = {
+        "PolicyDescriptions": [
+            {
+                "PolicyName": "policy-{}".format(port),
+                "PolicyAttributeDescriptions": [
+                    {"AttributeName": "Reference-Security-Policy", "AttributeValue": "ref-{}".format(port)}
+                ],
+            }
+            for port in [443, 8443]
+        ]
+    }
+    with patch("lemur.plugins.lemur_aws.elb.describe_load_balancer_policies", return_value=policies) as describe:
+        endpoints = get_elb_endpoints("123456789012", "us-east-1", elb_dict)
+    assert describe.call_count == 1
+    assert [e["policy"]["name"] for e in endpoints] == ["ref-443", "ref-8443"]
+
+    listeners = {
+        "Listeners": [
+            {"Port": 443, "SslPolicy": "ELBSecurityPolicy-2016-08", "Certificates": [{"CertificateArn": "arn/cert"}]}
+        ]
+    }
+    ssl_policies = {"SslPolicies": [{"Name": "ELBSecurityPolicy-2016-08", "Ciphers": [{"Name": "AES128-SHA"}]}]}
+    elb_dict = {"LoadBalancerName": "example-lb", "DNSName": "example-lb", "LoadBalancerArn": "arn/lb"}
+    cache = {}
+    with patch("lemur.plugins.lemur_aws.elb.describe_listeners_v2", return_value=listeners), \
+            patch("lemur.plugins.lemur_aws.elb.describe_ssl_policies_v2", return_value=ssl_policies) as describe:
+        endpoints = [
+            get_elb_endpoints_v2("123456789012", "us-east-1", elb_dict, policies=cache)[0]
+            for _ in range(3)
+        ]
+    assert describe.call_count == 1
+    assert endpoints[0]["policy"] == dict(name="ELBSecurityPolicy-2016-08", ciphers=["AES128-SHA"])
+
+    # sync_endpoints rewrites the ciphers of each endpoint, the cached policy must not change
+    endpoints[0]["policy"]["ciphers"] = ["rewritten"]
+    assert endpoints[1]["policy"]["ciphers"] == ["AES128-SHA"]
+    assert cache["ELBSecurityPolicy-2016-08"]["ciphers"] == ["AES128-SHA"]
@@ -0,0 +1,65 @@
+from moto import mock_sts
+
+
+@mock_sts()
+def test_sts_client_cached(app, aws_credentials):
+    from datetime import datetime, timedelta, timezone
+    from lemur.plugins.lemur_aws.sts import sts_cache, sts_client
+
+    @sts_client("elb")
+    def get_client(**kwargs):
+        return kwargs["client"]
+
+    client = get_client(account_number="123456789012", region="us-east-1")
+    assert get_client(account_number="123456789012", region="us-east-1") is client
+    assert get_client(account_number="123456789012", region="us-west-2") is not client
+
+    # credentials about to expire are refreshed and the client rebuilt
+    for credentials in sts_cache.credentials.values():
+        credentials["Expiration"] = datetime.now(timezone.utc) + timedelta(seconds=60)
+        credentials["AccessKeyId"] = "expiring"
+    assert get_client(account_number="123456789012", region="us-east-1") is not client
+
+
+def test_sts_refresh_does_not_block_other_accounts(app):
+    import threading
+    from datetime import datetime, timedelta, timezone
+    from mock import Mock, patch
+    from lemur.plugins.lemur_aws.sts import sts_cache
+
+    slow_account_waiting = threading.Event()
+    release_slow_account = threading.Event()
+
+    def assume_role(RoleArn, RoleSessionName):
+        if "111111111111" in RoleArn:
+            slow_account_waiting.set()
+            release_slow_account.wait(5)
+        return {
+            "Credentials": {
+                "AccessKeyId": RoleArn,
+                "Expiration": datetime.now(timezone.utc) + timedelta(hours=1),
+            }
+        }
+
+    sts = Mock(assume_role=Mock(side_effect=assume_role))
+    with patch(
+        "lemur.plugins.lemur_aws.sts.boto3.session.Session",
+        return_value=Mock(client=Mock(return_value=sts)),
+    ):
+        def refresh_slow_account():
+            with app.app_context():
+                sts_cache.get_credentials("111111111111", "Lemur")
+
+        slow = threading.Thread(target=refresh_slow_account)
+        slow.start()
+        assert slow_account_waiting.wait(5)
+
+        # answered while the other account's STS call is still in flight
+        assert sts_cache.get_credentials("222222222222", "Lemur")["AccessKeyId"].endswith(
+            "222222222222:role/Lemur"
+        )
+        assert slow.is_alive()
+
+        release_slow_account.set()
+        slow.join(5)
+    assert sts.assume_role.call_count == 2
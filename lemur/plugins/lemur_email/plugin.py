@@ -6,11 +6,17 @@
 
 .. moduleauthor:: Kevin Glisson <kglisson@netflix.com>
 """
+import smtplib
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
 import boto3
 from flask import current_app
 from flask_mail import Message
 
-from lemur.extensions import smtp_mail
+from lemur.extensions import metrics, smtp_mail
 from lemur.exceptions import InvalidConfiguration
 
 from lemur.plugins.bases import ExpirationNotificationPlugin
@@ -33,6 +39,66 @@ def render_html(template_name, message):
     )
 
 
+class Delivery(object):
+    """
+    Delivers every email of a notification run over one SMTP connection, or one SES client.
+
+    The SMTP connection is opened on the first message and reopened once if the server drops
+    it. Messages sent and throughput are reported when the run ends.
+    """
+
+    def __init__(self, sender):
+        self.sender = sender
+        self.connection = None
+        self.client = None
+        self.sent = 0
+        self.start = time.time()
+
+    def send_smtp(self, msg):
+        for attempt in range(2):
+            try:
+                if self.connection is None:
+                    connection = smtp_mail.connect()
+                    connection.__enter__()
+                    self.connection = connection
+                self.connection.send(msg)
+                break
+            except (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout):
+                self.disconnect()
+                if attempt:
+                    raise
+        self.sent += 1
+
+    def ses_client(self):
+        if self.client is None:
+            self.client = boto3.client("ses", region_name="us-east-1")
+        return self.client
+
+    def disconnect(self):
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError):
+                pass
+
+    def close(self):
+        self.disconnect()
+        elapsed = max(time.time() - self.start, 1)
+        metrics.send(
+            "email_delivery.sent", "counter", self.sent, metric_tags={"sender": self.sender}
+        )
+        metrics.send(
+            "email_delivery.throughput",
+            "gauge",
+            self.sent / elapsed,
+            metric_tags={"sender": self.sender},
+        )
+
+
+delivery = threading.local()
+
+
 def send_via_smtp(subject, body, targets):
     """
     Attempts to deliver email notification via SES service.
@@ -47,7 +113,12 @@ def send_via_smtp(subject, body, targets):
     )
     msg.body = ""  # kinda a weird api for sending html emails
     msg.html = body
-    smtp_mail.send(msg)
+
+    batch = getattr(delivery, "batch", None)
+    if batch is not None:
+        batch.send_smtp(msg)
+    else:
+        smtp_mail.send(msg)
 
 
 def send_via_ses(subject, body, targets):
@@ -58,7 +129,12 @@ def send_via_ses(subject, body, targets):
     :param targets:
     :return:
     """
-    client = boto3.client("ses", region_name="us-east-1")
+    batch = getattr(delivery, "batch", None)
+    if batch is not None:
+        client = batch.ses_client()
+    else:
+        client = boto3.client("ses", region_name="us-east-1")
+
     client.send_email(
         Source=current_app.config.get("LEMUR_EMAIL"),
         Destination={"ToAddresses": targets},
@@ -68,6 +144,9 @@ def send_via_ses(subject, body, targets):
         },
     )
 
+    if batch is not None:
+        batch.sent += 1
+
 
 class EmailNotificationPlugin(ExpirationNotificationPlugin):
     title = "Email"
@@ -95,6 +174,23 @@ class EmailNotificationPlugin(ExpirationNotificationPlugin):
         if sender not in ["ses", "smtp"]:
             raise InvalidConfiguration("Email sender type {0} is not recognized.")
 
+    @staticmethod
+    @contextmanager
+    def batch():
+        """Sends the emails of the enclosed block over a single connection."""
+        if getattr(delivery, "batch", None) is not None:
+            yield
+            return
+
+        delivery.batch = Delivery(
+            current_app.config.get("LEMUR_EMAIL_SENDER", "ses").lower()
+        )
+        try:
+            yield
+        finally:
+            delivery.batch.close()
+            delivery.batch = None
+
     @staticmethod
     def send(notification_type, message, targets, options, **kwargs):
 
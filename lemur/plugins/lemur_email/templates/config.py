@@ -5,9 +5,12 @@ from jinja2 import Environment, FileSystemLoader, select_autoescape
 from lemur.plugins.utils import get_plugin_option
 
 loader = FileSystemLoader(searchpath=os.path.dirname(os.path.realpath(__file__)))
+# templates ship with Lemur and never change at runtime, so compiled templates are served
+# from the environment's cache without checking the files again
 env = Environment(
     loader=loader,  # nosec: potentially dangerous types esc.
     autoescape=select_autoescape(["html", "xml"]),
+    auto_reload=False,
 )
 
 
@@ -23,6 +26,14 @@ def unit(options):
     return get_plugin_option("unit", options)
 
 
+def merged(certificates):
+    """
+    Whether an expiration digest lists certificates due under several notifications.
+    """
+    return len(set((c.get("notification") or {}).get("label") for c in certificates)) > 1
+
+
 env.filters["time"] = human_time
 env.filters["interval"] = interval
 env.filters["unit"] = unit
+env.filters["merged"] = merged
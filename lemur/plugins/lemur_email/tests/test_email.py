@@ -23,6 +23,19 @@ def test_render(certificate, endpoint):
     template = env.get_template("{}.html".format("expiration"))
 
     body = template.render(dict(message=data, hostname="lemur.test.example.com"))
+    assert "expiring in 10 days" in body
+
+    # a digest merging notifications names each certificate's notification instead
+    data["certificates"] = [
+        dict(
+            data["certificates"][0],
+            notification=dict(label=label, interval=interval, unit=unit),
+        )
+        for label, interval, unit in [("first", 10, "days"), ("second", 2, "weeks")]
+    ]
+    body = template.render(dict(message=data, hostname="lemur.test.example.com"))
+    assert "expiring soon" in body
+    assert "second: 2 weeks notice" in body
 
     template = env.get_template("{}.html".format("rotation"))
 
@@ -34,3 +47,31 @@ def test_render(certificate, endpoint):
             hostname="lemur.test.example.com",
         )
     )
+
+
+def test_batch_reuses_smtp_connection(app):
+    from mock import patch
+    from lemur.extensions import smtp_mail
+    from lemur.plugins.lemur_email.plugin import EmailNotificationPlugin, send_via_smtp
+
+    with patch.object(smtp_mail, "connect", wraps=smtp_mail.connect) as connect:
+        with smtp_mail.record_messages() as outbox:
+            with EmailNotificationPlugin.batch():
+                send_via_smtp("subject", "body", ["a@example.com"])
+                send_via_smtp("subject", "body", ["b@example.com"])
+
+    assert connect.call_count == 1
+    assert [m.recipients for m in outbox] == [["a@example.com"], ["b@example.com"]]
+
+
+def test_batch_reuses_ses_client(app):
+    from mock import patch
+    from lemur.plugins.lemur_email.plugin import EmailNotificationPlugin, send_via_ses
+
+    with patch("lemur.plugins.lemur_email.plugin.boto3.client") as client:
+        with EmailNotificationPlugin.batch():
+            send_via_ses("subject", "body", ["a@example.com"])
+            send_via_ses("subject", "body", ["b@example.com"])
+
+    assert client.call_count == 1
+    assert client.return_value.send_email.call_count == 2
@@ -8,6 +8,9 @@
 .. moduleauthor:: Kevin Glisson <kglisson@netflix.com>
 """
 import json
+import threading
+from contextlib import contextmanager
+
 import arrow
 from flask import current_app
 from lemur.plugins.bases import ExpirationNotificationPlugin
@@ -22,35 +25,66 @@ def create_certificate_url(name):
     )
 
 
+def create_expiration_attachment(certificate):
+    attachment = {
+        "title": certificate["name"],
+        "title_link": create_certificate_url(certificate["name"]),
+        "color": "danger",
+        "fallback": "",
+        "fields": [
+            {"title": "Owner", "value": certificate["owner"], "short": True},
+            {
+                "title": "Expires",
+                "value": arrow.get(certificate["validityEnd"]).format(
+                    "dddd, MMMM D, YYYY"
+                ),
+                "short": True,
+            },
+            {
+                "title": "Endpoints Detected",
+                "value": len(certificate["endpoints"]),
+                "short": True,
+            },
+        ],
+        "text": "",
+        "mrkdwn_in": ["text"],
+    }
+    # the notification the certificate is due under, see send_expiration_notifications
+    notification = certificate.get("notification")
+    if notification:
+        attachment["fields"].append(
+            {"title": "Notification", "value": notification["label"], "short": True}
+        )
+    return attachment
+
+
+# attachments built during the current notification run, see SlackNotificationPlugin.batch
+run = threading.local()
+
+
 def create_expiration_attachments(certificates):
-    attachments = []
+    """
+    Builds the attachments for a list of certificate notification payloads. Within a
+    notification run an attachment is built once for a certificate showing up in the
+    owner, recipients and security messages, and only serialized by `send`.
+    """
+    attachments = getattr(run, "attachments", None)
+    if attachments is None:
+        return [create_expiration_attachment(c) for c in certificates]
+
+    result = []
     for certificate in certificates:
-        attachments.append(
-            {
-                "title": certificate["name"],
-                "title_link": create_certificate_url(certificate["name"]),
-                "color": "danger",
-                "fallback": "",
-                "fields": [
-                    {"title": "Owner", "value": certificate["owner"], "short": True},
-                    {
-                        "title": "Expires",
-                        "value": arrow.get(certificate["validityEnd"]).format(
-                            "dddd, MMMM D, YYYY"
-                        ),
-                        "short": True,
-                    },
-                    {
-                        "title": "Endpoints Detected",
-                        "value": len(certificate["endpoints"]),
-                        "short": True,
-                    },
-                ],
-                "text": "",
-                "mrkdwn_in": ["text"],
-            }
+        key = (
+            certificate["name"],
+            certificate["owner"],
+            certificate["validityEnd"],
+            len(certificate["endpoints"]),
+            (certificate.get("notification") or {}).get("label"),
         )
-    return attachments
+        if key not in attachments:
+            attachments[key] = create_expiration_attachment(certificate)
+        result.append(attachments[key])
+    return result
 
 
 def create_rotation_attachments(certificate):
@@ -91,6 +125,9 @@ class SlackNotificationPlugin(ExpirationNotificationPlugin):
     author = "Harm Weites"
     author_url = "https://github.com/netflix/lemur"
 
+    # the channel comes from the options, not from the targets
+    routing_options = ["webhook", "username", "recipients"]
+
     additional_options = [
         {
             "name": "webhook",
@@ -115,6 +152,20 @@ class SlackNotificationPlugin(ExpirationNotificationPlugin):
         },
     ]
 
+    @staticmethod
+    @contextmanager
+    def batch():
+        """Builds each certificate's attachment once for the messages of the enclosed block."""
+        if getattr(run, "attachments", None) is not None:
+            yield
+            return
+
+        run.attachments = {}
+        try:
+            yield
+        finally:
+            run.attachments = None
+
     def send(self, notification_type, message, targets, options, **kwargs):
         """
         A typical check can be performed using the notify command:
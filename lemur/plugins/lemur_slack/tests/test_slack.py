@@ -21,3 +21,21 @@ def test_formatting(certificate):
     }
 
     assert attachment == create_expiration_attachments(data)[0]
+
+
+def test_attachments_are_shared_within_a_run(certificate):
+    from lemur.plugins.lemur_slack.plugin import (
+        SlackNotificationPlugin,
+        create_expiration_attachments,
+    )
+    from lemur.certificates.schemas import certificate_notification_output_schema
+
+    data = certificate_notification_output_schema.dump(certificate).data
+
+    with SlackNotificationPlugin.batch():
+        owner = create_expiration_attachments([data])[0]
+        security = create_expiration_attachments([data])[0]
+    assert owner is security
+
+    # nothing is kept once the run is over
+    assert create_expiration_attachments([data])[0] is not owner
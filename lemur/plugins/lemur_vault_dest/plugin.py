@@ -20,7 +20,6 @@ from lemur.plugins.bases import DestinationPlugin
 from lemur.plugins.bases import SourcePlugin
 
 from cryptography import x509
-from cryptography.hazmat.backends import default_backend
 
 
 class VaultSourcePlugin(SourcePlugin):
@@ -328,8 +327,7 @@ def get_san_list(body):
     """ parse certificate for SAN names and return list, return empty list on error """
     san_list = []
     try:
-        byte_body = body.encode("utf-8")
-        cert = x509.load_pem_x509_certificate(byte_body, default_backend())
+        cert = parse_certificate(body)
         ext = cert.extensions.get_extension_for_oid(
             x509.oid.ExtensionOID.SUBJECT_ALTERNATIVE_NAME
         )
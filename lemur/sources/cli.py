@@ -79,7 +79,23 @@ def execute_clean(plugin, certificate, source):
     action="append",
     help="Sources to operate on.",
 )
-def sync(source_strings):
+@manager.option(
+    "-b",
+    "--batch-size",
+    dest="batch_size",
+    type=int,
+    default=None,
+    help="Match and commit certificates in batches of this size.",
+)
+@manager.option(
+    "-f",
+    "--full",
+    dest="full",
+    action="store_true",
+    default=False,
+    help="Fetch every certificate, including those unchanged since the last sync.",
+)
+def sync(source_strings, batch_size=None, full=False):
     sources = validate_sources(source_strings)
     for source in sources:
         status = FAILURE_METRIC_STATUS
@@ -90,7 +106,7 @@ def sync(source_strings):
         user = user_service.get_by_username("lemur")
 
         try:
-            data = source_service.sync(source, user)
+            data = source_service.sync(source, user, batch_size=batch_size, full=full)
             print(
                 "[+] Certificates: New: {new} Updated: {updated}".format(
                     new=data["certificates"][0], updated=data["certificates"][1]
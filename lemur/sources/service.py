@@ -7,20 +7,22 @@
 """
 import arrow
 import copy
+from collections import defaultdict
 
 from flask import current_app
 
 from lemur import database
 from lemur.sources.models import Source
 from lemur.certificates.models import Certificate
+from lemur.endpoints.models import Endpoint
 from lemur.certificates import service as certificate_service
 from lemur.endpoints import service as endpoint_service
 from lemur.extensions import metrics, sentry
 from lemur.destinations import service as destination_service
 
 from lemur.certificates.schemas import CertificateUploadInputSchema
-from lemur.common.utils import find_matching_certificates_by_hash, parse_certificate
-from lemur.common.defaults import serial
+from lemur.common.utils import chunks, parse_certificate
+from lemur.common.defaults import fingerprint
 
 from lemur.plugins.base import plugins
 from lemur.plugins.utils import get_plugin_option, set_plugin_option
@@ -65,6 +67,61 @@ def sync_update_destination(certificate, source):
             certificate.destinations.append(dest)
 
 
+def find_endpoint_certificate(plugin, source, endpoint, certificate_name):
+    """
+    Finds the Lemur certificate of an endpoint whose certificate name is unknown to Lemur,
+    by describing it through the source and matching its serial number and hash.
+
+    :param plugin:
+    :param source:
+    :param endpoint:
+    :param certificate_name:
+    :return: the certificate (or None) and the number of certificates matched by hash
+    """
+    certificate, updated_by_hash = None, 0
+    certificate_attached_to_endpoint = None
+    try:
+        certificate_attached_to_endpoint = plugin.get_certificate_by_name(certificate_name, source.options)
+    except NotImplementedError:
+        current_app.logger.warning(
+            "Unable to describe server certificate for endpoints in source {0}:"
+            " plugin has not implemented 'get_certificate_by_name'".format(
+                source.label
+            )
+        )
+        sentry.captureException()
+
+    if certificate_attached_to_endpoint:
+        lemur_matching_cert, updated_by_hash = find_cert(certificate_attached_to_endpoint)
+
+        if lemur_matching_cert:
+            certificate = lemur_matching_cert[0]
+
+        if len(lemur_matching_cert) > 1:
+            current_app.logger.error(
+                "Too Many Certificates Found{0}. Name: {1} Endpoint: {2}".format(
+                    len(lemur_matching_cert), certificate_name, endpoint["name"]
+                )
+            )
+            metrics.send("endpoint.certificate.conflict",
+                         "gauge", len(lemur_matching_cert),
+                         metric_tags={"cert": certificate_name, "endpoint": endpoint["name"],
+                                      "acct": plugin.get_option("accountNumber", source.options)})
+
+    if not certificate:
+        current_app.logger.error(
+            "Certificate Not Found. Name: {0} Endpoint: {1}".format(
+                certificate_name, endpoint["name"]
+            )
+        )
+        metrics.send("endpoint.certificate.not.found",
+                     "counter", 1,
+                     metric_tags={"cert": certificate_name, "endpoint": endpoint["name"],
+                                  "acct": plugin.get_option("accountNumber", source.options)})
+
+    return certificate, updated_by_hash
+
+
 def sync_endpoints(source):
     new, updated, updated_by_hash = 0, 0, 0
     current_app.logger.debug("Retrieving endpoints from {0}".format(source.label))
@@ -89,58 +146,16 @@ def sync_endpoints(source):
 
         endpoint["certificate"] = certificate_service.get_by_name(certificate_name)
 
-        # if get cert by name failed, we attempt a search via serial number and hash comparison
-        # and link the endpoint certificate to Lemur certificate
         if not endpoint["certificate"]:
-            certificate_attached_to_endpoint = None
-            try:
-                certificate_attached_to_endpoint = s.get_certificate_by_name(certificate_name, source.options)
-            except NotImplementedError:
-                current_app.logger.warning(
-                    "Unable to describe server certificate for endpoints in source {0}:"
-                    " plugin has not implemented 'get_certificate_by_name'".format(
-                        source.label
-                    )
-                )
-                sentry.captureException()
-
-            if certificate_attached_to_endpoint:
-                lemur_matching_cert, updated_by_hash_tmp = find_cert(certificate_attached_to_endpoint)
-                updated_by_hash += updated_by_hash_tmp
-
-                if lemur_matching_cert:
-                    endpoint["certificate"] = lemur_matching_cert[0]
-
-                if len(lemur_matching_cert) > 1:
-                    current_app.logger.error(
-                        "Too Many Certificates Found{0}. Name: {1} Endpoint: {2}".format(
-                            len(lemur_matching_cert), certificate_name, endpoint["name"]
-                        )
-                    )
-                    metrics.send("endpoint.certificate.conflict",
-                                 "gauge", len(lemur_matching_cert),
-                                 metric_tags={"cert": certificate_name, "endpoint": endpoint["name"],
-                                              "acct": s.get_option("accountNumber", source.options)})
+            endpoint["certificate"], updated_by_hash_tmp = find_endpoint_certificate(
+                s, source, endpoint, certificate_name
+            )
+            updated_by_hash += updated_by_hash_tmp
 
         if not endpoint["certificate"]:
-            current_app.logger.error(
-                "Certificate Not Found. Name: {0} Endpoint: {1}".format(
-                    certificate_name, endpoint["name"]
-                )
-            )
-            metrics.send("endpoint.certificate.not.found",
-                         "counter", 1,
-                         metric_tags={"cert": certificate_name, "endpoint": endpoint["name"],
-                                      "acct": s.get_option("accountNumber", source.options)})
             continue
 
         policy = endpoint.pop("policy")
-
-        policy_ciphers = []
-        for nc in policy["ciphers"]:
-            policy_ciphers.append(endpoint_service.get_or_create_cipher(name=nc))
-
-        policy["ciphers"] = policy_ciphers
         endpoint["policy"] = endpoint_service.get_or_create_policy(**policy)
         endpoint["source"] = source
 
@@ -159,6 +174,94 @@ def sync_endpoints(source):
     return new, updated, updated_by_hash
 
 
+def sync_endpoints_batched(source, batch_size):
+    """
+    Batched variant of `sync_endpoints`. Existing endpoints of the source are prefetched into
+    a (dnsname, port) map, certificates are looked up by name per chunk, policies and ciphers
+    are interned once for the whole sync, and each chunk of endpoints is written with a single
+    INSERT ... ON CONFLICT and committed once. Endpoints are keyed by source, dnsname and port,
+    another source reporting the same dnsname and port keeps an endpoint of its own.
+
+    :param source:
+    :param batch_size: number of endpoints written together
+    :return:
+    """
+    new, updated, updated_by_hash = 0, 0, 0
+    current_app.logger.debug("Retrieving endpoints from {0}".format(source.label))
+    s = plugins.get(source.plugin_name)
+
+    try:
+        endpoints = s.get_endpoints(source.options)
+    except NotImplementedError:
+        current_app.logger.warning(
+            "Unable to sync endpoints for source {0} plugin has not implemented 'get_endpoints'".format(
+                source.label
+            )
+        )
+        return new, updated, updated_by_hash
+
+    existing = endpoint_service.get_ids_by_dnsname_and_port(source)
+    columns = Endpoint.__table__.columns.keys()
+    policies = {}
+
+    for chunk in chunks(endpoints, batch_size):
+        certificates = {
+            c.name: c
+            for c in certificate_service.get_by_names(
+                [e["certificate_name"] for e in chunk]
+            )
+        }
+
+        for endpoint in chunk:
+            endpoint["policy_hash"] = endpoint_service.get_policy_hash(
+                endpoint["policy"]["ciphers"]
+            )
+        chunk_policies = [e["policy"] for e in chunk if e["policy_hash"] not in policies]
+        policies.update(endpoint_service.get_or_create_policies(chunk_policies))
+
+        # later entries for the same (dnsname, port) win, as they do when syncing one by one
+        rows = {}
+        for endpoint in chunk:
+            certificate_name = endpoint.pop("certificate_name")
+            certificate = certificates.get(certificate_name)
+
+            if not certificate:
+                certificate, updated_by_hash_tmp = find_endpoint_certificate(
+                    s, source, endpoint, certificate_name
+                )
+                updated_by_hash += updated_by_hash_tmp
+
+            if not certificate:
+                continue
+
+            row = {k: v for k, v in endpoint.items() if k in columns}
+            row.update(
+                policy_id=policies[endpoint["policy_hash"]].id,
+                certificate_id=certificate.id,
+                source_id=source.id,
+                active=True,
+                sensitive=endpoint.get("sensitive", False),
+                last_updated=arrow.utcnow(),
+                date_created=arrow.utcnow(),
+            )
+            rows[(row["dnsname"], row["port"])] = row
+
+        for key in rows:
+            if key in existing:
+                updated += 1
+            else:
+                new += 1
+            existing[key] = None
+
+        endpoint_service.upsert(list(rows.values()))
+        database.commit()
+
+    metrics.send("endpoint_added", "counter", new, metric_tags={"source": source.label})
+    metrics.send("endpoint_updated", "counter", updated, metric_tags={"source": source.label})
+
+    return new, updated, updated_by_hash
+
+
 def find_cert(certificate):
     updated_by_hash = 0
     exists = False
@@ -177,21 +280,192 @@ def find_cert(certificate):
 
     if not exists:
         cert = parse_certificate(certificate["body"])
-        matching_serials = certificate_service.get_by_serial(serial(cert))
-        exists = find_matching_certificates_by_hash(cert, matching_serials)
+        exists = certificate_service.get_by_bodies([cert]).get(fingerprint(cert), [])
         updated_by_hash += 1
 
     exists = [x for x in exists if x]
     return exists, updated_by_hash
 
 
-# TODO this is very slow as we don't batch update certificates
-def sync_certificates(source, user):
-    new, updated, updated_by_hash = 0, 0, 0
+def find_certs(certificates):
+    """
+    Batched variant of `find_cert`. Resolves the Lemur certificates matching each of the given
+    source certificates with one `IN` query per lookup strategy (name, serial, then body, see
+    `get_by_bodies`) instead of up to three queries per certificate.
+
+    :param certificates: list of certificate dicts as returned by a source plugin
+    :return: tuple of (matches aligned with `certificates`, number matched by hash,
+             queries issued, queries the per-certificate lookup would have issued)
+    """
+    matches = [[] for _ in certificates]
+    updated_by_hash = 0
+    queries, expected_queries = 0, 0
+
+    pending = []
+    for i, certificate in enumerate(certificates):
+        if certificate.get("search", None):
+            # arbitrary attribute searches cannot be batched, resolve them one by one
+            matches[i], by_hash = find_cert(certificate)
+            updated_by_hash += by_hash
+        else:
+            pending.append((i, certificate))
+
+    by_name = {}
+    names = {c["name"] for _, c in pending if c.get("name")}
+    if names:
+        by_name = {c.name: c for c in certificate_service.get_by_names(names)}
+        queries += 1
+
+    unresolved = []
+    for i, certificate in pending:
+        if certificate.get("name"):
+            expected_queries += 1
+            if certificate["name"] in by_name:
+                matches[i] = [by_name[certificate["name"]]]
+                continue
+        unresolved.append((i, certificate))
+
+    by_serial = defaultdict(list)
+    serials = {str(c["serial"]) for _, c in unresolved if c.get("serial")}
+    if serials:
+        for c in certificate_service.get_by_serials(serials):
+            by_serial[c.serial].append(c)
+        queries += 1
+
+    unmatched = []
+    for i, certificate in unresolved:
+        if certificate.get("serial"):
+            expected_queries += 1
+            if by_serial.get(str(certificate["serial"])):
+                matches[i] = by_serial[str(certificate["serial"])]
+                continue
+        unmatched.append((i, parse_certificate(certificate["body"])))
+
+    by_fingerprint = {}
+    if unmatched:
+        by_fingerprint = certificate_service.get_by_bodies([cert for _, cert in unmatched])
+        queries += 1
+
+    for i, cert in unmatched:
+        expected_queries += 1
+        matches[i] = by_fingerprint.get(fingerprint(cert), [])
+        updated_by_hash += 1
+
+    return matches, updated_by_hash, queries, expected_queries
+
+
+def get_source_certificates(source, full=False):
+    """
+    Fetches the certificates of a source from its plugin.
+
+    Unless `full` is set, plugins are also given the names of the certificates already
+    attached to the source and the start of its last successful sync, so they can skip
+    downloading certificates that have not changed since.
 
+    :param source:
+    :param full: fetch every certificate regardless of what Lemur already has
+    :return:
+    """
     current_app.logger.debug("Retrieving certificates from {0}".format(source.label))
     s = plugins.get(source.plugin_name)
-    certificates = s.get_certificates(source.options)
+
+    if full or not source.last_run:
+        return s.get_certificates(source.options)
+
+    known_names = set(
+        name
+        for name, in database.session_query(Certificate.name).filter(
+            Certificate.sources.any(Source.id == source.id)
+        )
+    )
+    return s.get_certificates(
+        source.options, known_names=known_names, last_run=source.last_run.datetime
+    )
+
+
+def sync_certificates_batched(source, user, batch_size, full=False):
+    """
+    Batched variant of `sync_certificates`. The certificates returned by the source plugin are
+    matched against Lemur in chunks of `batch_size`, and the source and destination associations
+    of already known certificates are committed once per chunk instead of once per certificate.
+
+    :param source:
+    :param user:
+    :param batch_size: number of certificates resolved and committed together
+    :param full: fetch every certificate from the source, see `get_source_certificates`
+    :return:
+    """
+    new, updated, updated_by_hash = 0, 0, 0
+    queries, expected_queries = 0, 0
+    commits, expected_commits = 0, 0
+
+    certificates = get_source_certificates(source, full=full)
+
+    destination = destination_service.get_by_label(source.label)
+    queries += 1
+
+    for chunk in chunks(certificates, batch_size):
+        matches, by_hash, chunk_queries, chunk_expected_queries = find_certs(chunk)
+        updated_by_hash += by_hash
+        queries += chunk_queries
+        expected_queries += chunk_expected_queries
+
+        dirty = False
+        for certificate, exists in zip(chunk, matches):
+            exists = [x for x in exists if x]
+
+            if not certificate.get("owner"):
+                certificate["owner"] = user.email
+
+            certificate["creator"] = user
+
+            if not exists:
+                certificate_create(certificate, source)
+                new += 1
+                continue
+
+            for e in exists:
+                if certificate.get("external_id"):
+                    e.external_id = certificate["external_id"]
+                if certificate.get("authority_id"):
+                    e.authority_id = certificate["authority_id"]
+
+                if source.label not in [src.label for src in e.sources]:
+                    e.sources.append(source)
+
+                if destination and source.label not in [d.label for d in e.destinations]:
+                    e.destinations.append(destination)
+
+                # the per-certificate path looks up the destination and commits for every update
+                expected_queries += 1
+                expected_commits += 1
+                dirty = True
+                updated += 1
+
+        if dirty:
+            database.commit()
+            commits += 1
+
+    current_app.logger.info(
+        "Batched sync of {0}: {1} queries saved, {2} commits saved".format(
+            source.label, expected_queries - queries, expected_commits - commits
+        )
+    )
+    metrics.send("sync.batched.queries_saved",
+                 "gauge", expected_queries - queries,
+                 metric_tags={"source": source.label})
+    metrics.send("sync.batched.commits_saved",
+                 "gauge", expected_commits - commits,
+                 metric_tags={"source": source.label})
+
+    return new, updated, updated_by_hash
+
+
+# TODO this is very slow as we don't batch update certificates, see sync_certificates_batched
+def sync_certificates(source, user, full=False):
+    new, updated, updated_by_hash = 0, 0, 0
+
+    certificates = get_source_certificates(source, full=full)
 
     for certificate in certificates:
         exists, updated_by_hash = find_cert(certificate)
@@ -217,9 +491,19 @@ def sync_certificates(source, user):
     return new, updated, updated_by_hash
 
 
-def sync(source, user):
-    new_certs, updated_certs, updated_certs_by_hash = sync_certificates(source, user)
-    new_endpoints, updated_endpoints, updated_endpoints_by_hash = sync_endpoints(source)
+def sync(source, user, batch_size=None, full=False):
+    # recorded before fetching so certificates uploaded while we sync are picked up next time
+    started = arrow.utcnow()
+
+    if batch_size is None:
+        batch_size = current_app.config.get("LEMUR_SOURCE_SYNC_BATCH_SIZE")
+
+    if batch_size:
+        new_certs, updated_certs, updated_certs_by_hash = sync_certificates_batched(source, user, batch_size, full=full)
+        new_endpoints, updated_endpoints, updated_endpoints_by_hash = sync_endpoints_batched(source, batch_size)
+    else:
+        new_certs, updated_certs, updated_certs_by_hash = sync_certificates(source, user, full=full)
+        new_endpoints, updated_endpoints, updated_endpoints_by_hash = sync_endpoints(source)
 
     metrics.send("sync.updated_certs_by_hash",
                  "gauge", updated_certs_by_hash,
@@ -229,7 +513,7 @@ def sync(source, user):
                  "gauge", updated_endpoints_by_hash,
                  metric_tags={"source": source.label})
 
-    source.last_run = arrow.utcnow()
+    source.last_run = started
     database.update(source)
 
     return {
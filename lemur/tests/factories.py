@@ -312,7 +312,7 @@ class EndpointFactory(BaseFactory):
     type = FuzzyChoice(["elb"])
     active = True
     port = FuzzyInteger(0, high=65535)
-    dnsname = "endpoint.example.com"
+    dnsname = Sequence(lambda n: "endpoint{0}.example.com".format(n))
     policy = SubFactory(PolicyFactory)
     certificate = SubFactory(CertificateFactory)
     source = SubFactory(SourceFactory)
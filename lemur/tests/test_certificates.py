@@ -84,6 +84,15 @@ def test_get_by_serial(session, certificate):
     assert found
 
 
+def test_get_by_fingerprint(session, certificate):
+    from lemur.certificates.service import get_by_fingerprint, get_by_fingerprints
+    from lemur.common.defaults import fingerprint
+
+    assert certificate.fingerprint == fingerprint(certificate.parsed_cert)
+    assert certificate in get_by_fingerprint(certificate.fingerprint)
+    assert certificate in get_by_fingerprints([certificate.fingerprint, "0" * 64])
+
+
 def test_delete_cert(session):
     from lemur.certificates.service import delete, get
     from lemur.tests.factories import CertificateFactory
@@ -146,6 +155,23 @@ def test_find_duplicates(session):
     assert len(dups2) > 0
 
 
+def test_find_duplicates_without_fingerprint(session, certificate):
+    from lemur.certificates.service import find_duplicates, get_by_bodies
+    from lemur.common.defaults import fingerprint
+    from lemur.common.utils import parse_certificate
+
+    # as stored before fingerprints were backfilled
+    certificate.fingerprint = None
+    session.commit()
+
+    cert = parse_certificate(certificate.body)
+    assert certificate in get_by_bodies([cert])[fingerprint(cert)]
+    assert certificate in find_duplicates({"body": certificate.body, "chain": certificate.chain})
+
+    # bodies that cannot be parsed are compared as text instead of raising
+    assert find_duplicates({"body": "not a certificate", "chain": None}) == []
+
+
 def test_get_certificate_primitives(certificate):
     from lemur.certificates.service import get_certificate_primitives
 
@@ -163,7 +189,19 @@ def test_certificate_output_schema(session, certificate, issuer_plugin):
     if "parsed_cert" in certificate.__dict__:
         del certificate.__dict__["parsed_cert"]
 
-    # Make sure serialization parses the cert only once (uses cached 'parsed_cert' attribute)
+    # Make sure serialization does not parse the cert (uses precomputed 'x509_metadata')
+    with patch(
+        "lemur.common.utils.parse_certificate", side_effect=utils.parse_certificate
+    ) as wrapper:
+        data, errors = CertificateOutputSchema().dump(certificate)
+        assert data["issuer"] == "LemurTrustUnittestsClass1CA2018"
+        assert data["distinguishedName"] == certificate.x509_metadata["distinguished_name"]
+        assert data["extensions"] == certificate.x509_metadata["extensions"]
+
+    assert wrapper.call_count == 0
+
+    # Rows that have not been backfilled yet still parse the cert only once
+    certificate.x509_metadata = None
     with patch(
         "lemur.common.utils.parse_certificate", side_effect=utils.parse_certificate
     ) as wrapper:
@@ -173,6 +211,24 @@ def test_certificate_output_schema(session, certificate, issuer_plugin):
     assert wrapper.call_count == 1
 
 
+def test_certificate_x509_metadata_extensions(session, certificate):
+    from lemur.certificates.models import get_x509_metadata
+    from lemur.schemas import ExtensionSchema
+
+    # stored exactly as the live serialization, without logging at creation
+    with patch("lemur.certificates.models.current_app") as app:
+        metadata = get_x509_metadata(certificate.parsed_cert)
+    assert not app.logger.warning.called
+    assert metadata["extensions"] == ExtensionSchema().dump(certificate.extensions).data
+
+    # extensions that do not dump to JSON are left to be rendered from the body
+    with patch("lemur.schemas.ExtensionSchema.dump") as dump:
+        dump.return_value.data = {"sub_alt_names": {"names": [x509.Name([])]}}
+        metadata = get_x509_metadata(certificate.parsed_cert)
+    assert "extensions" not in metadata
+    assert metadata["distinguished_name"] == certificate.x509_metadata["distinguished_name"]
+
+
 def test_certificate_edit_schema(session):
     from lemur.certificates.schemas import CertificateEditInputSchema
 
@@ -1269,3 +1325,102 @@ def test_boolean_filter(client):
         headers=VALID_ADMIN_HEADER_TOKEN,
     )
     assert resp.status_code == 200
+
+
+def test_cursor_pagination(client, session):
+    from lemur.tests.factories import CertificateFactory
+
+    for i in range(3):
+        CertificateFactory(name="cursor-{}".format(i))
+    session.commit()
+
+    for sort in ["", "&sortBy=notAfter&sortDir=asc"]:
+        url = api.url_for(CertificatesList) + "?count=2&filter=name;cursor-" + sort
+        resp = client.get(url + "&cursor=", headers=VALID_ADMIN_HEADER_TOKEN)
+        assert resp.status_code == 200
+        assert "total" not in resp.json
+
+        names = [c["name"] for c in resp.json["items"]]
+        while resp.json["nextCursor"]:
+            resp = client.get(
+                url + "&cursor=" + resp.json["nextCursor"],
+                headers=VALID_ADMIN_HEADER_TOKEN,
+            )
+            names += [c["name"] for c in resp.json["items"]]
+
+        assert sorted(names) == ["cursor-0", "cursor-1", "cursor-2"]
+
+    resp = client.get(
+        api.url_for(CertificatesList) + "?cursor=notacursor",
+        headers=VALID_ADMIN_HEADER_TOKEN,
+    )
+    assert "is not valid for this query" in resp.json["message"]
+
+
+def test_check_revoked_chunk(session):
+    from lemur.certificates.cli import check_revoked_chunk
+    from lemur.tests.factories import CertificateFactory
+
+    valid, unknown = CertificateFactory(chain=None), CertificateFactory(chain="unknown")
+    session.commit()
+
+    with patch(
+        "lemur.certificates.cli.verify_string",
+        side_effect=lambda body, chain: None if chain == "unknown" else True,
+    ):
+        counts = check_revoked_chunk([valid.id, unknown.id])
+
+    assert counts == {"valid": 1, "unknown": 1}
+    assert valid.status == "valid"
+    assert unknown.status == "unknown"
+    assert valid.last_revocation_check is not None
+
+
+def test_check_revoked_chunk_deadline(session):
+    import time
+    from lemur.certificates.cli import check_revoked_chunk
+    from lemur.tests.factories import CertificateFactory
+
+    cert = CertificateFactory()
+    session.commit()
+
+    with patch("lemur.certificates.cli.verify_string") as verify:
+        assert check_revoked_chunk([cert.id], time.time() - 1) == {}
+
+    assert not verify.called
+    assert cert.last_revocation_check is None
+
+
+def test_claim_revocation_check(session):
+    from lemur.certificates.cli import claim_revocation_check
+    from lemur.certificates.service import get_ids_due_revocation_check
+    from lemur.tests.factories import CertificateFactory
+
+    claimed, expired = CertificateFactory(), CertificateFactory()
+    session.commit()
+
+    now = arrow.utcnow()
+    claim_revocation_check([claimed.id], now.shift(hours=1))
+    claim_revocation_check([expired.id], now.shift(seconds=-1))
+
+    due = [id for ids in get_ids_due_revocation_check(now.shift(days=-1)) for id in ids]
+    assert claimed.id not in due
+    assert expired.id in due
+
+
+def test_get_ids_due_revocation_check(session):
+    from lemur.certificates.service import get_ids_due_revocation_check
+    from lemur.tests.factories import CertificateFactory, EndpointFactory
+
+    checked, unchecked = CertificateFactory(), CertificateFactory()
+    attached = EndpointFactory().certificate
+    checked.last_revocation_check = arrow.utcnow()
+    session.commit()
+
+    pages = list(get_ids_due_revocation_check(arrow.utcnow().shift(hours=-1), limit=1))
+    assert all(len(ids) == 1 for ids in pages)
+
+    ids = [id for ids in pages for id in ids]
+    assert len(set(ids)) == len(ids)
+    assert checked.id not in ids
+    assert ids.index(attached.id) < ids.index(unchecked.id)
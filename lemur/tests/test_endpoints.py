@@ -21,6 +21,52 @@ def test_rotate_certificate(client, source_plugin):
     assert endpoint.certificate == new_certificate
 
 
+def test_get_or_create_policy(session):
+    from lemur.endpoints.service import get_or_create_policy, get_or_create_policies, policy_ids
+
+    policy = get_or_create_policy(name="example-policy", ciphers=["AES256-SHA", "AES128-SHA"])
+    assert [c.name for c in policy.ciphers] == ["AES128-SHA", "AES256-SHA"]
+
+    policy_ids.clear()
+    assert get_or_create_policy(name="example-policy", ciphers=["AES128-SHA", "AES256-SHA"]) == policy
+    assert get_or_create_policy(name="example-policy", ciphers=["AES128-SHA"]) != policy
+    # policy names are unique per load balancer, the cipher set alone identifies a policy
+    assert get_or_create_policy(name="other-policy", ciphers=["AES128-SHA", "AES256-SHA"]) == policy
+
+    policies = get_or_create_policies([dict(name="example-policy", ciphers=["AES256-SHA", "AES128-SHA"])])
+    assert list(policies.values()) == [policy]
+
+
+def test_insert_policies_conflict(session):
+    from lemur.endpoints.models import Policy
+    from lemur.endpoints.service import get_or_create_policy, get_policy_hash, insert_policies
+
+    policy = get_or_create_policy(name="example-policy", ciphers=["AES128-SHA"])
+
+    # as if a concurrent sync inserted the same policy first
+    policy_hash = get_policy_hash(["AES128-SHA"])
+    insert_policies({policy_hash: dict(name="example-policy", ciphers=["AES128-SHA"])})
+    session.expire_all()
+
+    assert Policy.query.filter(Policy.content_hash == policy_hash).all() == [policy]
+    assert [c.name for c in policy.ciphers] == ["AES128-SHA"]
+
+
+def test_compact_policies(session):
+    from lemur.endpoints.cli import compact_policies
+    from lemur.endpoints.models import Cipher, Policy
+
+    first = EndpointFactory(policy=Policy(name="example-policy", ciphers=[Cipher(name="AES128-SHA")]))
+    second = EndpointFactory(policy=Policy(name="other-policy", ciphers=[Cipher(name="AES128-SHA")]))
+    session.commit()
+
+    compact_policies(True)
+
+    assert first.policy == second.policy
+    assert first.policy.content_hash
+    assert Cipher.query.filter(Cipher.name == "AES128-SHA").count() == 1
+
+
 @pytest.mark.parametrize(
     "token,status",
     [
@@ -8,6 +8,7 @@ from moto import mock_ses
 
 def test_needs_notification(app, certificate, notification):
     from lemur.notifications.messaging import needs_notification
+    from lemur.tests.factories import NotificationFactory
 
     assert not needs_notification(certificate)
 
@@ -29,6 +30,13 @@ def test_needs_notification(app, certificate, notification):
     with freeze_time(delta.datetime):
         assert needs_notification(certificate)
 
+    # an inactive notification does not hold back the active ones
+    inactive = NotificationFactory(active=False)
+    certificate.notifications.append(inactive)
+    with freeze_time(delta.datetime):
+        notifications = needs_notification(certificate)
+        assert notifications and inactive not in notifications
+
 
 def test_get_certificates(app, certificate, notification):
     from lemur.notifications.messaging import get_certificates
@@ -59,6 +67,25 @@ def test_get_certificates(app, certificate, notification):
         assert len(get_certificates()) == 0
 
 
+def test_get_certificates_once(app, certificate, session):
+    from lemur.notifications.messaging import get_certificates
+    from lemur.tests.factories import CertificateFactory, NotificationFactory
+
+    options = [{"name": "interval", "value": 10}, {"name": "unit", "value": "days"}]
+    first, second, third = [
+        NotificationFactory(label=label, options=options) for label in ["a", "b", "c"]
+    ]
+    other = CertificateFactory(owner=certificate.owner)
+    certificate.notifications.extend([first, third])
+    other.notifications.append(second)
+    session.commit()
+
+    # due under labels a and c, with the other certificate's label b in between
+    with freeze_time((certificate.not_after - timedelta(days=10, hours=1)).datetime):
+        certificates = get_certificates()
+    assert sorted(c.id for c in certificates) == sorted([certificate.id, other.id])
+
+
 def test_get_eligible_certificates(app, certificate, notification):
     from lemur.notifications.messaging import get_eligible_certificates
 
@@ -75,6 +102,98 @@ def test_get_eligible_certificates(app, certificate, notification):
         }
 
 
+def test_get_due_notifications(app, certificate, session):
+    from lemur.notifications.messaging import get_due_notifications
+    from lemur.tests.factories import NotificationFactory
+
+    due, later, inactive = [
+        NotificationFactory(
+            options=[
+                {"name": "interval", "value": interval},
+                {"name": "unit", "value": unit},
+            ],
+            active=active,
+        )
+        for interval, unit, active in [(2, "weeks", True), (30, "days", True), (14, "days", False)]
+    ]
+    certificate.notifications.extend([due, later, inactive])
+    session.commit()
+
+    delta = certificate.not_after - timedelta(days=14, hours=1)
+    with freeze_time(delta.datetime):
+        # an inactive notification no longer hides the others
+        assert get_due_notifications() == [(certificate, due)]
+        assert get_due_notifications(exclude=[certificate.name]) == []
+
+    # like before, nothing fires more than 90 days before expiration
+    far = NotificationFactory(
+        options=[{"name": "interval", "value": 120}, {"name": "unit", "value": "days"}]
+    )
+    certificate.notifications.append(far)
+    session.commit()
+    with freeze_time((certificate.not_after - timedelta(days=120, hours=1)).datetime):
+        assert get_due_notifications() == []
+
+
+def test_plan_expiration_notifications(app, certificate, notification, session):
+    from lemur.notifications.messaging import plan_expiration_notifications
+    from lemur.tests.factories import CertificateFactory
+
+    other = CertificateFactory(owner=certificate.owner)
+    notification.options = [
+        {"name": "interval", "value": 10},
+        {"name": "unit", "value": "days"},
+        {"name": "recipients", "value": "team@example.com," + certificate.owner},
+    ]
+    certificate.notifications.append(notification)
+    other.notifications.append(notification)
+    session.commit()
+
+    delta = certificate.not_after - timedelta(days=10)
+    with freeze_time(delta.datetime):
+        plan, covered = plan_expiration_notifications()
+
+    # one digest each for the owner, the other recipients and the security team
+    assert covered == 2
+    assert [targets for n, targets, certs in plan] == [
+        [certificate.owner],
+        ["team@example.com"],
+        ["security@example.com"],
+    ]
+    for n, targets, certs in plan:
+        assert n == notification
+        assert sorted(c.id for c, due in certs) == sorted([certificate.id, other.id])
+
+
+def test_plan_expiration_notifications_per_recipient(app, certificate, session):
+    from lemur.notifications.messaging import plan_expiration_notifications
+    from lemur.tests.factories import CertificateFactory, NotificationFactory
+
+    first, second = [
+        NotificationFactory(
+            options=[{"name": "interval", "value": interval}, {"name": "unit", "value": unit}]
+        )
+        for interval, unit in [(10, "days"), (10, "days")]
+    ]
+    other = CertificateFactory(owner=certificate.owner)
+    certificate.notifications.append(first)
+    other.notifications.append(second)
+    session.commit()
+
+    with freeze_time((certificate.not_after - timedelta(days=10)).datetime):
+        plan, covered = plan_expiration_notifications()
+
+    # the owner and the security team each get one digest listing both notifications
+    assert [targets for n, targets, certs in plan] == [
+        [certificate.owner],
+        ["security@example.com"],
+    ]
+    for n, targets, certs in plan:
+        assert sorted((c.id, due.id) for c, due in certs) == sorted(
+            [(certificate.id, first.id), (other.id, second.id)]
+        )
+
+
 @mock_ses
 def test_send_expiration_notification(certificate, notification, notification_plugin):
     from lemur.notifications.messaging import send_expiration_notifications
@@ -106,3 +225,130 @@ def test_send_rotation_notification(notification_plugin, certificate):
     from lemur.notifications.messaging import send_rotation_notification
 
     send_rotation_notification(certificate, notification_plugin=notification_plugin)
+
+
+@mock_ses
+def test_send_expiration_notification_dumps_once(certificate, notification, notification_plugin):
+    from mock import patch
+    from lemur.certificates.schemas import certificate_notification_output_schema
+    from lemur.notifications.messaging import send_expiration_notifications
+
+    certificate.notifications.append(notification)
+    certificate.notifications[0].options = [
+        {"name": "interval", "value": 10},
+        {"name": "unit", "value": "days"},
+    ]
+
+    delta = certificate.not_after - timedelta(days=10)
+    with freeze_time(delta.datetime), patch.object(
+        certificate_notification_output_schema,
+        "dump",
+        wraps=certificate_notification_output_schema.dump,
+    ) as dump:
+        # the owner and security team messages share the certificate's payload
+        assert send_expiration_notifications([]) == (2, 0)
+
+    assert dump.call_count == 1
+
+
+def test_notification_outbox(app, certificate, notification):
+    from mock import patch
+    from lemur.certificates.schemas import certificate_notification_output_schema
+    from lemur.notifications.messaging import dispatch_notifications, send_notification
+    from lemur.notifications.models import NotificationMessage
+
+    data = [certificate_notification_output_schema.dump(certificate).data]
+    config = {
+        "LEMUR_NOTIFICATION_OUTBOX": True,
+        "LEMUR_NOTIFICATION_RETRY_SECONDS": 0,
+        "LEMUR_NOTIFICATION_CONCURRENCY": 1,
+    }
+    with patch.dict(app.config, config):
+        assert send_notification("expiration", data, ["a@example.com"], notification)
+        # queued at most once a day
+        assert send_notification("expiration", data, ["a@example.com"], notification)
+        assert NotificationMessage.query.filter_by(status="pending").count() == 1
+
+        with patch(
+            "lemur.tests.plugins.notification_plugin.TestNotificationPlugin.send",
+            side_effect=[Exception("unavailable"), None],
+        ) as send, patch(
+            "lemur.tests.plugins.notification_plugin.TestNotificationPlugin.batch"
+        ) as batch:
+            assert dispatch_notifications() == (1, 0)
+
+    assert send.call_count == 2
+    # the only worker sent both attempts within one batch of the plugin
+    assert batch.call_count == 1
+    message = NotificationMessage.query.one()
+    assert message.status == "sent"
+    assert message.attempts == 1
+    assert message.targets == ["a@example.com"]
+
+
+def test_queue_notification_per_certificate(session, certificate, notification):
+    from lemur.certificates.schemas import certificate_notification_output_schema
+    from lemur.notifications.messaging import queue_notification
+    from lemur.notifications.models import NotificationMessage
+    from lemur.tests.factories import CertificateFactory
+
+    other = CertificateFactory()
+    session.flush()
+    first = certificate_notification_output_schema.dump(certificate).data
+    second = certificate_notification_output_schema.dump(other).data
+
+    queue_notification("expiration", [first], ["a@example.com"], notification)
+    # only the certificate not queued yet today goes out again
+    queue_notification("expiration", [first, second], ["a@example.com"], notification)
+    queue_notification("expiration", [second], ["a@example.com"], notification)
+    # other recipients get their own copy
+    queue_notification("expiration", [first], ["b@example.com"], notification)
+
+    messages = NotificationMessage.query.order_by(NotificationMessage.id).all()
+    assert [[c["name"] for c in m.payload] for m in messages] == [
+        [first["name"]],
+        [second["name"]],
+        [first["name"]],
+    ]
+
+    # nothing is committed on the caller's behalf
+    session.rollback()
+    assert NotificationMessage.query.count() == 0
+
+
+def test_purge_notifications(session, certificate, notification):
+    from lemur.certificates.schemas import certificate_notification_output_schema
+    from lemur.notifications.messaging import purge_notifications, queue_notification
+    from lemur.notifications.models import NotificationMessage, NotificationMessageKey
+
+    data = [certificate_notification_output_schema.dump(certificate).data]
+    queue_notification("expiration", data, ["a@example.com"], notification)
+    queue_notification("expiration", data, ["b@example.com"], notification)
+    old, recent = NotificationMessage.query.order_by(NotificationMessage.id).all()
+    old.status = "sent"
+    old.date_created = arrow.utcnow().shift(days=-60)
+    recent.date_created = arrow.utcnow().shift(days=-1)
+    session.commit()
+
+    # the old message goes with its key, the recent one only loses its key of yesterday
+    assert purge_notifications() == (1, 1)
+    assert NotificationMessage.query.all() == [recent]
+    assert NotificationMessageKey.query.count() == 0
+
+
+def test_claim_notifications(app, certificate, notification):
+    from mock import patch
+    from lemur.certificates.schemas import certificate_notification_output_schema
+    from lemur.notifications.messaging import claim_notifications, queue_notification
+
+    data = [certificate_notification_output_schema.dump(certificate).data]
+    queue_notification("expiration", data, ["a@example.com"], notification)
+
+    # a claim that has already expired, as if its dispatcher died
+    with patch.dict(app.config, {"LEMUR_NOTIFICATION_CLAIM_SECONDS": -60}):
+        assert [m.status for m in claim_notifications(10)] == ["sending"]
+
+    claimed = claim_notifications(10)
+    assert len(claimed) == 1
+    # another dispatcher does not get the claimed message
+    assert claim_notifications(10) == []
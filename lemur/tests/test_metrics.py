@@ -0,0 +1,115 @@
+from mock import Mock, patch
+
+
+def test_metric_buffer():
+    from lemur.metrics import MetricBuffer
+
+    buffer = MetricBuffer()
+    for _ in range(3):
+        buffer.add("source_sync", "counter", 1, {"source": "a", "status": "success"})
+    buffer.add("source_sync", "counter", 1, {"status": "success", "source": "b"})
+    buffer.add("backlog", "gauge", 5)
+    buffer.add("backlog", "gauge", 2)
+    buffer.add("latency", "timer", 10)
+    buffer.add("latency", "timer", 20)
+
+    assert len(buffer) == 4
+    assert sorted(buffer.drain(), key=str) == sorted(
+        [
+            ("source_sync", "counter", 3, {"source": "a", "status": "success"}),
+            ("source_sync", "counter", 1, {"source": "b", "status": "success"}),
+            ("backlog", "gauge", 2, {}),
+            ("latency.count", "counter", 2, {}),
+            ("latency.sum", "counter", 30, {}),
+            ("latency.min", "gauge", 10, {}),
+            ("latency.max", "gauge", 20, {}),
+        ],
+        key=str,
+    )
+    assert not buffer.drain()
+
+
+def test_metrics_flush(app):
+    from lemur.metrics import Metrics
+
+    app.config["METRIC_PROVIDERS"] = ["example-metric"]
+    app.config["METRIC_FLUSH_INTERVAL"] = 3600
+    try:
+        metrics = Metrics(app)
+    finally:
+        del app.config["METRIC_PROVIDERS"]
+        del app.config["METRIC_FLUSH_INTERVAL"]
+
+    plugin = Mock()
+    with patch("lemur.metrics.plugins.get", return_value=plugin) as get:
+        metrics.send("certificate_clean", "counter", 1, metric_tags={"source": "a"})
+        metrics.send("certificate_clean", "counter", 1, metric_tags={"source": "a"})
+        assert not plugin.submit.called
+
+        metrics.flush()
+        plugin.submit_many.assert_called_once_with(
+            [("certificate_clean", "counter", 2, {"source": "a"})]
+        )
+
+        metrics.send("rotation", "counter", 1, options={})
+        plugin.submit.assert_called_once_with("rotation", "counter", 1, options={})
+        assert get.call_count == 1
+
+
+def test_metrics_request_flush(app):
+    import time
+    from lemur.metrics import Metrics
+
+    app.config["METRIC_PROVIDERS"] = ["example-metric"]
+    app.config["METRIC_FLUSH_INTERVAL"] = 3600
+    try:
+        with patch("lemur.metrics.atexit.register") as register:
+            metrics = Metrics(app)
+            metrics.init_app(app)
+    finally:
+        del app.config["METRIC_PROVIDERS"]
+        del app.config["METRIC_FLUSH_INTERVAL"]
+    # the exit flush is registered once however often the app is initialized
+    register.assert_called_once_with(metrics.flush)
+
+    plugin = Mock()
+    with patch("lemur.metrics.plugins.get", return_value=plugin):
+        metrics.send("certificate_clean", "counter", 1)
+        metrics.request_flush()
+
+        # flushed by the background thread well before its interval is up
+        for _ in range(50):
+            if plugin.submit_many.called:
+                break
+            time.sleep(0.1)
+
+    plugin.submit_many.assert_called_once_with([("certificate_clean", "counter", 1, {})])
+
+
+def test_atlas_redis_submit_many(app):
+    import json
+    import fakeredis
+    from lemur.plugins.lemur_atlas_redis.plugin import AtlasMetricRedisPlugin
+
+    plugin = AtlasMetricRedisPlugin()
+    red = fakeredis.FakeStrictRedis(decode_responses=True)
+    options = [
+        {"name": "redis_host", "value": "localhost"},
+        {"name": "redis_port", "value": 28527},
+        {"name": "max_queue_length", "value": 3},
+    ]
+
+    with patch.object(plugin, "client", return_value=red):
+        plugin.submit("source_sync", "counter", 1, metric_tags={"source": "a"}, options=options)
+        plugin.submit_many(
+            [("backlog", "gauge", value, {}) for value in range(3)]
+            + [("backlog", "histogram", 1, {}), ("backlog", "gauge", "many", {})],
+            options=options,
+        )
+
+    queued = [json.loads(m) for m in red.lrange("atlas-agent", 0, -1)]
+    assert [(m["name"], m["type"], m["value"]) for m in queued] == [
+        ("backlog", "GAUGE", 0),
+        ("backlog", "GAUGE", 1),
+        ("backlog", "GAUGE", 2),
+    ]
@@ -11,3 +11,55 @@ def test_write_and_read_from_redis():
     value = int(time.time())
     assert red.set(key, value) is True
     assert (int(red.get(key)) == value) is True
+
+
+def test_lease_lock():
+    from lemur.common.redis import LeaseLock
+
+    red = fakeredis.FakeStrictRedis()
+    lock = LeaseLock(red, "task.lock", "task-1", 60)
+    assert lock.acquire()
+    assert not LeaseLock(red, "task.lock", "task-2", 60).acquire()
+    assert 0 < red.pttl("task.lock") <= 60000
+    assert LeaseLock(red, "other-task.lock", "task-2", 60).acquire()
+    lock.released.set()
+
+
+def test_lease_semaphore():
+    from mock import patch
+    from lemur.common.redis import LeaseSemaphore
+
+    red = fakeredis.FakeStrictRedis()
+    slots = LeaseSemaphore(red, "task.slots", 2, 60)
+    assert slots.acquire("task-1")
+    assert slots.acquire("task-2")
+    assert not slots.acquire("task-3")
+    slots.release("task-1")
+    assert slots.acquire("task-3")
+
+    # leases of holders that never released lapse
+    with patch("lemur.common.redis.time.time", return_value=time.time() + 120):
+        assert slots.acquire("task-4")
+        assert slots.acquire("task-5")
+
+
+def test_redis_handler_shares_pool():
+    from lemur.common.redis import RedisHandler
+
+    # clients are handed out without connecting
+    red = RedisHandler(host="localhost", port=1).redis()
+    assert red.connection_pool is RedisHandler(host="localhost", port=1).redis().connection_pool
+    assert red.connection_pool is not RedisHandler(host="localhost", port=2).redis().connection_pool
+
+
+def test_process_redis_follows_fork():
+    from mock import patch
+    from lemur.common.redis import ProcessRedis
+
+    red = ProcessRedis(host="localhost", port=1)
+    pool = red.connection_pool
+    assert red.connection_pool is pool
+
+    # a forked child gets a pool of its own
+    with patch("lemur.common.redis.os.getpid", return_value=-1):
+        assert red.connection_pool is not pool
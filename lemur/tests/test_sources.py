@@ -41,6 +41,51 @@ def test_create_certificate(user, source):
     assert cert.notifications
 
 
+def test_find_certs_batched(certificate):
+    from lemur.sources.service import find_certs
+
+    matches, updated_by_hash, queries, expected_queries = find_certs(
+        [
+            {"name": certificate.name, "body": certificate.body},
+            {"body": certificate.body},
+        ]
+    )
+
+    assert matches == [[certificate], [certificate]]
+    assert updated_by_hash == 1
+    assert queries == 2
+    assert expected_queries == 2
+
+
+def test_sync_endpoints_batched(session, source, certificate):
+    from mock import Mock, patch
+    from lemur.endpoints import service as endpoint_service
+    from lemur.sources.service import sync_endpoints_batched
+
+    def get_endpoints(options):
+        return [
+            dict(
+                name="example-lb",
+                dnsname="example-lb.example.com",
+                type="elb",
+                port=port,
+                certificate_name=certificate.name,
+                policy=dict(name="example-policy", ciphers=["AES128-SHA", "AES256-SHA"]),
+            )
+            for port in [443, 8443, 443]
+        ]
+
+    plugin = Mock(get_endpoints=Mock(side_effect=get_endpoints))
+    with patch("lemur.sources.service.plugins.get", return_value=plugin):
+        assert sync_endpoints_batched(source, 2) == (2, 1, 0)
+        assert sync_endpoints_batched(source, 10) == (0, 2, 0)
+
+    endpoint = endpoint_service.get_by_dnsname_and_port("example-lb.example.com", 443)
+    assert endpoint.certificate == certificate
+    assert endpoint.source == source
+    assert sorted(c.name for c in endpoint.policy.ciphers) == ["AES128-SHA", "AES256-SHA"]
+
+
 @pytest.mark.parametrize(
     "token,status",
     [
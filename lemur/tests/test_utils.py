@@ -100,3 +100,25 @@ def test_is_selfsigned(selfsigned_cert):
     # unsupported algorithm (DSA)
     with pytest.raises(Exception):
         is_selfsigned(DSA_CERT)
+
+
+def test_parse_cache():
+    from lemur.common.utils import ParseCache, parse_certificate, certificate_cache
+    from lemur.tests.vectors import INTERMEDIATE_CERT_STR, ROOTCA_CERT_STR
+
+    assert parse_certificate(INTERMEDIATE_CERT_STR) is parse_certificate(INTERMEDIATE_CERT_STR)
+    assert len(certificate_cache) > 0
+
+    parsed = []
+    cache = ParseCache("test", lambda pem: parsed.append(pem) or object())
+    cache.default_size = 1
+
+    first = cache.get(INTERMEDIATE_CERT_STR)
+    assert cache.get(INTERMEDIATE_CERT_STR) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # bounded: the least recently used entry is evicted
+    cache.get(ROOTCA_CERT_STR)
+    assert len(cache) == 1
+    assert cache.get(INTERMEDIATE_CERT_STR) is not first
+    assert len(parsed) == 3
@@ -1,14 +1,96 @@
+import datetime
+
 import pytest
+import requests_mock
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.x509 import UniformResourceIdentifier
+from cryptography.x509 import UniformResourceIdentifier, ocsp
 
-from lemur.certificates.verify import verify_string, crl_verify
+from lemur.certificates.verify import (
+    crl_store,
+    crl_verify,
+    ocsp_cache,
+    ocsp_verify,
+    verify_string,
+)
+from lemur.common.utils import parse_certificate
 from lemur.utils import mktempfile
 
 from .vectors import INTERMEDIATE_CERT_STR
 
+OCSP_URL = "http://ocsp.example.org/"
+
+
+class OCSPResponder(object):
+    """Stand-in OCSP responder answering for certificates issued by `issuer`."""
+
+    def __init__(self, issuer, issuer_key):
+        self.issuer = issuer
+        # answers are signed by the issuer unless a different responder is set
+        self.responder = issuer
+        self.responder_key = issuer_key
+        self.certificates = {}
+        self.requests = 0
+        # how long before the request the answers were produced
+        self.age = datetime.timedelta(0)
+
+    def add(self, cert, status=ocsp.OCSPCertStatus.GOOD):
+        self.certificates[cert.serial_number] = (cert, status)
+
+    def respond(self, request, context):
+        self.requests += 1
+        serial = ocsp.load_der_ocsp_request(request.body).serial_number
+        if serial not in self.certificates:
+            return ocsp.OCSPResponseBuilder.build_unsuccessful(
+                ocsp.OCSPResponseStatus.UNAUTHORIZED
+            ).public_bytes(serialization.Encoding.DER)
+
+        cert, status = self.certificates[serial]
+        now = datetime.datetime.utcnow() - self.age
+        revoked = status == ocsp.OCSPCertStatus.REVOKED
+        return (
+            ocsp.OCSPResponseBuilder()
+            .add_response(
+                cert=cert,
+                issuer=self.issuer,
+                algorithm=hashes.SHA1(),
+                cert_status=status,
+                this_update=now,
+                next_update=now + datetime.timedelta(days=1),
+                revocation_time=now if revoked else None,
+                revocation_reason=None,
+            )
+            .responder_id(ocsp.OCSPResponderEncoding.HASH, self.responder)
+            .sign(self.responder_key, hashes.SHA256())
+            .public_bytes(serialization.Encoding.DER)
+        )
+
+
+@pytest.fixture(autouse=True)
+def clear_revocation_caches():
+    ocsp_cache.responses.clear()
+    crl_store.crls.clear()
+
+
+@pytest.fixture
+def ocsp_responder(issuer_private_key):
+    responder = OCSPResponder(
+        parse_certificate(INTERMEDIATE_CERT_STR), issuer_private_key
+    )
+    with requests_mock.Mocker() as m:
+        m.post(OCSP_URL, content=responder.respond)
+        yield responder
+
+
+@pytest.fixture
+def ocsp_cert_builder(cert_builder):
+    issuer = parse_certificate(INTERMEDIATE_CERT_STR)
+    aia = x509.AuthorityInformationAccess(
+        [x509.AccessDescription(x509.OID_OCSP, UniformResourceIdentifier(OCSP_URL))]
+    )
+    return cert_builder.issuer_name(issuer.subject).add_extension(aia, critical=False)
+
 
 def test_verify_simple_cert():
     """Simple certificate without CRL or OCSP."""
@@ -56,3 +138,236 @@ def test_verify_crl_unreachable(cert_builder, private_key):
 
         with pytest.raises(Exception, match="Unable to retrieve CRL:"):
             crl_verify(cert, cert_tmp)
+
+
+def test_verify_ocsp(ocsp_responder, ocsp_cert_builder, issuer_private_key):
+    """OCSP requests are answered in-process by the stand-in responder."""
+    good = ocsp_cert_builder.serial_number(100).sign(
+        issuer_private_key, hashes.SHA256(), default_backend()
+    )
+    revoked = ocsp_cert_builder.serial_number(101).sign(
+        issuer_private_key, hashes.SHA256(), default_backend()
+    )
+    unknown = ocsp_cert_builder.serial_number(102).sign(
+        issuer_private_key, hashes.SHA256(), default_backend()
+    )
+    ocsp_responder.add(good)
+    ocsp_responder.add(revoked, ocsp.OCSPCertStatus.REVOKED)
+
+    assert ocsp_verify(good, ocsp_responder.issuer) is True
+    assert ocsp_verify(revoked, ocsp_responder.issuer) is False
+
+    with pytest.raises(Exception, match="UNAUTHORIZED"):
+        ocsp_verify(unknown, ocsp_responder.issuer)
+
+    # Without the issuer in the chain no request can be built
+    assert ocsp_verify(good, None) is None
+    assert ocsp_responder.requests == 3
+
+    # Signed answers are served from the cache until their next_update
+    assert ocsp_verify(good, ocsp_responder.issuer) is True
+    assert ocsp_verify(revoked, ocsp_responder.issuer) is False
+    assert ocsp_responder.requests == 3
+
+    pem = good.public_bytes(serialization.Encoding.PEM).decode("utf-8")
+    assert verify_string(pem, INTERMEDIATE_CERT_STR) is True
+
+
+@pytest.mark.parametrize("use_redis", [False, True])
+def test_verify_crl_store(cert_builder, private_key, issuer_private_key, use_redis):
+    """CRLs are indexed once and revalidated with their ETag after next_update."""
+    import fakeredis
+    from mock import patch
+    from lemur.certificates.verify import CRLStore
+
+    crl_uri = "http://crl.example.org/example.crl"
+    crl_dp = x509.DistributionPoint(
+        [UniformResourceIdentifier(crl_uri)],
+        relative_name=None,
+        reasons=None,
+        crl_issuer=None,
+    )
+    issuer = parse_certificate(INTERMEDIATE_CERT_STR)
+    builder = cert_builder.issuer_name(issuer.subject).add_extension(
+        x509.CRLDistributionPoints([crl_dp]), critical=False
+    )
+    certs = [
+        builder.serial_number(serial).sign(
+            issuer_private_key, hashes.SHA256(), default_backend()
+        )
+        for serial in (200, 201, 202)
+    ]
+
+    now = datetime.datetime.utcnow()
+    crl = (
+        x509.CertificateRevocationListBuilder()
+        .issuer_name(issuer.subject)
+        .last_update(now)
+        .next_update(now + datetime.timedelta(days=1))
+    )
+    for serial, reason in [
+        (200, x509.ReasonFlags.key_compromise),
+        (201, x509.ReasonFlags.remove_from_crl),
+    ]:
+        crl = crl.add_revoked_certificate(
+            x509.RevokedCertificateBuilder()
+            .serial_number(serial)
+            .revocation_date(now)
+            .add_extension(x509.CRLReason(reason), critical=False)
+            .build(default_backend())
+        )
+    crl = crl.sign(issuer_private_key, hashes.SHA256(), default_backend()).public_bytes(
+        serialization.Encoding.DER
+    )
+
+    store = CRLStore()
+    red = fakeredis.FakeStrictRedis(decode_responses=True) if use_redis else None
+    with requests_mock.Mocker() as m, patch(
+        "lemur.certificates.verify.crl_store", store
+    ), patch.object(CRLStore, "redis", return_value=red):
+        m.get(crl_uri, content=crl, headers={"ETag": '"v1"'})
+
+        assert crl_verify(certs[0]) is False
+        assert crl_verify(certs[1]) is True
+        assert crl_verify(certs[2]) is True
+        assert store.get_revocation_reason(crl_uri, 200) == "keyCompromise"
+        assert m.call_count == 1
+
+        # once stale the CRL is revalidated instead of downloaded again
+        store.crls[crl_uri]["next_update"] = now
+        if use_redis:
+            store.crls.clear()
+            red.hset(store.keys(crl_uri)[0], "next_update", now.isoformat())
+        m.get(crl_uri, status_code=304)
+        assert crl_verify(certs[0]) is False
+        assert m.call_count == 2
+        assert m.last_request.headers["If-None-Match"] == '"v1"'
+
+
+def test_crl_store_download_does_not_block_other_urls(app):
+    import threading
+    from mock import patch
+    from lemur.certificates.verify import CRLStore
+
+    slow_url_waiting = threading.Event()
+    release_slow_url = threading.Event()
+
+    def refresh(url, crl, red=None):
+        if url == "http://slow.example.org/crl":
+            slow_url_waiting.set()
+            release_slow_url.wait(5)
+        return dict(
+            revoked={1: "keyCompromise"},
+            count=1,
+            next_update=datetime.datetime.utcnow() + datetime.timedelta(hours=1),
+            etag=None,
+            last_modified=None,
+        )
+
+    store = CRLStore()
+    with patch.object(store, "refresh", side_effect=refresh) as refreshes, patch.object(
+        CRLStore, "redis", return_value=None
+    ):
+        def get_slow_url():
+            with app.app_context():
+                store.get_revocation_reason("http://slow.example.org/crl", 1)
+
+        slow = threading.Thread(target=get_slow_url)
+        slow.start()
+        assert slow_url_waiting.wait(5)
+
+        # answered while the other CRL is still downloading
+        assert store.get_revocation_reason("http://fast.example.org/crl", 1) == "keyCompromise"
+        assert slow.is_alive()
+
+        release_slow_url.set()
+        slow.join(5)
+    assert refreshes.call_count == 2
+
+
+def test_verify_crl_store_lost_index(issuer_private_key):
+    """A CRL whose index never made it to Redis is downloaded again, not read as empty."""
+    import fakeredis
+    from mock import patch
+    from lemur.certificates.verify import CRLStore
+
+    crl_uri = "http://crl.example.org/lost.crl"
+    issuer = parse_certificate(INTERMEDIATE_CERT_STR)
+    now = datetime.datetime.utcnow()
+    crl = (
+        x509.CertificateRevocationListBuilder()
+        .issuer_name(issuer.subject)
+        .last_update(now)
+        .next_update(now + datetime.timedelta(days=1))
+        .add_revoked_certificate(
+            x509.RevokedCertificateBuilder()
+            .serial_number(300)
+            .revocation_date(now)
+            .build(default_backend())
+        )
+        .sign(issuer_private_key, hashes.SHA256(), default_backend())
+        .public_bytes(serialization.Encoding.DER)
+    )
+
+    store = CRLStore()
+    red = fakeredis.FakeStrictRedis(decode_responses=True)
+    meta_key, revoked_key = store.keys(crl_uri)
+    with requests_mock.Mocker() as m, patch.object(CRLStore, "redis", return_value=red):
+        m.get(crl_uri, content=crl, headers={"ETag": '"v1"'})
+
+        # saving the index failed, revalidating must store it again from memory
+        with patch.object(CRLStore, "save"):
+            assert store.get_revocation_reason(crl_uri, 300) == "unspecified"
+        store.crls[crl_uri]["next_update"] = now
+        m.get(crl_uri, status_code=304)
+        assert store.get_revocation_reason(crl_uri, 300) == "unspecified"
+        assert red.hget(revoked_key, "300") == "unspecified"
+
+        # a meta hash without its index is a cache miss in every other worker
+        red.delete(revoked_key)
+        m.get(crl_uri, content=crl, headers={"ETag": '"v1"'})
+        assert CRLStore().get_revocation_reason(crl_uri, 300) == "unspecified"
+        assert m.call_count == 3
+
+
+def test_verify_ocsp_forged_response(
+    ocsp_responder, ocsp_cert_builder, issuer_private_key, selfsigned_cert, private_key
+):
+    """Answers not signed by the issuer or a delegated responder are rejected and not cached."""
+    cert = ocsp_cert_builder.serial_number(103).sign(
+        issuer_private_key, hashes.SHA256(), default_backend()
+    )
+    ocsp_responder.add(cert, ocsp.OCSPCertStatus.REVOKED)
+    ocsp_responder.responder = selfsigned_cert
+    ocsp_responder.responder_key = private_key
+
+    with pytest.raises(Exception, match="signature is not valid"):
+        ocsp_verify(cert, ocsp_responder.issuer)
+    assert not ocsp_cache.responses
+
+
+def test_verify_ocsp_stale_response(ocsp_responder, ocsp_cert_builder, issuer_private_key):
+    """Answers whose next_update has passed are rejected, e.g. a replayed old response."""
+    cert = ocsp_cert_builder.serial_number(104).sign(
+        issuer_private_key, hashes.SHA256(), default_backend()
+    )
+    ocsp_responder.add(cert)
+    ocsp_responder.age = datetime.timedelta(days=2)
+
+    with pytest.raises(Exception, match="stale"):
+        ocsp_verify(cert, ocsp_responder.issuer)
+    assert not ocsp_cache.responses
+
+
+def test_ocsp_cache_eviction(app):
+    """A full in-memory cache evicts its oldest answer instead of rebuilding itself."""
+    from lemur.certificates.verify import OCSPCache
+
+    cache = OCSPCache()
+    cache.max_size = 2
+    for serial in (1, 2, 3):
+        cache.set(b"issuer", serial, True)
+
+    assert cache.get(b"issuer", 1) is None
+    assert cache.get(b"issuer", 2) is True
+    assert cache.get(b"issuer", 3) is True